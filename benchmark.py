@@ -0,0 +1,458 @@
+#!/bin/python3
+# Benchmarks for ClueSheetBot, run from the repository root: python3 benchmark.py --help
+import argparse
+import datetime
+import functools
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cluesheetbot as csb
+
+
+class CountingStream(io.TextIOBase):
+    """Stands in for a line buffered terminal: every flush with pending output is one write syscall"""
+    def __init__(self):
+        self.pending = []
+        self.bytes_written = 0
+        self.writes = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.bytes_written += len(''.join(self.pending).encode())
+            self.writes += 1
+            self.pending = []
+
+
+def replay_game(savefile, differential=True):
+    """Plays a replay file through the regular user interface, returns (display, output stream)"""
+    display = csb.Display()
+    display.differential = differential
+    display.screen = None
+
+    def out_of_input():
+        raise csb.ReplayFinished()
+    display.getch = out_of_input
+
+    stream = CountingStream()
+    stdout, sys.stdout = sys.stdout, stream
+    try:
+        display.load_recording(savefile, inform_user=False)
+        cards = display.get_card_config(display.cardsfile)
+        while not csb.programloop(display, cards, in_memory=True, snapshot_file=None):
+            pass
+    except csb.ReplayFinished:
+        pass
+    finally:
+        sys.stdout = stdout
+    stream.flush()
+    return display, stream
+
+
+def typed(name):
+    return re.sub("[^A-Za-z0-9 ]", "", name) + "\r"
+
+
+def synthetic_replay(keystrokes, seed=0, block=1000):
+    """Keys of a consistent three player game with the default cards: one turn per block of keys, the rest of the
+    block edits the prompt (typing, clearing, scrolling, tab cycling, refreshing) without changing the game"""
+    rnd = random.Random(seed)
+    names = csb.Display().get_card_config()["names"]
+    players = [("Me", "Colonel Mustard"), ("Ann", "Miss Scarlett"), ("Bob", "Professor Plum")]
+
+    envelope = [rnd.choice(names[cardtype]) for cardtype in sorted(names)]
+    rest = [c for cardtype in sorted(names) for c in names[cardtype] if c not in envelope]
+    rnd.shuffle(rest)
+    hands = dict((name, rest[i::len(players)]) for i, (name, pawn) in enumerate(players))
+
+    keys = ["new game\r"]
+    for name, pawn in players:
+        keys += ["add player\r", name + "\r", typed(pawn)]
+    keys.append("start game\r")
+    keys += ["%i\r" % len(hands[name]) for name, pawn in players]
+    keys += [typed(card) for card in hands["Me"]]
+    keys.append("Ann\r")
+    count = sum(len(k) for k in keys)
+    filler = ["ref\r", "\033[A", "\033[B", "skp\025", "\t\t\025"]
+
+    turn = 1
+    while count < keystrokes:
+        questioner = players[turn][0]
+        if questioner == "Me":
+            turn_keys = ["skip\r", "yes\r"]
+        else:
+            leads = [rnd.choice(names[cardtype]) for cardtype in ("rooms", "suspects", "weapons")]
+            turn_keys = ["turn\r"] + [typed(lead) for lead in leads]
+            for i in range(1, len(players)):
+                interviewee = players[(turn + i) % len(players)][0]
+                holding = [lead for lead in leads if lead in hands[interviewee]]
+                if interviewee == "Me":
+                    turn_keys.append(typed(holding[0]) if len(holding) > 1 else "\r") #single options are filled in
+                else:
+                    turn_keys.append("show\r" if holding else "pass\r")
+                if holding:
+                    break
+        turn = (turn + 1) % len(players)
+        keys += turn_keys
+        count += sum(len(k) for k in turn_keys)
+
+        target = min(keystrokes, count + block - sum(len(k) for k in turn_keys))
+        while count < target:
+            unit = filler[rnd.randrange(len(filler))]
+            if count + len(unit) > target:
+                unit = "\025" #Ctrl+U on an empty line pads to the exact length
+            keys.append(unit)
+            count += len(unit)
+    return "".join(keys)[:keystrokes]
+
+
+def replay_headless(savefile, **settings):
+    """Fast-forwards a replay file without screen output on a Memory with the given settings, returns (display,
+    seconds replaying, seconds saving)"""
+    display = csb.Display()
+    display.headless = True
+
+    display.load_recording(savefile, inform_user=False)
+    cards = display.get_card_config(display.cardsfile)
+    start = time.perf_counter()
+    try:
+        while not csb.programloop(display, cards, in_memory=True, snapshot_file=None, **settings):
+            pass
+    except csb.ReplayFinished:
+        pass
+    replaying = time.perf_counter() - start
+
+    start = time.perf_counter()
+    display.save_recording(os.devnull, inform_user=False)
+    saving = time.perf_counter() - start
+    assert display.recorded() == display.simbuffer, "recording differs from the replay"
+    return display, replaying, saving
+
+
+def bench_replay(args):
+    print("%-12s %10s %12s %12s %12s" % ("keystrokes", "replay s", "us/key", "save ms", "engine"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            savefile = os.path.join(tmp, "synthetic_%i.sav" % size)
+            with open(savefile, "w", newline='') as save:
+                save.write('\0' + synthetic_replay(size, args.seed))
+            display, replaying, saving = replay_headless(savefile, engine_name=args.engine)
+            print("%-12i %10.2f %12.1f %12.1f %12s" % (size, replaying, replaying / size * 1e6, saving * 1000,
+                  args.engine))
+
+
+class SyntheticGame(object):
+    """A random but consistent game played straight on Memory without any display: the hands are dealt, every
+    suggestion is random and every interviewee answers truthfully, deducing at the same points as the game loop"""
+
+    def __init__(self, names, players, seed=0, **settings):
+        self.rnd = random.Random(seed)
+        self.memory = memory = csb.Memory(**settings)
+        memory.db_setup()
+        memory.new_cards(names)
+        self.by_type = dict((t, [c for c in memory.get_cards() if c.type == t]) for t in ("room", "suspect", "weapon"))
+        if players > len(self.by_type["suspect"]):
+            raise ValueError("%i players need as many suspects" % players)
+
+        envelope = [self.rnd.choice(self.by_type[t]) for t in sorted(self.by_type)]
+        rest = [c for c in memory.get_cards() if c not in envelope]
+        self.rnd.shuffle(rest)
+        self.hands = {}
+        for i in range(players):
+            player = memory.new_player("Player %i" % (i+1), self.by_type["suspect"][i])
+            self.hands[player.id] = rest[i::players]
+            memory.set_number_of_cards(player, len(self.hands[player.id]))
+        memory.deal(self.hands[memory.get_players()[0].id])
+        memory.whose_turn = self.rnd.choice(memory.get_players())
+        self.clues = 0
+
+    def deduce(self):
+        start = time.perf_counter()
+        self.memory.run_deductions()
+        return time.perf_counter() - start
+
+    def play_turn(self):
+        """Plays one turn, returns the seconds spent deducing"""
+        memory = self.memory
+        seconds = self.deduce() #start of the game loop
+        questioner = memory.whose_turn
+        leads = [self.rnd.choice(self.by_type[t]) for t in ("room", "suspect", "weapon")]
+        memory.begin_turn()
+        interviewee = memory.next_player(questioner)
+        while interviewee != questioner:
+            holding = [c for c in leads if c in self.hands[interviewee.id]]
+            if holding:
+                shown = self.rnd.choice(holding) if memory.user in (questioner, interviewee) else None
+                memory.record_show(questioner, interviewee, leads, shown)
+                self.clues += 1
+                break
+            memory.record_pass(interviewee, leads)
+            interviewee = memory.next_player(interviewee)
+            seconds += self.deduce()
+        memory.end_turn(questioner, leads)
+        return seconds
+
+
+class HostedGame(object):
+    """The same kind of random but consistent game as SyntheticGame, told to a hosted Session by names: the setup
+    and then every turn as the suggestion and its answers"""
+
+    def __init__(self, names, players, seed=0):
+        self.rnd = random.Random(seed)
+        self.by_type = dict((t, names[t + "s"]) for t in ("room", "suspect", "weapon"))
+        if players > len(self.by_type["suspect"]):
+            raise ValueError("%i players need as many suspects" % players)
+        envelope = [self.rnd.choice(self.by_type[t]) for t in sorted(self.by_type)]
+        rest = [c for cards in names.values() for c in cards if c not in envelope]
+        self.rnd.shuffle(rest)
+        self.players = ["Player %i" % (i+1) for i in range(players)]
+        self.hands = dict((name, rest[i::players]) for i, name in enumerate(self.players))
+        self.whose_turn = self.rnd.randrange(players)
+        self.setup = (names, [(name, self.by_type["suspect"][i], len(self.hands[name])) for i, name in enumerate(self.players)],
+                      self.hands[self.players[0]], self.players[self.whose_turn])
+
+    def turn(self):
+        questioner = self.players[self.whose_turn]
+        leads = [self.rnd.choice(self.by_type[t]) for t in ("room", "suspect", "weapon")]
+        answers = []
+        for i in range(1, len(self.players)):
+            interviewee = self.players[(self.whose_turn + i) % len(self.players)]
+            holding = [c for c in leads if c in self.hands[interviewee]]
+            if holding:
+                shown = self.rnd.choice(holding) if self.players[0] in (questioner, interviewee) else None
+                answers.append({'player': interviewee, 'shows': True, 'card': shown})
+                break
+            answers.append({'player': interviewee, 'shows': False})
+        self.whose_turn = (self.whose_turn + 1) % len(self.players)
+        return questioner, leads, answers
+
+
+def variant(cards_per_category, cardsfile=""):
+    if cardsfile:
+        return csb.Display().get_card_config(cardsfile)["names"]
+    return dict((category, ["%s %02i" % (category[:-1].capitalize(), i+1) for i in range(cards_per_category)])
+                for category in ("suspects", "weapons", "rooms"))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_deduction_config(config):
+    """One configuration in a process of its own, so that its peak memory is its own"""
+    settings = dict(engine_name=config['engine'], in_memory=True, snapshot_file=None, events_file=None)
+    names = variant(config['categories'], config['cards'])
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies, cycles, clues = [], 0, 0
+    for seed in range(config['games']):
+        game = SyntheticGame(names, config['players'], seed, **settings)
+        latencies += [game.play_turn() for turn in range(config['turns'])]
+        cycles += game.memory.cycles
+        clues += game.clues
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    late = latencies[-(len(latencies) // 4 or 1):]
+    return dict(config,
+                ms_per_turn=round(1000 * sum(latencies) / len(latencies), 3),
+                p95_ms=round(1000 * percentile(latencies, 0.95), 3),
+                late_ms_per_turn=round(1000 * sum(late) / len(late), 3),
+                cycles_per_turn=round(cycles / len(latencies), 2),
+                clues_per_game=round(clues / config['games'], 1),
+                peak_mb=round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)) #ru_maxrss unit differs
+
+
+def commit_id():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def previous_results(filename, commit):
+    """The latest stored result of every configuration measured at another commit"""
+    previous = {}
+    if os.path.isfile(filename):
+        with open(filename) as results:
+            for line in results:
+                run = json.loads(line)
+                if run['commit'] != commit:
+                    for result in run['results']:
+                        previous[config_key(result)] = (run['commit'], result)
+    return previous
+
+
+def config_key(config):
+    return tuple(config[k] for k in ('engine', 'players', 'categories', 'cards', 'turns', 'games'))
+
+
+def bench_deduction(args):
+    configs = [{'engine': engine, 'players': players, 'categories': categories, 'cards': args.cards,
+                'turns': args.turns, 'games': args.games}
+               for engine in args.engines for categories in ([None] if args.cards else args.categories)
+               for players in args.players if args.cards or players <= categories]
+    commit = commit_id()
+    previous = previous_results(args.results, commit) if args.results else {}
+
+    print("%-12s %7s %5s %9s %9s %9s %9s %7s %8s  %s" % ("engine", "players", "cards", "ms/turn", "p95 ms",
+          "late ms", "cycles", "clues", "peak MB", "vs. previous commit"))
+    results = []
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool: #a fresh process for every configuration
+        for result in pool.imap(run_deduction_config, configs):
+            results.append(result)
+            before = previous.get(config_key(result))
+            change = ""
+            if before:
+                change = "%+.0f%% ms/turn (%s)" % (100.0 * result['ms_per_turn'] / max(before[1]['ms_per_turn'], 1e-9) - 100,
+                                                  before[0])
+            print("%-12s %7i %5s %9.2f %9.2f %9.2f %9.2f %7.1f %8.1f  %s" % (result['engine'], result['players'],
+                  "file" if args.cards else result['categories'], result['ms_per_turn'], result['p95_ms'],
+                  result['late_ms_per_turn'], result['cycles_per_turn'], result['clues_per_game'], result['peak_mb'], change))
+
+    if args.results:
+        with open(args.results, "a") as store:
+            store.write(json.dumps({'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                                    'results': results}) + "\n")
+
+
+def run_odds_config(config):
+    settings = dict(in_memory=True, snapshot_file=None, events_file=None, odds_budget=config['budget'])
+    names = variant(config['categories'])
+
+    latencies, estimated = [], 0
+    for seed in range(config['games']):
+        game = SyntheticGame(names, config['players'], seed, **settings)
+        for turn in range(config['turns']):
+            game.play_turn()
+            game.deduce()
+            start = time.perf_counter()
+            odds = game.memory.odds(game.memory.user)
+            if odds is None or odds['deals'] is None:
+                estimated += 1
+            latencies.append(time.perf_counter() - start)
+    return dict(config, ms_per_turn=round(1000 * sum(latencies) / len(latencies), 3),
+                p95_ms=round(1000 * percentile(latencies, 0.95), 3), max_ms=round(1000 * max(latencies), 3),
+                estimated=estimated)
+
+
+def bench_odds(args):
+    configs = [{'players': players, 'categories': categories, 'turns': args.turns, 'games': args.games,
+                'budget': args.budget}
+               for categories in args.categories for players in args.players if players <= categories]
+    print("%7s %5s %9s %9s %9s %8s" % ("players", "cards", "ms/turn", "p95 ms", "max ms", "drawn"))
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_odds_config, configs):
+            print("%7i %5i %9.2f %9.2f %9.2f %8i" % (result['players'], result['categories'], result['ms_per_turn'],
+                  result['p95_ms'], result['max_ms'], result['estimated']))
+
+
+def run_sessions_config(config):
+    """Hosts that many games at once and plays all their turns, every game's turns queued right away"""
+    names = variant(config['categories'])
+    with tempfile.TemporaryDirectory() as tmp:
+        sessions = csb.Sessions(tmp if config['files'] else None, config['jobs'])
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        games = [HostedGame(names, config['players'], seed) for seed in range(config['sessions'])]
+        for seed, game in enumerate(games):
+            sessions.open("game%i" % seed, engine_name=config['engine'])
+            sessions.submit("game%i" % seed, 'setup', *game.setup).result()
+
+        latencies = []
+        def done(future, submitted=None):
+            latencies.append(time.perf_counter() - submitted)
+        start = time.perf_counter()
+        futures = []
+        for turn in range(config['turns']):
+            for seed, game in enumerate(games):
+                future = sessions.submit("game%i" % seed, 'play_turn', *game.turn())
+                future.add_done_callback(functools.partial(done, submitted=time.perf_counter()))
+                futures.append(future)
+        for future in futures:
+            future.result()
+        seconds = time.perf_counter() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        sessions.shutdown()
+    turns = config['turns'] * config['sessions']
+    return dict(config, turns_per_s=round(turns / seconds, 1), ms_per_turn=round(1000 * seconds / turns, 3),
+                p95_ms=round(1000 * percentile(latencies, 0.95), 1),
+                mb_per_session=round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024) / config['sessions'], 2))
+
+
+def bench_sessions(args):
+    configs = [{'sessions': sessions, 'players': args.players, 'categories': args.categories, 'turns': args.turns,
+                'jobs': args.jobs, 'files': args.files, 'engine': args.engine} for sessions in args.sessions]
+    print("%8s %10s %9s %11s %12s" % ("sessions", "turns/s", "ms/turn", "p95 wait ms", "MB/session"))
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_sessions_config, configs):
+            print("%8i %10.1f %9.2f %11.1f %12.2f" % (result['sessions'], result['turns_per_s'], result['ms_per_turn'],
+                  result['p95_ms'], result['mb_per_session']))
+
+
+def bench_render(args):
+    print("%-30s %-12s %10s %14s %14s" % ("replay", "renderer", "keystrokes", "bytes/key", "writes/key"))
+    for savefile in args.savefiles:
+        for differential in (False, True):
+            display, stream = replay_game(savefile, differential)
+            keys = max(display.keystrokes, 1)
+            print("%-30s %-12s %10i %14.1f %14.2f" % (savefile[-30:], "differential" if differential else "full",
+                  display.keystrokes, stream.bytes_written / keys, stream.writes / keys))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    render = subparsers.add_parser('render', help="Terminal output per keystroke, full redraw vs. differential")
+    render.add_argument('savefiles', nargs='+', metavar='SAVEFILE')
+    render.set_defaults(run=bench_render)
+    replay = subparsers.add_parser('replay', help="Headless replay time of synthetic keystroke files")
+    replay.add_argument('sizes', nargs='*', type=int, default=[10000, 100000, 1000000], metavar='KEYSTROKES')
+    replay.add_argument('--seed', type=int, default=0)
+    replay.add_argument('--engine', default='sql', choices=sorted(csb.engines))
+    replay.set_defaults(run=bench_replay)
+    deduction = subparsers.add_parser('deduction', help="Deduction latency, cycles and memory of synthetic games")
+    deduction.add_argument('--players', nargs='+', type=int, default=[3, 4, 6])
+    deduction.add_argument('--categories', nargs='+', type=int, default=[6, 9, 12], metavar='CARDS',
+                           help="Cards per category of the generated variants")
+    deduction.add_argument('--cards', default="", metavar='CARDSFILE', help="Uses the cards file instead")
+    deduction.add_argument('--turns', type=int, default=60)
+    deduction.add_argument('--games', type=int, default=3, help="Games (seeds) per configuration")
+    deduction.add_argument('--engines', nargs='+', default=['sql'], choices=sorted(csb.engines))
+    deduction.add_argument('--results', default="benchmark_results.jsonl", metavar='FILE',
+                           help="Appends the results and compares with the last other commit, empty to skip")
+    deduction.set_defaults(run=bench_deduction)
+    odds = subparsers.add_parser('odds', help="Time to count the deals for the odds after every turn")
+    odds.add_argument('--players', nargs='+', type=int, default=[3, 4, 6])
+    odds.add_argument('--categories', nargs='+', type=int, default=[6, 9], metavar='CARDS',
+                      help="Cards per category of the generated variants")
+    odds.add_argument('--turns', type=int, default=40)
+    odds.add_argument('--games', type=int, default=3, help="Games (seeds) per configuration")
+    odds.add_argument('--budget', type=int, default=5000, metavar='MS', help="Counting budget per turn")
+    odds.set_defaults(run=bench_odds)
+    sessions = subparsers.add_parser('sessions', help="Throughput of many games hosted at once, as they scale")
+    sessions.add_argument('sessions', nargs='*', type=int, default=[1, 4, 16, 64], metavar='SESSIONS')
+    sessions.add_argument('--players', type=int, default=4)
+    sessions.add_argument('--categories', type=int, default=6, metavar='CARDS',
+                          help="Cards per category of the generated variant")
+    sessions.add_argument('--turns', type=int, default=20, help="Turns per game")
+    sessions.add_argument('--jobs', type=int, default=None, help="Threads running the games (default: the executor's)")
+    sessions.add_argument('--files', action='store_true', help="Puts every game on a database file instead of in memory")
+    sessions.add_argument('--engine', default='sql', choices=sorted(csb.engines))
+    sessions.set_defaults(run=bench_sessions)
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit()
+    args.run(args)
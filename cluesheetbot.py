@@ -1,7 +1,22 @@
 #!/bin/python3
 # ClueSheetBot is a clue[do] sheet at first sight but records EVERYTHING and thereby does fancy advanced logic stuff
 import argparse
+import asyncio
+import atexit
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import csv
 import datetime
+import functools
+import glob
+import http.server
+import itertools
+import json
+import locale
+import math
+import multiprocessing
 import os
 import random
 import re
@@ -10,56 +25,127 @@ import sqlite3
 import string
 import sys
 import termios
+import threading
+import time
 import traceback
 import tty
+import urllib.parse
 
 class DB(object):
-    def __init__(self, dbname, clone_from=None):
-        self.dbname = dbname
+    in_memory = ':memory:'
 
-        try:
-            if os.path.isfile(self.dbname):
-                os.remove(self.dbname)
-        except OSError:
-            print("Sorry, unable to access database file.")
-            raise
-        if clone_from:
-            shutil.copy2(clone_from, self.dbname)
+    def __init__(self, dbname, clone_from=None, threaded=False):
+        self.dbname = dbname
+        self.threaded = threaded
+        self.snapshots = set()
 
-        self.dbconn = sqlite3.connect(self.dbname, isolation_level=None)
+        if self.dbname != self.in_memory:
+            try:
+                if os.path.isfile(self.dbname):
+                    os.remove(self.dbname)
+            except OSError:
+                print("Sorry, unable to access database file.")
+                raise
+            if clone_from:
+                shutil.copy2(clone_from, self.dbname)
+
+        #a threaded connection is handed between worker threads, though never used by two at once
+        self.dbconn = sqlite3.connect(self.dbname, isolation_level=None, check_same_thread=not threaded)
         self.cursor = self.dbconn.cursor()
 
     def execute(self, query, vals):
         return self.cursor.execute(query, vals)
 
+    def get_lastrowid(self):
+        return self.cursor.lastrowid
+
+    def executemany(self, query, vals):
+        return self.cursor.executemany(query, vals)
+
     def fetchall(self):
         return self.cursor.fetchall()
 
     def get_rowcount(self):
         return self.cursor.rowcount
 
+    def checkpoint(self):
+        """Copy of the whole database in memory, taken between transactions"""
+        copy = sqlite3.connect(self.in_memory, isolation_level=None, check_same_thread=not self.threaded)
+        self.dbconn.backup(copy)
+        return copy
+
+    def restore(self, checkpoint):
+        """Turns the database back into the checkpoint, which is used up"""
+        foreign_keys = self.dbconn.execute("pragma foreign_keys").fetchone()[0]
+        if self.dbname == self.in_memory:
+            #nobody else sees this database, so the checkpoint simply takes its place
+            self.dbconn.close()
+            self.dbconn = checkpoint
+            self.cursor = self.dbconn.cursor()
+        else:
+            checkpoint.backup(self.dbconn)
+            checkpoint.close()
+        self.dbconn.execute("pragma foreign_keys=%i" % foreign_keys) #a setting of the connection, not the file
+
+    def snapshot(self, filename):
+        #Readers must never see a half written file, so it is built aside and moved into place
+        partial = filename + ".part"
+        if os.path.isfile(partial):
+            os.remove(partial)
+        target = sqlite3.connect(partial, isolation_level=None)
+        try:
+            if not self.dbconn.in_transaction:
+                self.dbconn.backup(target)
+            else:
+                #the backup API waits for open transactions (e.g. the turn savepoint), so copy table by table instead
+                target.execute("BEGIN")
+                schema = self.dbconn.execute("""SELECT type, name, sql FROM sqlite_master
+                                                    WHERE sql IS NOT NULL ORDER BY type = 'table' DESC""").fetchall()
+                for objtype, name, sql in schema:
+                    if name.startswith("sqlite_"):
+                        continue #internal, e.g. sqlite_sequence comes with the first AUTOINCREMENT table
+                    target.execute(sql)
+                    if objtype == 'table':
+                        self.copy_rows(target, name)
+                for objtype, name, sql in schema:
+                    if objtype == 'table' and name.startswith("sqlite_"):
+                        target.execute("DELETE FROM " + name) #filled by the rows copied into the other tables
+                        self.copy_rows(target, name)
+                target.execute("COMMIT")
+            target.close()
+            os.replace(partial, filename)
+        except BaseException:
+            target.close()
+            os.remove(partial)
+            raise
+        self.snapshots.add(filename)
+
+    def copy_rows(self, target, table):
+        rows = self.dbconn.execute("SELECT * FROM " + table).fetchall()
+        if rows:
+            target.executemany("INSERT INTO %s VALUES (%s)" % (table, ",".join("?"*len(rows[0]))), rows)
+
     def __del__(self):
         self.dbconn.close()
-        os.remove(self.dbname)
+        if self.dbname != self.in_memory:
+            os.remove(self.dbname)
+        for filename in self.snapshots:
+            if os.path.isfile(filename):
+                os.remove(filename)
 
 
 class Player(object):
-    def __init__(self, memory, playerid=None, playername=None):
-        select = "SELECT id, porder, suspectcard, number_of_cards, name FROM players "
-        if playerid:
-            memory.execute(select + "WHERE id = ?", (playerid,))
-        elif playername:
-            memory.execute(select + "WHERE name = ?", (playername,))
-        else:
-            raise ValueError("Player instantiation without identifier")
-        rows = memory.fetchall()
-        if len(rows) != 1:
-            raise RuntimeError("Player lookup failed")
-        self.id = rows[0][0]
-        self.order = rows[0][1]
-        self.suspectcard = Card(memory, cardid=rows[0][2])
-        self.number_of_cards = rows[0][3]
-        self.name = rows[0][4]
+    __slots__ = ('id', 'order', 'suspectcard', 'number_of_cards', 'name')
+
+    def __init__(self, playerid, order, suspectcard, number_of_cards, name):
+        for slot, value in zip(self.__slots__, (playerid, order, suspectcard, number_of_cards, name)):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Player is immutable")
+
+    def __reduce__(self): #pickled by the constructor as attributes cannot be set
+        return (self.__class__, tuple(getattr(self, slot) for slot in self.__slots__))
 
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
@@ -68,22 +154,22 @@ class Player(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.id)
+
 
 class Card(object):
-    def __init__(self, memory, cardid=None, cardname=None):
-        select = "SELECT id, type, name FROM cards "
-        if cardid:
-            memory.execute(select + "WHERE id = ?", (cardid,))
-        elif cardname:
-            memory.execute(select + "WHERE name = ?", (cardname,))
-        else:
-            raise ValueError("Card instantiation without identifier")
-        rows = memory.fetchall()
-        if len(rows) != 1:
-            raise RuntimeError("Card lookup failed")
-        self.id = rows[0][0]
-        self.type = rows[0][1]
-        self.name = rows[0][2]
+    __slots__ = ('id', 'type', 'name')
+
+    def __init__(self, cardid, cardtype, name):
+        for slot, value in zip(self.__slots__, (cardid, cardtype, name)):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Card is immutable")
+
+    def __reduce__(self): #pickled by the constructor as attributes cannot be set
+        return (self.__class__, tuple(getattr(self, slot) for slot in self.__slots__))
 
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
@@ -92,27 +178,85 @@ class Card(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.id)
+
 
 class Memory(object):
     real_file = 'cluesheetbot.db.tmp'
-    perspective_default = None
-    perspective_board = None
-    user = None
-    whose_turn = None
-    whose_turn_undo = None
-    rowcount = 0
-    undo_savepoint_exists = False
-    undo_available = False
-
-    def __init__(self):
-        self.real_brain = DB(self.real_file)
+    in_memory = False
+    snapshot_file = None
+    snapshot_interval = 0 #milliseconds, 0 publishes at turn boundaries only
+    events_file = None
+    push = None #PushServer streaming the sheets to external apps
+    profiling = False
+    profile_file = None
+    odds_budget = 500 #milliseconds for counting the deals of one perspective, and as much for drawing them instead
+    odds_precision = 0.02 #confidence interval half width of the odds from deals drawn
+    sample_jobs = None #processes drawing deals, one per core
+    engine_name = 'sql'
+    rules = ('romeo_and_julia', 'highlander', 'whats_in_the_box', 'resolve_questioner', 'resolve_solver')
+    undo_depth = 20 #turns kept for undo, 0 keeps all of them, each a full copy of the database of 60-150 KiB
+    change_retention = 5000 #changes kept for readers catching up, older ones are pruned at the start of each turn
+
+    def __init__(self, dbname=None, logger=None, **settings):
+        #Any of the settings above for this game only, the class keeps the defaults the command line set
+        for name, value in settings.items():
+            if not hasattr(type(self), name):
+                raise TypeError("No setting named %s" % name)
+            setattr(self, name, value)
+        #deductions may run in a worker thread, though never while the game thread uses the database
+        self.real_brain = DB(dbname or (DB.in_memory if self.in_memory else self.real_file), threaded=True)
+        self.logger = logger #tells the user what the deductions found
+        self.deducer = None
+        self.deduction = None #Future of the deductions running in the background
+        self.game_thread = None #the thread which waits for them before it uses the database
+        self.generation = 0 #of the sheet they work on, raised when it is replaced as a whole
+        self.settled = False #nothing changed since the deductions last reached their fixpoint
+        self.rowcount = 0
+        self.randseed = "" #the players, their pawns and the user's cards seed the game's randomness
+        self.perspective_default = None
+        self.perspective_board = None
+        self.user = None
+        self.whose_turn = None
+        self.last_snapshot = None
+        self.engine = engines[self.engine_name](self)
+        self.events = EventLog(self.events_file) if self.events_file else None
+        self.turn_answers = []
+        self.clue_number = 0 #of the latest clue, clues are numbered as they are given and numbers are never reused
+        #Statistics of the game
+        self.turns = 0
+        self.in_turn = False
+        self.cycles = 0
+        self.rule_changes = {}
+        self.solved_turn = None
+        self.profiler = Profiler(self.profile_file) if self.profiling else None
+        self.odds_cache = {} #perspective id -> (what was counted, odds)
+        self.leads_cache = None #(what was ranked, suggestions ranked) for the user's turn
+        self.checkpoints = [] #the game at the start of each of the last turns, oldest first
+        #Registry of the game's players and cards, kept in sync by the methods creating or changing them
+        self.cards = []
+        self.cards_by_id = {}
+        self.cards_by_name = {}
+        self.players = []
+        self.players_by_id = {}
+        self.players_by_name = {}
         return
 
     def execute(self, query, vals=()):
+        if self.deduction and threading.current_thread() is self.game_thread:
+            self.finish_deductions()
         result = self.real_brain.execute(query, vals)
         self.rowcount = self.real_brain.get_rowcount()
         return result
 
+    def executemany(self, query, vals):
+        if self.deduction and threading.current_thread() is self.game_thread:
+            self.finish_deductions()
+        result = self.real_brain.executemany(query, vals)
+        self.rowcount = self.real_brain.get_rowcount()
+        return result
+
     def fetchall(self):
         return self.real_brain.fetchall()
 
@@ -155,11 +299,16 @@ class Memory(object):
             has INTEGER DEFAULT NULL,
             certainty REAL DEFAULT NULL,
             likely INTEGER DEFAULT 0,
+            PRIMARY KEY(perspective, player, card),
             FOREIGN KEY(perspective) REFERENCES players(id),
             FOREIGN KEY(player) REFERENCES players(id),
             FOREIGN KEY(card) REFERENCES cards(id)
-        )
+        ) WITHOUT ROWID
         """)
+        #Column access (Highlander, What's-in-the-box, clue refinement) and row statistics (Romeo-and-Julia)
+        self.execute("CREATE INDEX facts_by_card ON facts (perspective, card, has, certainty)")
+        self.execute("CREATE INDEX facts_by_player ON facts (perspective, player, has, certainty)")
+        self.execute("CREATE INDEX facts_by_has ON facts (has, perspective, card, certainty)")
 
         #A clue is an unresolved "player X holds one of these" from someone's perspective
         self.execute("""
@@ -169,78 +318,405 @@ class Memory(object):
             player INTEGER NOT NULL,
             questioner INTEGER NOT NULL,
             lead INTEGER NOT NULL,
+            PRIMARY KEY(perspective, number, player, lead),
             FOREIGN KEY(perspective) REFERENCES players(id),
             FOREIGN KEY(player) REFERENCES players(id),
             FOREIGN KEY(questioner) REFERENCES players(id),
             FOREIGN KEY(lead) REFERENCES cards(id)
-        )
+        ) WITHOUT ROWID
         """)
+        #Clue resolution from the questioner's point of view
+        self.execute("CREATE INDEX clues_by_questioner ON clues (perspective, number, questioner, player, lead)")
 
         self.execute('pragma foreign_keys=ON')
         return
 
+    def db_create_changes(self):
+        #Change data capture: every fact changed and every clue added or dropped, numbered by an ever increasing
+        #version so that readers only need to look at what changed since the version they saw last
+        self.execute("""
+        CREATE TABLE changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            perspective INTEGER,
+            player INTEGER,
+            card INTEGER,
+            number INTEGER,
+            questioner INTEGER,
+            old_has INTEGER,
+            has INTEGER,
+            old_certainty REAL,
+            certainty REAL
+        )
+        """)
+        self.execute("""
+        CREATE TRIGGER capture_fact AFTER UPDATE OF has, certainty ON facts
+            WHEN OLD.has IS NOT NEW.has OR OLD.certainty IS NOT NEW.certainty
+            BEGIN
+                INSERT INTO changes (kind, perspective, player, card, old_has, has, old_certainty, certainty)
+                    VALUES ('fact', NEW.perspective, NEW.player, NEW.card, OLD.has, NEW.has, OLD.certainty, NEW.certainty);
+            END
+        """)
+        self.execute("""
+        CREATE TRIGGER capture_clue_added AFTER INSERT ON clues
+            BEGIN
+                INSERT INTO changes (kind, perspective, player, card, number, questioner)
+                    VALUES ('clue_added', NEW.perspective, NEW.player, NEW.lead, NEW.number, NEW.questioner);
+            END
+        """)
+        self.execute("""
+        CREATE TRIGGER capture_clue_dropped AFTER DELETE ON clues
+            BEGIN
+                INSERT INTO changes (kind, perspective, player, card, number, questioner)
+                    VALUES ('clue_dropped', OLD.perspective, OLD.player, OLD.lead, OLD.number, OLD.questioner);
+            END
+        """)
+        return
+
     def init_cardtypes(self):
         self.execute("INSERT INTO cardtypes VALUES ('suspect'),('weapon'),('room')")
         return
 
     def new_card(self, name, cardtype):
         self.execute("INSERT INTO cards (type, name) VALUES (?, ?)", (cardtype, name,))
-        return Card(self, cardname=name)
+        card = Card(self.real_brain.get_lastrowid(), cardtype, name)
+        self.cards.append(card)
+        self.cards.sort(key=lambda c: c.name) #the order the name index used to hand them out
+        self.cards_by_id[card.id] = card
+        self.cards_by_name[card.name] = card
+        return card
+
+    def new_cards(self, names):
+        self.executemany("INSERT INTO cards (type, name) VALUES (?, ?)",
+                         [(cardtype.rstrip('s'), cardname) for cardtype in sorted(list(names))
+                          for cardname in sorted(list(names[cardtype]))])
+        self.execute("SELECT id, type, name FROM cards")
+        for card in [Card(*row) for row in self.fetchall() if row[0] not in self.cards_by_id]:
+            self.cards.append(card)
+            self.cards_by_id[card.id] = card
+            self.cards_by_name[card.name] = card
+        self.cards.sort(key=lambda c: c.name)
 
     def new_player(self, name, suspectcard):
         self.execute("INSERT INTO players (porder, suspectcard, number_of_cards, name) VALUES ((SELECT COUNT(*) FROM players) + 1, ?, 0, ?)", (suspectcard.id, name,))
-        return Player(self, playername=name)
+        return self.register_player(Player(self.real_brain.get_lastrowid(), len(self.players) + 1, suspectcard, 0, name))
+
+    def register_player(self, player):
+        if player.id in self.players_by_id:
+            self.players[self.players.index(player)] = player
+        else:
+            self.players.append(player)
+        self.players_by_id[player.id] = player
+        self.players_by_name[player.name] = player
+        return player
 
     def init_facts(self):
+        latest = self.latest_change()
         self.execute("""INSERT INTO facts (perspective, player, card)
                             SELECT p1.id, p2.id, c.id
                             FROM players p1
                                 JOIN players p2
                                 JOIN cards c""")
+        self.reset_changes(latest)
+        self.settled = False
         return
 
+    def setup(self, cards, players, user_cards, first):
+        """Sets up a game from names: the cards by category, the (name, suspect, number of cards) of the players
+        in their order starting with the user, the user's cards and the player starting"""
+        self.db_setup()
+        self.new_cards(cards)
+        for name, suspect, number_of_cards in players:
+            player = self.new_player(name, self.get_card(cardname=suspect))
+            self.set_number_of_cards(player, number_of_cards)
+            self.randseed += name+suspect
+        self.deal([self.get_card(cardname=name) for name in user_cards])
+        self.randseed += "".join(user_cards)
+        self.whose_turn = self.get_player(playername=first)
+
+    def deal(self, user_cards):
+        #Blank facts, then the user is the first player and knows their own hand
+        self.init_facts()
+        self.user = self.players[0]
+        self.perspective_default = self.user
+        self.perspective_board = self.user
+        self.add_facts([(self.user, self.user, card, True, 1) for card in user_cards])
+
     def db_setup(self):
         self.db_create_tables()
+        self.db_create_changes()
         self.init_cardtypes()
         return
 
     def get_players(self):
-        self.execute("SELECT id FROM players ORDER BY porder ASC")
-        rows = self.fetchall()
-        players = [Player(self, playerid=row[0]) for row in rows]
-        return players
+        return list(self.players)
 
     def get_cards(self):
-        self.execute("SELECT id FROM cards")
-        rows = self.fetchall()
-        cards = [Card(self, cardid=row[0]) for row in rows]
-        return cards
+        return list(self.cards)
+
+    def get_player(self, playerid=None, playername=None):
+        if playerid:
+            player = self.players_by_id.get(playerid)
+        elif playername:
+            player = self.players_by_name.get(playername)
+        else:
+            raise ValueError("Player lookup without identifier")
+        if not player:
+            raise RuntimeError("Player lookup failed")
+        return player
+
+    def get_card(self, cardid=None, cardname=None):
+        if cardid:
+            card = self.cards_by_id.get(cardid)
+        elif cardname:
+            card = self.cards_by_name.get(cardname)
+        else:
+            raise ValueError("Card lookup without identifier")
+        if not card:
+            raise RuntimeError("Card lookup failed")
+        return card
 
     def set_number_of_cards(self, player, number_of_cards):
         self.execute("""UPDATE players SET number_of_cards = ? WHERE id = ?
                      """, (number_of_cards, player.id))
-        player.number_of_cards = number_of_cards
+        self.engine.reset()
+        self.settled = False
+        return self.register_player(Player(player.id, player.order, player.suspectcard, number_of_cards, player.name))
 
     def add_fact(self, player, card, has, certainty=None, perspective=None):
-        perspective = self.assure_perspective(perspective)
-        self.execute("""UPDATE facts SET has = ?, certainty = ?
-                        WHERE perspective = ? AND player = ? AND card = ?""",
-                (has, certainty, perspective.id, player.id, card.id))
+        self.add_facts([(self.assure_perspective(perspective), player, card, has, certainty)])
+
+    def add_facts(self, facts):
+        """Sets all the (perspective, player, card, has, certainty) facts in one statement and tells the engine,
+        returns the (perspective, player, card) cells touched"""
+        self.executemany("""UPDATE facts SET has = ?, certainty = ?
+                            WHERE perspective = ? AND player = ? AND card = ?""",
+                         [(has, certainty, perspective.id, player.id, card.id)
+                          for perspective, player, card, has, certainty in facts])
+        for perspective, player, card, has, certainty in facts:
+            self.engine.note_fact(perspective, player, card, has, certainty)
+        if facts:
+            self.settled = False
+        return [(perspective, player, card) for perspective, player, card, _, _ in facts]
 
     def add_clue(self, questioner, interviewee, leads):
         if len(leads) != 3:
             raise AssertionError("Clue should contain three cards")
-        self.execute("""INSERT INTO clues (perspective, number, questioner, player, lead)
-                            WITH number (last) AS (SELECT IFNULL(MAX(number),0) FROM clues)
-                            SELECT p.id, (number.last+1), ?, ?, leads.id
-                                FROM players p
-                                    JOIN number
-                                    JOIN (SELECT ? id UNION SELECT ? id UNION SELECT ? id) leads
-                     """, (questioner.id, interviewee.id,)+tuple(c.id for c in leads))
+        number = self.clue_number + 1
+        self.executemany("INSERT INTO clues (perspective, number, questioner, player, lead) VALUES (?, ?, ?, ?, ?)",
+                         [(perspective.id, number, questioner.id, interviewee.id, lead)
+                          for lead in sorted(set(c.id for c in leads))
+                          for perspective in sorted(self.players, key=lambda p: p.id)])
+        self.clue_number = number
+        self.engine.note_clue(number, questioner, interviewee, leads)
+        self.settled = False
+        return number
+
+    def publish(self, turn_boundary=True):
+        if self.deduction and threading.current_thread() is self.game_thread:
+            self.finish_deductions() #which publish what they found, one after the other
+        if self.push and self.user:
+            self.push.update(self)
+        #Only an in-memory database needs to be copied for external readers to see it
+        if not (self.in_memory and self.snapshot_file):
+            return
+        now = time.monotonic()
+        if not turn_boundary:
+            if not self.snapshot_interval:
+                return
+            if self.last_snapshot is not None and (now - self.last_snapshot)*1000 < self.snapshot_interval:
+                return
+        self.real_brain.snapshot(self.snapshot_file)
+        self.last_snapshot = now
+
+    def latest_change(self):
+        self.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'changes'")
+        return self.fetchall()[0][0]
+
+    def changes_since(self, version):
+        """(latest version, changes after the given version oldest first) - the changes are None if some of them are
+        no longer kept or the tables were rolled back or replaced since, then everything has to be read anew"""
+        latest = self.latest_change()
+        if version == latest:
+            return latest, []
+        self.execute("SELECT MIN(version) FROM changes")
+        oldest = self.fetchall()[0][0]
+        if version > latest or oldest is None or version + 1 < oldest:
+            return latest, None
+        self.execute("""SELECT version, kind, perspective, player, card, number, questioner, old_has, has, old_certainty, certainty
+                            FROM changes WHERE version > ? ORDER BY version""", (version,))
+        changes = self.fetchall()
+        if any(change[1] == 'reset' for change in changes):
+            return latest, None
+        return latest, changes
+
+    def reset_changes(self, latest):
+        #what changed after the latest version before the tables were rolled back or replaced cannot be told apart,
+        #so readers are told to read everything anew, by a version above all versions handed out so far
+        self.execute("DELETE FROM changes WHERE version > ?", (latest,))
+        self.execute("INSERT INTO changes (version, kind) VALUES (?, 'reset')", (latest + 1,))
+
+    def rollback(self, savepoint):
+        self.supersede_deductions()
+        latest = self.latest_change()
+        self.execute("ROLLBACK TO SAVEPOINT " + savepoint)
+        self.execute("RELEASE SAVEPOINT " + savepoint)
+        self.reset_changes(latest)
+        self.engine.reset()
+        self.settled = False
+
+    def log(self, text):
+        if self.logger:
+            self.logger(text)
+
+    def log_event(self, event, **details):
+        if self.events:
+            self.events.write(event, **details)
+
+    def state(self):
+        self.execute("SELECT perspective, player, card, has, certainty FROM facts")
+        facts = self.fetchall()
+        self.execute("SELECT perspective, number, player, questioner, lead FROM clues")
+        return {'whose_turn': self.whose_turn.name, 'facts': facts, 'clues': self.fetchall(), 'clue_number': self.clue_number}
+
+    def restore_state(self, state):
+        self.supersede_deductions()
+        latest = self.latest_change()
+        self.execute("DELETE FROM clues")
+        self.execute("DELETE FROM facts")
+        self.executemany("INSERT INTO facts (perspective, player, card, has, certainty) VALUES (?, ?, ?, ?, ?)",
+                         state['facts'])
+        self.executemany("INSERT INTO clues (perspective, number, player, questioner, lead) VALUES (?, ?, ?, ?, ?)",
+                         state['clues'])
+        self.reset_changes(latest)
+        self.whose_turn = self.get_player(playername=state['whose_turn'])
+        self.clue_number = state.get('clue_number', max([clue[1] for clue in state['clues']] or [0]))
+        self.engine.reset()
+        self.settled = False
+
+    #Game steps shared by the game loop and event replays
+
+    def begin_turn(self):
+        if self.events:
+            self.events.turn_starts(self)
+        self.execute("DELETE FROM changes WHERE version <= ?", (self.latest_change() - self.change_retention,))
+        self.checkpoint()
+        self.execute("SAVEPOINT turn")
+        self.turn_answers = []
+        self.in_turn = True
+
+    def record_pass(self, interviewee, leads):
+        return self.record_answers(None, leads, [(interviewee, False, None)])
+
+    def record_show(self, questioner, interviewee, leads, shown=None):
+        return self.record_answers(questioner, leads, [(interviewee, True, shown)])
+
+    def record_answers(self, questioner, leads, answers):
+        """Applies the (interviewee, shows, shown card) answers to a suggestion of the leads in one transaction, the
+        facts of all of them in one statement, and returns the (perspective, player, card) cells touched. The game
+        loop deduces after every pass, so it records the answers one at a time, but nothing needs to."""
+        facts, clues, recorded = [], [], []
+        for interviewee, shows, shown in answers:
+            if not shows:
+                #cannot show so everyone gains facts
+                facts += [(inspector, interviewee, lead, False, 1) for inspector in self.get_players() for lead in leads]
+            else:
+                #if we are the inspector we gain plain facts...
+                if questioner == self.user:
+                    facts += [(questioner, interviewee, shown, True, 1), (interviewee, interviewee, shown, True, 1)]
+                #if we are interviewed we know who knows more...
+                elif interviewee == self.user:
+                    facts.append((questioner, interviewee, shown, True, 1))
+                #...but in any case everyone gets a clue
+                clues.append(interviewee)
+            answer = {'player': interviewee.name, 'shows': shows}
+            if shows:
+                answer['card'] = shown.name if shown else None
+            recorded.append(answer)
+        self.supersede_deductions() #they work on a sheet without these answers, the next run starts from them
+        self.execute("SAVEPOINT answers")
+        clue_number = self.clue_number
+        try:
+            touched = self.add_facts(facts)
+            for interviewee in clues:
+                self.add_clue(questioner, interviewee, leads)
+        except BaseException:
+            self.rollback("answers")
+            self.clue_number = clue_number
+            raise
+        self.execute("RELEASE SAVEPOINT answers")
+        self.turn_answers += recorded
+        return touched
+
+    def end_turn(self, questioner, leads):
+        self.whose_turn = self.next_player(self.whose_turn)
+        self.execute("RELEASE SAVEPOINT turn")
+        self.turns += 1
+        self.in_turn = False
+        if self.events:
+            self.events.turns += 1
+            self.log_event('turn', turn=self.events.turns, player=questioner.name, leads=[c.name for c in leads],
+                           answers=self.turn_answers)
+
+    def abort_turn(self):
+        self.rollback("turn")
+        checkpoint = self.checkpoints.pop()
+        checkpoint['brain'].close() #nothing to undo
+        self.clue_number = checkpoint['clue_number']
+        self.in_turn = False
+
+    def checkpoint(self):
+        self.checkpoints.append({'brain': self.real_brain.checkpoint(), 'whose_turn': self.whose_turn,
+                                 'turns': self.turns, 'solved_turn': self.solved_turn, 'clue_number': self.clue_number})
+        #retention: the oldest turns can no longer be undone
+        while self.undo_depth and len(self.checkpoints) > self.undo_depth:
+            self.checkpoints.pop(0)['brain'].close()
+
+    def undoable_turns(self):
+        return len(self.checkpoints)
+
+    def undo_turns(self, turns=1):
+        """Goes back to the start of the turn that many turns ago, by swapping in its checkpoint"""
+        if not 0 < turns <= len(self.checkpoints):
+            raise LookupError("Only %i turn(s) can be undone" % len(self.checkpoints))
+        self.supersede_deductions()
+        latest = self.latest_change()
+        kept = len(self.checkpoints) - turns
+        checkpoint, undone = self.checkpoints[kept], self.checkpoints[kept+1:]
+        self.checkpoints = self.checkpoints[:kept]
+        for later in undone:
+            later['brain'].close()
+        self.real_brain.restore(checkpoint['brain'])
+        self.reset_changes(latest)
+        self.whose_turn = checkpoint['whose_turn']
+        self.turns = checkpoint['turns']
+        self.solved_turn = checkpoint['solved_turn']
+        self.clue_number = checkpoint['clue_number']
+        self.engine.reset()
+        self.settled = False
+        self.log_event('undo', turns=turns)
+
+    def skip_turn(self):
+        self.whose_turn = self.next_player(self.whose_turn)
+        self.log_event('skip')
+
+    def override_fact(self, player, card, has, certainty, perspectives):
+        self.supersede_deductions()
+        self.add_facts([(perspective, player, card, has, certainty) for perspective in perspectives])
+        self.log_event('fact', player=player.name, card=card.name, has=has, certainty=certainty,
+                       perspectives=[p.name for p in perspectives])
+
+    def commit_undo(self):
+        if not self.checkpoints:
+            return False
+        for checkpoint in self.checkpoints:
+            checkpoint['brain'].close()
+        self.checkpoints = []
+        self.log_event('commit')
+        return True
 
     def next_player(self, current):
-        players = self.get_players()
-        return players[(players.index(current)+1)%len(players)]
+        return self.players[current.order % len(self.players)]
 
     def assure_perspective(self, perspective):
         if not perspective:
@@ -258,37 +734,148 @@ class Memory(object):
         assert len(rows) == 1
         return (rows[0][0], rows[0][1])
 
+    def count_rule(self, rule, changes, evaluated=1):
+        self.rule_changes[rule] = self.rule_changes.get(rule, 0) + changes
+        if self.profiler:
+            self.profiler.lap(rule, changes, evaluated)
+        return changes
+
+    def statistics(self):
+        stats = {'players': len(self.players), 'turns': self.turns, 'solved_turn': self.solved_turn, 'cycles': self.cycles,
+                 'facts_deduced': sum(self.rule_changes.values())}
+        for rule in self.rules:
+            stats['deduced_' + rule] = self.rule_changes.get(rule, 0)
+        return stats
+
+    def solution(self, perspective=None):
+        #The envelope's cards once perspective is absolutely certain about all three of them
+        perspective = perspective or self.perspective_default
+        if not perspective:
+            return None
+        self.execute("""SELECT c.id FROM cards c
+                            WHERE NOT EXISTS
+                                (SELECT 1 FROM facts f
+                                    WHERE f.perspective = ? AND f.card = c.id
+                                        AND (IFNULL(f.has, 1) != 0 OR IFNULL(f.certainty, 0.0) < 1.0))
+                     """, (perspective.id,))
+        envelope = [self.get_card(cardid=row[0]) for row in self.fetchall()]
+        if len(envelope) != 3 or len(set(c.type for c in envelope)) != 3:
+            return None
+        return envelope
+
+    def odds(self, perspective=None, solutions=False):
+        #Exact probabilities as seen by perspective, or estimated from deals drawn if counting them exceeds the
+        #budget, None if not even one deal that fits could be found
+        perspective = self.assure_perspective(perspective)
+        counter = DealCounter(self, perspective, self.odds_budget / 1000.0)
+        cached = self.odds_cache.get(perspective.id)
+        if cached and cached[0] == counter.key and not (solutions and cached[1] and cached[1]['solutions'] is None):
+            return cached[1]
+        try:
+            odds = counter.count(solutions)
+        except CountingBudgetExceeded as e:
+            self.log("Counting the deals takes over %i ms, drawing some instead." % self.odds_budget)
+            #seeded like the game's other randomness
+            sampler = DealSampler(counter, "%s/%s" % (self.randseed, perspective.name), self.odds_precision,
+                                  self.odds_budget / 1000.0, self.sample_jobs)
+            odds = sampler.estimate(solutions)
+        if odds or not (cached and cached[0] == counter.key): #the cells may still be known without the solutions
+            self.odds_cache[perspective.id] = (counter.key, odds)
+        return odds
+
+    def start_deductions(self, publish=False):
+        """Runs the deductions (and publishes the game afterwards if asked to) in a worker thread. The game thread
+        goes on until it uses the database, which first waits for them to finish, so the game sees the very same
+        facts at the very same time as if they had run right away."""
+        if self.settled and not publish:
+            return
+        if not self.deducer:
+            self.deducer = concurrent.futures.ThreadPoolExecutor(1)
+        self.finish_deductions()
+        self.game_thread = threading.current_thread()
+        self.deduction = self.deducer.submit(self.deduce_and_publish, publish)
+
+    def finish_deductions(self):
+        """Waits for the deductions running in the background, returns the number of facts they deduced"""
+        deduction, self.deduction = self.deduction, None
+        return deduction.result() if deduction else 0
+
+    def supersede_deductions(self):
+        """Stops the deductions running in the background after their current cycle, for a change replacing the
+        sheet as a whole (undo, restore, rollback) which would throw their work away anyway, or adding facts
+        (answers, overrides) which would only wait for a run about to be redone. The sheet is left unsettled, so
+        they start over on it next time, and a stopped run publishes nothing. Deducing only after new facts may
+        give other certainties than deducing to the end before them."""
+        self.generation += 1
+        self.finish_deductions()
+
+    def deduce_and_publish(self, publish=False):
+        generation = self.generation
+        changes = self.run_deductions()
+        if publish and self.generation == generation: #not a sheet about to be replaced
+            self.publish()
+        return changes
+
     def run_deductions(self):
+        if self.settled: #another run could not find anything new
+            return 0
         total_changes = 0
         changes = None
         cycles = 0
-
+        generation = self.generation
+
+        profiler = self.profiler
+        if profiler:
+            profiler.begin()
+        self.engine.load()
+        if profiler:
+            profiler.lap('load')
         while changes != 0:
             cycles += 1
-            changes = self.deduce()
+            changes = self.engine.deduce()
             total_changes += changes
             if cycles > 99:
                 #I got 99 problems but an infinite loop ain't one
-                display.log("Deduction engine just escaped from a singularity...")
+                self.log("Deduction engine just escaped from a singularity...")
                 break
+            if self.generation != generation: #superseded, the sheet is about to be replaced
+                self.settled = False
+                self.cycles += cycles
+                return total_changes
         cycles -= 1 #because the last one was futile
+        self.engine.store()
+        if profiler:
+            profiler.lap('store')
+            profiler.end(self.turns + self.in_turn, cycles + 1)
+        self.settled = changes == 0
+        self.cycles += cycles
+        if total_changes and self.solved_turn is None and self.solution():
+            self.solved_turn = self.turns + self.in_turn
 
         if cycles > 1:
-            display.log("Deduction engine used %i cycles!" % cycles)
+            self.log("Deduction engine used %i cycles!" % cycles)
 
         if total_changes:
-            display.log("Deduced %i new fact(s)." % total_changes)
+            self.log("Deduced %i new fact(s)." % total_changes)
+        self.publish(turn_boundary=False)
         return total_changes
 
 
     def deduce(self):
-        players = self.get_players()
-        cards = self.get_cards()
+        changes = self.deduce_facts()
+        changes += self.resolve_questioner()
+        changes += self.deduce_clues()
+        return changes
+
+    #Every rule but resolve_questioner stays within a perspective, so each part can run on a perspective's rows alone
+
+    def deduce_facts(self):
         changes = 0
 
         #FACT BASED DEDUCTIONS
 
         #Romeo-and-Julia (column based hold-or-not-hold deduction)
+        #(counting every player's known cards reads each fact once per statement, in the order of facts_by_player)
         self.execute("""
             WITH
                 plan_raw (perspective, player, has_known, has_target, certainty) AS
@@ -324,14 +911,12 @@ class Memory(object):
                         WHERE facts.perspective = plan.perspective
                             AND facts.player = plan.player
                             AND (facts.has IS NULL OR facts.has = plan.has_target))
-                WHERE EXISTS
-                    (SELECT 42 FROM plan
-                        WHERE facts.perspective = plan.perspective
-                            AND facts.player = plan.player
-                            AND facts.has IS NULL)
+                WHERE facts.has IS NULL
+                    AND (facts.perspective, facts.player) IN
+                        (SELECT plan.perspective, plan.player FROM plan)
         """)
         self.execute("SELECT CHANGES()")
-        changes += self.fetchall()[0][0]
+        changes += self.count_rule('romeo_and_julia', self.fetchall()[0][0])
 
         #Highlander (there can be only one player who holds a card)
         self.execute("""
@@ -349,14 +934,11 @@ class Memory(object):
                         WHERE facts.perspective = plan.perspective
                             AND facts.player = plan.poorplayer
                             AND facts.card = plan.card)
-                WHERE EXISTS
-                    (SELECT 42 FROM plan
-                        WHERE facts.perspective = plan.perspective
-                            AND facts.player = plan.poorplayer
-                            AND facts.card = plan.card);
+                WHERE (facts.perspective, facts.player, facts.card) IN
+                    (SELECT plan.perspective, plan.poorplayer, plan.card FROM plan);
         """)
         self.execute("SELECT CHANGES()")
-        changes += self.fetchall()[0][0]
+        changes += self.count_rule('highlander', self.fetchall()[0][0])
 
         #Whats-in-box-?!?!? (if you know who holds all weapons but one...)
         self.execute("""
@@ -371,33 +953,26 @@ class Memory(object):
                         WHERE f.has = 1
                         GROUP BY f.perspective, f.has, c.type
                         HAVING COUNT(f.card) = cstats.num - 1),
-                nobodyknows (perspective, card, type) AS
-                    (SELECT f.perspective, f.card, c.type
-                        FROM facts f
-                            JOIN cards c
-                                ON f.card = c.id
-                        GROUP BY f.perspective, f.card
-                        HAVING MAX(IFNULL(f.has, 0)) = 0),
                 plan (perspective, card, certainty) AS
-                    (SELECT om.perspective, nk.card, om.certainty
+                    (SELECT om.perspective, c.id, om.certainty
                         FROM onemissing om
-                            INNER JOIN nobodyknows nk
-                                ON om.perspective = nk.perspective
-                                    AND om.type = nk.type)
+                            JOIN cards c
+                                ON om.type = c.type
+                        WHERE NOT EXISTS
+                            (SELECT 1 FROM facts f
+                                WHERE f.has = 1 AND f.perspective = om.perspective AND f.card = c.id))
             UPDATE facts
                 SET has = 0,
                     certainty =
                     (SELECT certainty FROM plan
                         WHERE facts.perspective = plan.perspective
                             AND facts.card = plan.card)
-                WHERE EXISTS
-                    (SELECT 42 FROM plan
-                        WHERE facts.perspective = plan.perspective
-                            AND facts.card = plan.card
-                            AND facts.has IS NULL)
+                WHERE facts.has IS NULL
+                    AND (facts.perspective, facts.card) IN
+                        (SELECT plan.perspective, plan.card FROM plan)
         """)
         self.execute("SELECT CHANGES()")
-        changes += self.fetchall()[0][0]
+        changes += self.count_rule('whats_in_the_box', self.fetchall()[0][0])
 
         #CLUE-BASED DEDUCTIONS
 
@@ -406,19 +981,21 @@ class Memory(object):
             WITH analysis (perspective, number, player, lead, has) AS
                 (SELECT cl.perspective, cl.number, cl.player, cl.lead, f.has
                     FROM clues cl
-                        JOIN facts f
+                        CROSS JOIN facts f
                             ON cl.perspective = f.perspective
                                 AND cl.player = f.player
                                 AND cl.lead = f.card
                     WHERE f.has = 0)
             DELETE FROM clues
-                WHERE EXISTS
-                    (SELECT 42 FROM analysis a
-                        WHERE a.perspective = clues.perspective
-                            AND a.number = clues.number
-                            AND a.player = clues.player
-                            AND a.lead = clues.lead)
+                WHERE (clues.perspective, clues.number, clues.player, clues.lead) IN
+                    (SELECT a.perspective, a.number, a.player, a.lead FROM analysis a)
         """)
+        if self.profiler:
+            self.execute("SELECT CHANGES()")
+            self.profiler.lap('refine_clues', self.fetchall()[0][0])
+        return changes
+
+    def resolve_questioner(self):
         #...then note that the questioner definitely knows the answer...
         self.execute("""
             WITH remainders (perspective, questioner, player, lead) AS
@@ -428,14 +1005,14 @@ class Memory(object):
                     HAVING COUNT(lead) = 1)
             UPDATE facts
                 SET has = 1, certainty = 1.0
-                WHERE EXISTS
-                    (SELECT 42 FROM remainders r
-                        WHERE r.questioner = facts.perspective
-                            AND r.player = facts.player
-                            AND r.lead = facts.card)
+                WHERE (facts.perspective, facts.player, facts.card) IN
+                    (SELECT r.questioner, r.player, r.lead FROM remainders r)
         """)
         self.execute("SELECT CHANGES()")
-        changes += self.fetchall()[0][0]
+        return self.count_rule('resolve_questioner', self.fetchall()[0][0])
+
+    def deduce_clues(self):
+        changes = 0
         #...also resolve the rest of the clue from the solver's perspective...
         self.execute("""
             WITH remainders (perspective, number, player, lead) AS
@@ -445,15 +1022,12 @@ class Memory(object):
                     HAVING COUNT(lead) = 1)
             UPDATE facts
                 SET has = 1, certainty = 0.5
-                WHERE EXISTS
-                    (SELECT 42 FROM remainders r
-                        WHERE r.perspective = facts.perspective
-                            AND r.player = facts.player
-                            AND r.lead = facts.card
-                            AND facts.has IS NULL)
+                WHERE facts.has IS NULL
+                    AND (facts.perspective, facts.player, facts.card) IN
+                        (SELECT r.perspective, r.player, r.lead FROM remainders r)
         """)
         self.execute("SELECT CHANGES()")
-        changes += self.fetchall()[0][0]
+        changes += self.count_rule('resolve_solver', self.fetchall()[0][0])
         #...and delete them afterwards
         self.execute("""
             WITH usedup (perspective, number) AS
@@ -462,14 +1036,1474 @@ class Memory(object):
                     GROUP BY perspective, number, player
                     HAVING COUNT(lead) = 1)
             DELETE FROM clues
-                WHERE EXISTS
-                    (SELECT 42 FROM usedup u
-                        WHERE u.perspective = clues.perspective
-                            AND u.number = clues.number)
+                WHERE (clues.perspective, clues.number) IN
+                    (SELECT u.perspective, u.number FROM usedup u)
         """)
+        if self.profiler:
+            self.execute("SELECT CHANGES()")
+            self.profiler.lap('drop_clues', self.fetchall()[0][0])
+
+        return changes
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+if hasattr(int, 'bit_count'): #Python 3.10 and later count natively
+    popcount = int.bit_count
+
+def positions(mask):
+    pos = 0
+    while mask:
+        if mask & 1:
+            yield pos
+        mask >>= 1
+        pos += 1
+
+
+class SQLEngine(object):
+    """Reference engine: every rule is a statement run against the database (see Memory.deduce)"""
+    def __init__(self, memory):
+        self.memory = memory
+
+    def load(self):
+        return
+
+    def deduce(self):
+        return self.memory.deduce()
+
+    def store(self):
+        return
+
+    def reset(self):
+        return
+
+    def note_fact(self, perspective, player, card, has, certainty):
+        return
+
+    def note_clue(self, number, questioner, interviewee, leads):
+        return
+
+
+class Shard(object):
+    """One perspective's sheet: per player a bitmask of held and of missing cards (bit = card position)"""
+    def __init__(self, perspective, players, num_cards):
+        self.perspective = perspective
+        self.has = dict((player, 0) for player in players)
+        self.hasnot = dict((player, 0) for player in players)
+        self.certainty = dict((player, [None]*num_cards) for player in players)
+        self.clues = {} #number -> [player, questioner, {lead position: card id}]
+
+
+class BitsetEngine(object):
+    """Evaluates the rules of Memory.deduce on bitmasks in memory and writes back only the cells that changed.
+
+    Each rule mirrors its SQL statement exactly (including how certainty is aggregated and how changes are
+    counted) so that both engines leave identical facts and clues tables behind."""
+    def __init__(self, memory):
+        self.memory = memory
+        self.shards = {}
+        self.evaluated = 0
+
+    def load(self):
+        memory = self.memory
+        self.number_of_cards = dict((p.id, p.number_of_cards) for p in memory.get_players())
+        self.players = list(self.number_of_cards)
+        cards = sorted(memory.get_cards(), key=lambda c: c.id)
+        self.cardids = [c.id for c in cards]
+        self.position = dict((cardid, pos) for pos, cardid in enumerate(self.cardids))
+        self.typemasks = {}
+        for pos, card in enumerate(cards):
+            self.typemasks[card.type] = self.typemasks.get(card.type, 0) | (1 << pos)
+        self.allmask = (1 << len(self.cardids)) - 1
+
+        self.shards = dict((p, Shard(p, self.players, len(self.cardids))) for p in self.players)
+        memory.execute("SELECT perspective, player, card, has, certainty FROM facts")
+        for perspective, player, card, has, certainty in memory.fetchall():
+            shard = self.shards[perspective]
+            pos = self.position[card]
+            if has == 1:
+                shard.has[player] |= 1 << pos
+            elif has == 0:
+                shard.hasnot[player] |= 1 << pos
+            shard.certainty[player][pos] = certainty
+        memory.execute("SELECT perspective, number, player, questioner, lead FROM clues")
+        for perspective, number, player, questioner, lead in memory.fetchall():
+            clue = self.shards[perspective].clues.setdefault(number, [player, questioner, {}])
+            clue[2][self.position[lead]] = lead
+
+        self.original = {} #(perspective, player, position) -> (has, certainty) before the first change
+        self.dropped_clues = []
+        return
+
+    def reset(self):
+        return
+
+    def note_fact(self, perspective, player, card, has, certainty):
+        return
+
+    def note_clue(self, number, questioner, interviewee, leads):
+        return
+
+    def get(self, shard, player, pos):
+        if shard.has[player] >> pos & 1:
+            has = 1
+        elif shard.hasnot[player] >> pos & 1:
+            has = 0
+        else:
+            has = None
+        return (has, shard.certainty[player][pos])
+
+    def set(self, shard, player, pos, has, certainty):
+        key = (shard.perspective, player, pos)
+        if key not in self.original:
+            self.original[key] = self.get(shard, player, pos)
+        bit = 1 << pos
+        if has:
+            shard.has[player] |= bit
+            shard.hasnot[player] &= ~bit
+        else:
+            shard.hasnot[player] |= bit
+            shard.has[player] &= ~bit
+        shard.certainty[player][pos] = certainty
 
+    def drop_clue(self, shard, number, pos):
+        player, questioner, leads = shard.clues[number]
+        self.dropped_clues.append((shard.perspective, number, player, leads.pop(pos)))
+
+    def deduce(self):
+        count = self.memory.count_rule
+        changes = 0
+        changes += count('romeo_and_julia', self.romeo_and_julia(), self.evaluated)
+        changes += count('highlander', self.highlander(), self.evaluated)
+        changes += count('whats_in_the_box', self.whats_in_the_box(), self.evaluated)
+        dropped = len(self.dropped_clues)
+        clues = self.refine_clues()
+        if self.memory.profiler:
+            self.memory.profiler.lap('refine_clues', len(self.dropped_clues) - dropped, self.evaluated)
+        changes += count('resolve_questioner', self.resolve_questioner(clues), len(clues))
+        changes += count('resolve_solver', self.resolve_solver(clues), len(clues))
         return changes
 
+    def scoped(self, scope):
+        #remembers how many rows, columns, types or clues the rule at hand evaluates
+        self.evaluated = len(scope)
+        return scope
+
+    #Which parts of the sheet each rule looks at - all of it here, subclasses may narrow it down
+
+    def scope_rows(self, rule):
+        return [(shard, player) for shard in self.shards.values() for player in self.players]
+
+    def scope_columns(self, rule):
+        return [(shard, pos) for shard in self.shards.values() for pos in range(len(self.cardids))]
+
+    def scope_types(self, rule):
+        return [(shard, cardtype) for shard in self.shards.values() for cardtype in self.typemasks]
+
+    def scope_clues(self, rule):
+        return [(shard, number) for shard in self.shards.values() for number in list(shard.clues)]
+
+    def romeo_and_julia(self):
+        changes = 0
+        allcards = len(self.cardids)
+        for shard, player in self.scoped(self.scope_rows('romeo_and_julia')):
+            unknown = self.allmask & ~(shard.has[player] | shard.hasnot[player])
+            if not unknown:
+                continue
+            limits = ((shard.has[player], self.number_of_cards[player], 0),
+                      (shard.hasnot[player], allcards - self.number_of_cards[player], 1))
+            plan = [(mask, target) for mask, limit, target in limits if mask and popcount(mask) == limit]
+            if len(plan) != 1:
+                continue
+            mask, target = plan[0]
+            #TOTAL() adds the group in index order, i.e. by ascending certainty
+            known = sorted(c for c in (shard.certainty[player][pos] for pos in positions(mask)) if c is not None)
+            certainty = sum(known, 0.0) / popcount(mask)
+            for pos in positions(unknown):
+                self.set(shard, player, pos, target, max(certainty, shard.certainty[player][pos] or 0.0))
+                changes += 1
+        return changes
+
+    def highlander(self):
+        changes = 0
+        for shard, pos in self.scoped(self.scope_columns('highlander')):
+            bit = 1 << pos
+            holders = [p for p in self.players if shard.has[p] & bit]
+            if not holders:
+                continue
+            for poorplayer in self.players:
+                if (shard.has[poorplayer] | shard.hasnot[poorplayer]) & bit:
+                    continue
+                poorcertainty = shard.certainty[poorplayer][pos] or 0.0
+                certainty = min(max(shard.certainty[p][pos] or 0.0, poorcertainty) for p in holders)
+                self.set(shard, poorplayer, pos, 0, certainty)
+                changes += 1
+        return changes
+
+    def whats_in_the_box(self):
+        changes = 0
+        plan = []
+        for shard, cardtype in self.scoped(self.scope_types('whats_in_the_box')):
+            typemask = self.typemasks[cardtype]
+            held = [(pos, shard.certainty[p][pos]) for pos in positions(typemask)
+                        for p in self.players if shard.has[p] >> pos & 1]
+            if len(held) != popcount(typemask) - 1:
+                continue
+            known = [c for pos, c in sorted(held, key=lambda h: (h[0], h[1] is not None, h[1])) if c is not None]
+            certainty = sum(known, 0.0) / len(known) if known else None
+            nobodyknows = typemask
+            for p in self.players:
+                nobodyknows &= ~shard.has[p]
+            plan += [(shard, pos, certainty) for pos in positions(nobodyknows)]
+        for shard, pos, certainty in plan:
+            for player in self.players:
+                if not (shard.has[player] | shard.hasnot[player]) >> pos & 1:
+                    self.set(shard, player, pos, 0, certainty)
+                    changes += 1
+        return changes
+
+    def refine_clues(self):
+        remaining = []
+        for shard, number in self.scoped(self.scope_clues('clues')):
+            player, questioner, leads = shard.clues[number]
+            for pos in [pos for pos in leads if shard.hasnot[player] >> pos & 1]:
+                self.drop_clue(shard, number, pos)
+            if leads:
+                remaining.append((shard, number))
+            else:
+                del shard.clues[number]
+        return remaining
+
+    def resolve_questioner(self, clues):
+        cells = set()
+        for shard, number in clues:
+            player, questioner, leads = shard.clues[number]
+            if len(leads) == 1:
+                cells.add((questioner, player, list(leads)[0]))
+        for questioner, player, pos in cells:
+            self.set(self.shards[questioner], player, pos, 1, 1.0)
+        return len(cells)
+
+    def resolve_solver(self, clues):
+        changes = 0
+        cells = set()
+        for shard, number in clues:
+            player, questioner, leads = shard.clues[number]
+            if len(leads) == 1:
+                pos = list(leads)[0]
+                cells.add((shard, player, pos))
+                self.drop_clue(shard, number, pos)
+                del shard.clues[number]
+        for shard, player, pos in cells:
+            if not (shard.has[player] | shard.hasnot[player]) >> pos & 1:
+                self.set(shard, player, pos, 1, 0.5)
+                changes += 1
+        return changes
+
+    def store(self):
+        updates = []
+        for (perspective, player, pos), before in self.original.items():
+            after = self.get(self.shards[perspective], player, pos)
+            if after != before:
+                updates.append(after + (perspective, player, self.cardids[pos]))
+        if not (updates or self.dropped_clues):
+            return
+        self.memory.execute("SAVEPOINT deductions")
+        self.memory.executemany("UPDATE facts SET has = ?, certainty = ? WHERE perspective = ? AND player = ? AND card = ?",
+                                updates)
+        self.memory.executemany("DELETE FROM clues WHERE perspective = ? AND number = ? AND player = ? AND lead = ?",
+                                self.dropped_clues)
+        self.memory.execute("RELEASE SAVEPOINT deductions")
+        self.original, self.dropped_clues = {}, []
+        return
+
+
+class IncrementalEngine(BitsetEngine):
+    """Keeps the bitmask sheet between runs and only re-fires rules on the cells and clues touched since.
+
+    Every rule remembers which cells changed since it last ran. A rule that left a region alone cannot produce
+    anything new there until one of its cells changes, so narrowing each rule down to the touched regions yields
+    the very same cycles and changes as evaluating the whole sheet."""
+    rules = ('romeo_and_julia', 'highlander', 'whats_in_the_box', 'clues')
+
+    def __init__(self, memory):
+        BitsetEngine.__init__(self, memory)
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            BitsetEngine.load(self)
+            self.pending = dict((rule, set((p, q, pos) for p in self.players for q in self.players
+                                            for pos in range(len(self.cardids)))) for rule in self.rules)
+            self.pending_clues = set(number for shard in self.shards.values() for number in shard.clues)
+            self.loaded = True
+        return
+
+    def reset(self):
+        self.loaded = False
+        return
+
+    def touch(self, perspective, player, pos):
+        for cells in self.pending.values():
+            cells.add((perspective, player, pos))
+        return
+
+    def set(self, shard, player, pos, has, certainty):
+        BitsetEngine.set(self, shard, player, pos, has, certainty)
+        self.touch(shard.perspective, player, pos)
+        return
+
+    def note_fact(self, perspective, player, card, has, certainty):
+        if not self.loaded:
+            return
+        shard, pos = self.shards[perspective.id], self.position[card.id]
+        bit = 1 << pos
+        shard.has[player.id] &= ~bit
+        shard.hasnot[player.id] &= ~bit
+        if has:
+            shard.has[player.id] |= bit
+        elif has is not None:
+            shard.hasnot[player.id] |= bit
+        shard.certainty[player.id][pos] = certainty if certainty is None else float(certainty)
+        self.touch(perspective.id, player.id, pos)
+        return
+
+    def note_clue(self, number, questioner, interviewee, leads):
+        if not self.loaded:
+            return
+        for shard in self.shards.values():
+            shard.clues[number] = [interviewee.id, questioner.id, dict((self.position[c.id], c.id) for c in leads)]
+        self.pending_clues.add(number)
+        return
+
+    def take(self, rule):
+        cells, self.pending[rule] = self.pending[rule], set()
+        return cells
+
+    def scope_rows(self, rule):
+        return [(self.shards[p], q) for p, q in set((p, q) for p, q, pos in self.take(rule))]
+
+    def scope_columns(self, rule):
+        return [(self.shards[p], pos) for p, pos in set((p, pos) for p, q, pos in self.take(rule))]
+
+    def scope_types(self, rule):
+        types = dict((pos, t) for t, mask in self.typemasks.items() for pos in positions(mask))
+        return [(self.shards[p], t) for p, t in set((p, types[pos]) for p, q, pos in self.take(rule))]
+
+    def scope_clues(self, rule):
+        cells = self.take(rule)
+        numbers, self.pending_clues = self.pending_clues, set()
+        scope = []
+        for shard in self.shards.values():
+            for number, (player, questioner, leads) in list(shard.clues.items()):
+                if number in numbers or any((shard.perspective, player, pos) in cells for pos in leads):
+                    scope.append((shard, number))
+        return scope
+
+
+engines = {'sql': SQLEngine, 'bitset': BitsetEngine, 'incremental': IncrementalEngine}
+
+
+class CountingBudgetExceeded(Exception):
+    pass
+
+
+class DealCounter(object):
+    """Counts the deals consistent with one perspective's facts, the hand sizes and the open clues, from which
+    the exact probability of every cell and of every envelope solution follows.
+
+    The cards are dealt one after the other to a player or the envelope. How many ways there are to complete a
+    partial deal only depends on the hand space left per player, the types the envelope already got and which
+    clues are still unsatisfied, so these sub-counts are memoized. Such a state is packed into one integer: a
+    field per player's hand space (with a guard bit to compare all of them at once), a bit per card type and a
+    bit per open clue. Every fact is taken as given, whatever its certainty."""
+    check_every = 4096 #memoized sub-counts between looks at the clock
+
+    def __init__(self, memory, perspective, budget=None, max_nodes=None):
+        self.players = sorted(memory.get_players(), key=lambda p: p.order)
+        self.cards = memory.get_cards()
+        self.budget = budget #seconds
+        self.max_nodes = max_nodes #memoized sub-counts, unlike the clock the same on every machine
+        memory.execute("SELECT player, card, has FROM facts WHERE perspective = ? AND has IS NOT NULL", (perspective.id,))
+        self.facts = dict(((player, card), has) for player, card, has in memory.fetchall())
+        memory.execute("SELECT number, player, lead FROM clues WHERE perspective = ?", (perspective.id,))
+        self.clues = sorted(memory.fetchall())
+        #everything the count depends on, equal keys give equal odds
+        self.key = (tuple(sorted(self.facts.items())), tuple(self.clues), tuple(p.number_of_cards for p in self.players))
+
+    def prepare(self):
+        """Orders the cards and lists the moves dealing each of them, False if no deal fits at all"""
+        players, envelope = self.players, len(self.players) #the envelope is the last holder
+        allowed = {}
+        for card in self.cards:
+            holders = [h for h, p in enumerate(players) if self.facts.get((p.id, card.id)) == 1]
+            if len(holders) > 1:
+                return False
+            allowed[card.id] = holders or [h for h, p in enumerate(players) if self.facts.get((p.id, card.id)) != 0] + [envelope]
+        types = sorted(set(c.type for c in self.cards))
+        if sum(p.number_of_cards for p in players) + len(types) != len(self.cards):
+            return False
+
+        #A clue asks for one of its leads in the player's hand, it is void once the last lead is dealt elsewhere
+        holder = dict((p.id, h) for h, p in enumerate(players))
+        grouped = {}
+        for number, player, lead in self.clues:
+            grouped.setdefault((number, player), set()).add(lead)
+        open_clues = set()
+        for (number, player), leads in grouped.items():
+            if any(self.facts.get((player, lead)) == 1 for lead in leads):
+                continue
+            leads = frozenset(lead for lead in leads if holder[player] in allowed[lead])
+            if not leads:
+                return False
+            open_clues.add((holder[player], leads))
+        #a clue with more leads than another one of the same player adds nothing
+        open_clues = sorted(((player, leads) for player, leads in open_clues
+                             if not any(p == player and l < leads for p, l in open_clues)),
+                            key=lambda clue: (clue[0], sorted(clue[1])))
+
+        #Every partially dealt clue multiplies the states, so the leads of a clue are dealt close together. So do
+        #the envelope's cards remembered for the solutions, so otherwise types with few candidates go first.
+        candidates = dict((t, sum(1 for c in self.cards if c.type == t and envelope in allowed[c.id])) for t in types)
+        self.order, dealt = [], set()
+        remaining = sorted(self.cards, key=lambda c: c.name)
+        while remaining:
+            def cost(card):
+                now = dealt | set([card.id])
+                return (sum(1 for player, leads in open_clues if leads & now and not leads <= now),
+                        candidates[card.type], card.type, len(allowed[card.id]))
+            card = min(remaining, key=cost)
+            self.order.append(card)
+            remaining.remove(card)
+            dealt.add(card.id)
+        n = len(self.order)
+        position = dict((c.id, i) for i, c in enumerate(self.order))
+
+        #State layout: the hand space fields, the type bits, the open clue bits
+        width = n.bit_length() + 1
+        self.guards = sum(1 << (width*h + width-1) for h in range(envelope))
+        self.spacemask = (1 << width*envelope) - 1
+        typebit = dict((t, 1 << (width*envelope + k)) for k, t in enumerate(types))
+        self.start = sum(p.number_of_cards << width*h for h, p in enumerate(players))
+        satisfies = [[0] * envelope for i in range(n)]
+        self.deadline = [0] * n
+        for bit, (player, leads) in enumerate(open_clues):
+            bit = 1 << (width*envelope + len(types) + bit)
+            for lead in leads:
+                satisfies[position[lead]][player] |= bit
+            self.deadline[max(position[lead] for lead in leads)] |= bit
+            self.start |= bit
+        #each type needs its envelope card by its last candidate
+        self.typedeadline = [0] * n
+        for t in types:
+            candidates = [i for i, c in enumerate(self.order) if c.type == t and envelope in allowed[c.id]]
+            if not candidates:
+                return False
+            self.typedeadline[candidates[-1]] |= typebit[t]
+
+        #The hand space left must fit into the cards left that a player may take, checked for all fields at once
+        self.room = [self.guards] * (n+1)
+        for i in range(n-1, -1, -1):
+            self.room[i] = self.room[i+1] + sum(1 << width*h for h in allowed[self.order[i].id] if h != envelope)
+        #Per possible holder of each card: the holder, its hand space unit, the bits to check and the clue bits cleared
+        fieldmask = (1 << (width-1)) - 1
+        self.moves = [[(h, 0, typebit[card.type], 0) if h == envelope else (h, 1 << width*h, fieldmask << width*h, satisfies[i][h])
+                       for h in allowed[card.id]] for i, card in enumerate(self.order)]
+        self.final = sum(typebit.values())
+        return True
+
+    def successors(self, i, state):
+        room, deadline, typedeadline = self.room[i+1], self.deadline[i], self.typedeadline[i]
+        for h, one, field, satisfied in self.moves[i]:
+            if not one: #the envelope, field is the card's type
+                if state & field:
+                    continue
+                after = state | field
+            elif state & field:
+                after = (state - one) & ~satisfied
+            else:
+                continue
+            if after & deadline or after & typedeadline != typedeadline \
+                    or (room - (after & self.spacemask)) & self.guards != self.guards:
+                continue
+            yield h, after
+
+    def completions(self, i, state):
+        #number of ways to deal the cards from i on
+        memo = self.memo[i]
+        if state not in memo:
+            self.nodes += 1
+            if not self.nodes % self.check_every and (self.max_nodes and self.nodes > self.max_nodes
+                                                       or self.budget and time.perf_counter() > self.deadline_time):
+                raise CountingBudgetExceeded("no count within the budget")
+            memo[state] = sum(self.completions(i+1, after) for h, after in self.successors(i, state))
+        return memo[state]
+
+    def total(self):
+        """Number of deals, raises CountingBudgetExceeded when it takes longer than the budget"""
+        self.deadline_time = time.perf_counter() + (self.budget or 0)
+        self.nodes = 0
+        if not self.prepare():
+            return 0
+        self.memo = [{} for i in range(len(self.order))] + [{self.final: 1}]
+        return self.completions(0, self.start)
+
+    def count(self, solutions=False):
+        """Number of deals and the probabilities of cells and envelope cards, also of the solutions if asked for
+        (which takes longer), raises CountingBudgetExceeded when it takes longer than the budget"""
+        result = {'deals': 0, 'cells': {}, 'envelope': {}, 'solutions': [] if solutions else None}
+        total = self.total()
+        if not total:
+            return result
+        n, envelope = len(self.order), len(self.players)
+
+        #Forward through the deal: the ways to reach each partial deal times the ways to complete it after each
+        #move. For the solutions partial deals remember the envelope's cards until it is full.
+        weights = [[0] * (envelope+1) for i in range(n)]
+        joint = {}
+        level = {(self.start, ()): 1}
+        for i in range(n):
+            reached = {}
+            for (state, picked), ways in level.items():
+                for h, after in self.successors(i, state):
+                    rest = self.completions(i+1, after)
+                    if not rest:
+                        continue
+                    weights[i][h] += ways * rest
+                    key = (after, picked + (i,) if solutions and h == envelope else picked)
+                    if solutions and h == envelope and after & self.final == self.final:
+                        joint[key[1]] = joint.get(key[1], 0) + ways * rest
+                        key = (after, ())
+                    reached[key] = reached.get(key, 0) + ways
+            level = reached
+            if self.budget and time.perf_counter() > self.deadline_time:
+                raise CountingBudgetExceeded("no count within %.3f seconds" % self.budget)
+
+        result['deals'] = total
+        for i, card in enumerate(self.order):
+            for h, player in enumerate(self.players):
+                result['cells'][(player.id, card.id)] = weights[i][h] / total
+            result['envelope'][card.id] = weights[i][envelope] / total
+        if solutions:
+            types = ('suspect', 'weapon', 'room')
+            result['solutions'] = sorted(((ways / total, sorted((self.order[i] for i in picks), key=lambda c: types.index(c.type)))
+                                          for picks, ways in joint.items()), key=lambda s: (-s[0], [c.name for c in s[1]]))
+        return result
+
+    def sample(self, rnd, number):
+        """Draws number deals, each one equally likely, as the index of the holder of every card in self.order (the
+        envelope's index is the number of players), no deals if none fits"""
+        if not self.total():
+            return []
+        choices = [{} for i in self.order] #per partial deal: running totals of the completions after each move
+        deals = []
+        for k in range(number):
+            state, deal = self.start, []
+            for i in range(len(self.order)):
+                if state not in choices[i]:
+                    moves = [(h, after) for h, after in self.successors(i, state) if self.memo[i+1][after]]
+                    choices[i][state] = (list(itertools.accumulate(self.memo[i+1][after] for h, after in moves)), moves)
+                running, moves = choices[i][state]
+                h, state = moves[bisect.bisect_right(running, rnd.randrange(running[-1]))]
+                deal.append(h)
+            deals.append(deal)
+        return deals
+
+
+class DealSampler(object):
+    """Estimates the odds of a DealCounter from deals drawn at random, for when there are too many to count.
+
+    Every task of a process pool walks through the deals on its own (a Markov chain): starting from a deal that
+    fits, it repeatedly proposes to swap the holders of two random cards and rejects the swap if it breaks a fact,
+    the envelope's types or an open clue. As every swap is as likely proposed as its reverse, after a while each
+    fitting deal is equally likely visited, and every few swaps one is recorded. The tasks are seeded from the
+    given seed and their number, so that the same game gives the same estimates. Their means scatter around the
+    true odds, which gives the confidence intervals."""
+    batch = 200 #deals recorded per task
+    burn_in = 100 #swaps per card before recording
+    thinning = 2 #swaps per card between recorded deals
+    min_batches = 10 #before trusting the confidence intervals
+    max_batches = 5000 #even without precision or budget
+    z = 1.96 #95% confidence
+    pools = {} #processes -> pool drawing for every sampler, started on first use and closed on exit
+
+    def __init__(self, counter, seed, precision=0.02, budget=None, jobs=None):
+        self.counter = counter
+        self.seed = seed
+        self.precision = precision #half width of the confidence interval of every probability
+        self.budget = budget #seconds
+        self.jobs = jobs or os.cpu_count() or 1
+
+    def first_deal(self, rnd):
+        """A random deal that fits (not every one equally likely), searched depth first through the counter's moves
+        in random order, remembering the partial deals without a way on; None if there is none"""
+        counter, failed = self.counter, set()
+
+        def deal_from(i, state):
+            if i == len(counter.order):
+                return []
+            moves = list(counter.successors(i, state))
+            rnd.shuffle(moves)
+            for h, after in moves:
+                if (i+1, after) not in failed:
+                    rest = deal_from(i+1, after)
+                    if rest is not None:
+                        return [h] + rest
+                    failed.add((i+1, after))
+            return None
+        return deal_from(0, counter.start)
+
+    def draw(self, task):
+        """How often each card was recorded at each holder and each solution came up in one task's deals, None
+        if no fitting deal was found"""
+        counter, rnd = self.counter, random.Random("%s/%i" % (self.seed, task))
+        n, envelope = len(counter.order), len(counter.players)
+        deal = self.first_deal(rnd)
+        if deal is None:
+            return None
+        allowed = [set(h for h, one, field, satisfied in counter.moves[i]) for i in range(n)]
+        free = [i for i in range(n) if len(allowed[i]) > 1] or [0] #the only cards to swap, a lone one never moves
+        types = [card.type for card in counter.order]
+        #the open clues satisfied by each card at each holder, and by how many cards each clue is now
+        satisfies = [dict((h, tuple(positions(satisfied))) for h, one, field, satisfied in counter.moves[i]) for i in range(n)]
+        satisfied = {}
+        for i, h in enumerate(deal):
+            for clue in satisfies[i][h]:
+                satisfied[clue] = satisfied.get(clue, 0) + 1
+
+        tally = {'cells': [[0] * (envelope+1) for i in range(n)], 'solutions': {}}
+        for step in range(n * (self.burn_in + self.batch * self.thinning)):
+            a, b = free[rnd.randrange(len(free))], free[rnd.randrange(len(free))]
+            x, y = deal[a], deal[b]
+            if x != y and y in allowed[a] and x in allowed[b] and (types[a] == types[b] or envelope not in (x, y)):
+                for clue in satisfies[a][y] + satisfies[b][x]:
+                    satisfied[clue] = satisfied.get(clue, 0) + 1
+                for clue in satisfies[a][x] + satisfies[b][y]:
+                    satisfied[clue] -= 1
+                if all(satisfied[clue] for clue in satisfies[a][x] + satisfies[b][y]):
+                    deal[a], deal[b] = y, x
+                else: #rejected, undone
+                    for clue in satisfies[a][x] + satisfies[b][y]:
+                        satisfied[clue] += 1
+                    for clue in satisfies[a][y] + satisfies[b][x]:
+                        satisfied[clue] -= 1
+            if step >= n * self.burn_in and not (step - n * self.burn_in + 1) % (n * self.thinning):
+                for i, h in enumerate(deal):
+                    tally['cells'][i][h] += 1
+                picks = tuple(i for i, h in enumerate(deal) if h == envelope)
+                tally['solutions'][picks] = tally['solutions'].get(picks, 0) + 1
+        return tally
+
+    def tallies(self):
+        #the tasks' tallies in the order of their seeds, however many processes draw them
+        if self.jobs == 1 or multiprocessing.current_process().daemon: #no pool within a pool
+            for task in itertools.count():
+                yield self.draw(task)
+        else:
+            pool = self.pool(self.jobs)
+            pending = [pool.apply_async(self.draw, (task,)) for task in range(self.jobs)]
+            for task in itertools.count(self.jobs):
+                yield pending.pop(0).get()
+                pending.append(pool.apply_async(self.draw, (task,)))
+
+    @classmethod
+    def pool(cls, jobs):
+        if jobs not in cls.pools:
+            if not cls.pools:
+                atexit.register(cls.close)
+            cls.pools[jobs] = multiprocessing.Pool(jobs)
+        return cls.pools[jobs]
+
+    @classmethod
+    def close(cls):
+        #the tasks still drawing for an estimate which was done before are not waited for
+        pools, cls.pools = cls.pools, {}
+        for pool in pools.values():
+            pool.terminate()
+            pool.join()
+
+    def estimate(self, solutions=False):
+        """Probabilities like DealCounter.count, with the half width of the confidence interval of each in 'margins'
+        (None if certain), the deals recorded, the precision reached after each task in 'history' and whether the
+        precision asked for was reached before the budget ran out; 'deals' is None as they are not counted. None if
+        not even one fitting deal was found."""
+        start = time.perf_counter()
+        result = {'deals': 0, 'cells': {}, 'envelope': {}, 'solutions': [] if solutions else None,
+                  'margins': {'cells': {}, 'envelope': {}}, 'drawn': 0, 'precision': None, 'converged': False,
+                  'history': []}
+        counter = self.counter
+        if not counter.prepare():
+            result['converged'] = True
+            return result
+        counter.memo = [] #sub-counts of an earlier attempt to count are not needed for drawing
+        n, envelope = len(counter.order), len(counter.players)
+
+        #Per cell the sum of the tasks' means and of their squares
+        means = [[0.0] * (envelope+1) for i in range(n)]
+        squares = [[0.0] * (envelope+1) for i in range(n)]
+        joint, batches = {}, 0
+        for tally in self.tallies():
+            if tally is None: #too hard to find a deal that fits
+                return None
+            batches += 1
+            for i in range(n):
+                for h in range(envelope+1):
+                    mean = float(tally['cells'][i][h]) / self.batch
+                    means[i][h] += mean
+                    squares[i][h] += mean * mean
+            for picks, times in tally['solutions'].items():
+                joint[picks] = joint.get(picks, 0) + times
+            precision = max(self.margin(means[i][h], squares[i][h], batches) for i in range(n) for h in range(envelope+1))
+            result['history'].append((batches * self.batch, precision))
+            if batches >= self.min_batches and precision <= self.precision:
+                result['converged'] = True
+                break
+            if batches >= self.max_batches or self.budget and time.perf_counter() - start > self.budget:
+                break
+
+        result.update(deals=None, drawn=batches * self.batch, precision=precision)
+        for i, card in enumerate(counter.order):
+            allowed = [h for h, one, field, satisfied in counter.moves[i]]
+            for h in range(envelope+1):
+                p, margin = means[i][h] / batches, self.margin(means[i][h], squares[i][h], batches)
+                if h not in allowed or len(allowed) == 1: #known without drawing
+                    margin = None
+                if h == envelope:
+                    result['envelope'][card.id], result['margins']['envelope'][card.id] = p, margin
+                else:
+                    cell = (counter.players[h].id, card.id)
+                    result['cells'][cell], result['margins']['cells'][cell] = p, margin
+        if solutions:
+            types = ('suspect', 'weapon', 'room')
+            result['solutions'] = sorted(((float(times) / result['drawn'], sorted((counter.order[i] for i in picks), key=lambda c: types.index(c.type)))
+                                          for picks, times in joint.items()), key=lambda s: (-s[0], [c.name for c in s[1]]))
+        return result
+
+    def margin(self, means, squares, batches):
+        #half width of the confidence interval from the scatter of the tasks' means
+        if batches < 2:
+            return 1.0
+        variance = max(squares - means * means / batches, 0.0) / (batches - 1)
+        return self.z * math.sqrt(variance / batches)
+
+
+class Profiler(object):
+    """Per deduction rule: wall time, facts (or clue rows) changed, how often it ran and how many rows, columns,
+    types or clues it evaluated. Every lap is attributed the time since the previous one. The figures are summed
+    up over the whole game and over each turn, a turn's deductions being those from its suggestion up to the next
+    suggestion."""
+    abbreviations = {'romeo_and_julia': 'RAJ', 'highlander': 'H', 'whats_in_the_box': 'WITB', 'refine_clues': 'RC',
+                     'resolve_questioner': 'RQ', 'resolve_solver': 'RS', 'drop_clues': 'DC'}
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.totals = {} #rule -> [runs, evaluated, seconds, rows changed]
+        self.turns = {} #turn -> [deductions, cycles, {rule -> [runs, evaluated, seconds, rows changed]}]
+        self.current = {}
+        self.runs = 0
+        self.cycles = 0
+        self.last_turn = None #with deductions profiled
+        self.clock = None
+
+    def begin(self):
+        self.current = {}
+        self.clock = time.perf_counter()
+
+    def lap(self, rule, rows=0, evaluated=1):
+        now = time.perf_counter()
+        entry = self.current.setdefault(rule, [0, 0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += evaluated
+        entry[2] += now - self.clock
+        entry[3] += rows
+        self.clock = now
+
+    def end(self, turn, cycles):
+        self.runs += 1
+        self.cycles += cycles
+        record = self.turns.setdefault(turn, [0, 0, {}])
+        record[0] += 1
+        record[1] += cycles
+        self.last_turn = turn
+        for rule, entry in self.current.items():
+            for totals in (self.totals, record[2]):
+                total = totals.setdefault(rule, [0, 0, 0.0, 0])
+                for i, value in enumerate(entry):
+                    total[i] += value
+        if self.filename:
+            with open(self.filename, "a") as profile:
+                profile.write(json.dumps({'turn': turn, 'cycles': cycles, 'rules': dict(
+                    (rule, {'runs': runs, 'evaluated': evaluated, 'seconds': round(seconds, 6), 'rows': rows})
+                    for rule, (runs, evaluated, seconds, rows) in self.current.items())}) + "\n")
+
+    def report(self, turn=None):
+        """The figures of the whole game, or of the given turn only"""
+        if turn is None:
+            runs, cycles, totals = self.runs, self.cycles, self.totals
+            lines = ["Profile of %i deduction(s), %i cycles:" % (runs, cycles)]
+        else:
+            runs, cycles, totals = self.turns.get(turn, [0, 0, {}])
+            lines = ["Profile of turn %i, %i deduction(s), %i cycles:" % (turn, runs, cycles)]
+        lines.append("rule  eval/cycle    ms  ms/run  rows")
+        cycles = max(cycles, 1)
+        for rule, (runs, evaluated, seconds, rows) in totals.items():
+            lines.append("%-5s %10.1f %5.0f %7.2f %5i" % (self.abbreviations.get(rule, rule[:5]), 1.0 * evaluated / cycles,
+                         seconds * 1000, seconds * 1000 / max(runs, 1), rows))
+        return "\n".join(lines)
+
+
+class Screen(object):
+    """Model of the terminal: text is drawn into a back buffer of cells and flush() only sends the runs of
+    cells which differ from what is on the terminal already (the front buffer) in one single write."""
+    csi = "\033["
+    blank = (' ', '')
+    merge_gap = 4 #unchanged cells between two changes are cheaper to repeat than to jump over
+
+    def __init__(self):
+        self.back = {} #(row, col) -> (character, graphics rendition)
+        self.front = {}
+        self.touched = set()
+        self.attr = ''
+        self.cursor = (1, 1)
+        self.shown_cursor = (None, None)
+        self.bytes_written = 0
+        self.writes = 0
+
+    def put(self, row, col, text):
+        for part in re.split("(\033\\[[0-9;]*m)", text):
+            if part.startswith("\033["):
+                params = part[2:-1]
+                self.attr = '' if params in ('', '0') else params
+                continue
+            for ch in part:
+                self.back[(row, col)] = (ch, self.attr)
+                self.touched.add((row, col))
+                col += 1
+        self.cursor = (row, col)
+
+    def clear(self):
+        self.back, self.front, self.touched = {}, {}, set()
+        self.attr = ''
+        self.shown_cursor = (None, None) #unknown, so the next frame positions it
+
+    def render(self):
+        changed = sorted(pos for pos in self.touched if self.back[pos] != self.front.get(pos, self.blank))
+        self.touched = set()
+        out = []
+        attr = ''
+        here = self.shown_cursor
+        for row, col in changed:
+            if here[0] == row and 0 <= col - here[1] <= self.merge_gap:
+                cells = [(row, c) for c in range(here[1], col+1)] #repeat the gap instead of jumping over it
+            else:
+                out.append(self.csi + "%i;%iH" % (row, col))
+                cells = [(row, col)]
+            for cell in cells:
+                ch, cellattr = self.back.get(cell, self.blank)
+                if cellattr != attr:
+                    out.append(self.csi + ("0;" + cellattr if cellattr else "0") + "m")
+                    attr = cellattr
+                out.append(ch)
+                self.front[cell] = (ch, cellattr)
+            here = (row, col+1)
+        if attr:
+            out.append(self.csi + "0m")
+        if here != self.cursor:
+            out.append(self.csi + "%i;%iH" % self.cursor)
+        self.shown_cursor = self.cursor
+        return ''.join(out)
+
+    def flush(self):
+        data = self.render()
+        if data:
+            sys.stdout.write(data)
+            self.bytes_written += len(data.encode())
+            self.writes += 1
+        sys.stdout.flush()
+
+
+class Journal(object):
+    """Append-only autosave: the replay file is written once and afterwards only extended by the keys recorded
+    since the last append. A crash can therefore only damage its tail, which load_recording ignores."""
+
+    def __init__(self, filename, header, keys, fsync=False):
+        self.filename = filename
+        self.fsync = fsync
+        #the first version appears complete or not at all
+        partial = filename + ".part"
+        with open(partial, "w", newline='') as save:
+            save.write(header + '\0' + keys)
+            save.flush()
+            os.fsync(save.fileno())
+        os.replace(partial, filename)
+        self.journal = open(filename, "a", newline='')
+        self.written = len(keys)
+
+    def append(self, keys):
+        if keys:
+            self.journal.write(keys)
+            self.written += len(keys)
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    def __del__(self):
+        self.journal.close()
+
+
+class EventLog(object):
+    """Structured record of a game, one JSON object per line: the setup, every turn with its answers, every other
+    action changing the game and, at the start of every few turns, a checkpoint of the whole database"""
+    checkpoint_interval = 10
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.log = open(filename, "w")
+        self.turns = 0
+        self.checkpointed = 0 #turn of the last checkpoint written
+
+    def write(self, event, **details):
+        self.log.write(json.dumps(dict(event=event, **details)) + "\n")
+        self.log.flush()
+        if event == 'checkpoint':
+            self.checkpointed = details['turn']
+
+    def turn_starts(self, memory):
+        upcoming = self.turns + 1
+        if upcoming > 1 and (upcoming - 1) % self.checkpoint_interval == 0 and upcoming != self.checkpointed:
+            self.write('checkpoint', turn=upcoming, **memory.state())
+
+    def __del__(self):
+        self.log.close()
+
+    @staticmethod
+    def is_event_log(filename):
+        with open(filename, "rb") as log:
+            return log.read(1) == b'{'
+
+    @staticmethod
+    def replay(filename, until_turn=None, logger=None, **settings):
+        """Builds the game recorded in the event log without any prompts, up to the start of turn until_turn if
+        given, on a Memory with the given logger and settings. Replays start from the last checkpoint before that
+        turn."""
+        with open(filename, "r") as log:
+            lines = log.readlines()
+        if not lines:
+            raise ValueError("Empty event log")
+
+        setup = json.loads(lines[0])
+        memory = Memory(logger=logger, **settings)
+        if memory.undo_depth: #keep as many turns as the game undid at once
+            memory.undo_depth = max([memory.undo_depth] + [json.loads(line).get('turns', 1) for line in lines
+                                                           if line.startswith('{"event": "undo"')])
+        memory.setup(setup['cards'], setup['players'], setup['user_cards'], setup['first'])
+        random.seed(memory.randseed, version=2)
+        memory.log_event('setup', **dict((k, v) for k, v in setup.items() if k != 'event'))
+
+        #skip ahead to the last checkpoint not after the wanted turn, the checkpoint is taken right before its turn,
+        #unless the turns replayed from there undo more turns than they played
+        start, turns = 1, 0
+        if until_turn:
+            depth = {} #checkpoint line -> turns played since, None once an undo went back further
+            for number, line in enumerate(lines):
+                if line.startswith('{"event": "checkpoint"'):
+                    if json.loads(line)['turn'] > until_turn:
+                        break
+                    depth[number] = 0
+                elif line.startswith(('{"event": "turn"', '{"event": "undo"')):
+                    event = json.loads(line)
+                    if event['event'] == 'turn' and event['turn'] >= until_turn:
+                        break
+                    for candidate, played in depth.items():
+                        if played is not None:
+                            played += 1 if event['event'] == 'turn' else -event.get('turns', 1)
+                            depth[candidate] = played if played >= 0 else None
+            start = max([number for number, played in depth.items() if played is not None] + [start])
+
+        for line in lines[start:]:
+            event = json.loads(line)
+            kind = event['event']
+            if kind == 'checkpoint':
+                if event['turn'] > turns + 1: #the turns before are skipped or missing from this log
+                    memory.restore_state(event)
+                    turns = event['turn'] - 1
+                    if memory.events:
+                        memory.events.turns = turns
+                        memory.log_event('checkpoint', **dict((k, v) for k, v in event.items() if k != 'event'))
+                continue
+            if kind == 'turn':
+                if until_turn and turns + 1 >= until_turn:
+                    break
+                turns += 1
+            memory.run_deductions() #as at the start of every action in the game loop
+            if kind == 'turn':
+                questioner = memory.get_player(playername=event['player'])
+                leads = [memory.get_card(cardname=name) for name in event['leads']]
+                memory.begin_turn()
+                for answer in event['answers']:
+                    interviewee = memory.get_player(playername=answer['player'])
+                    if answer['shows']:
+                        shown = memory.get_card(cardname=answer['card']) if answer['card'] else None
+                        memory.record_show(questioner, interviewee, leads, shown)
+                    else:
+                        memory.record_pass(interviewee, leads)
+                        memory.run_deductions()
+                memory.end_turn(questioner, leads)
+            elif kind == 'skip':
+                memory.skip_turn()
+            elif kind == 'undo':
+                memory.undo_turns(event.get('turns', 1))
+            elif kind == 'commit':
+                memory.commit_undo()
+            elif kind == 'fact':
+                memory.override_fact(memory.get_player(playername=event['player']), memory.get_card(cardname=event['card']),
+                                     event['has'], event['certainty'],
+                                     [memory.get_player(playername=name) for name in event['perspectives']])
+        memory.run_deductions()
+        return memory, turns
+
+
+class PushServer(object):
+    """Serves the sheets of the game on localhost and pushes their changes to external apps as they happen, so
+    they neither poll nor lock the database.
+
+    Whenever the game is published, the facts and clues changed since (see Memory.changes_since) are copied over
+    and compared with the last copy. The differences are numbered and kept for a while: GET /sheet?perspective=NAME returns a sheet along with the
+    version it reflects and GET /events?since=VERSION streams every later change as a server-sent event. A reader
+    that falls too far behind, or a new game, gets a reset event and fetches the sheet again."""
+    backlog = 1000 #changes kept for readers catching up
+    keepalive = 15 #seconds between comments on an idle stream, to notice readers gone
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.version = 0
+        self.game = None #players and cards, a different game resets the readers
+        self.facts, self.clues = {}, set()
+        self.whose_turn, self.turns = None, 0
+        self.source, self.seen = None, 0 #the memory copied from and the version of its changes copied last
+        self.changes = collections.deque(maxlen=self.backlog) #(version, event, data) with data as JSON
+        self.changed = threading.Condition()
+        self.server = http.server.ThreadingHTTPServer((host, port), PushHandler)
+        self.server.daemon_threads = True
+        self.server.push = self
+        self.address = "http://%s:%i" % self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def update(self, memory):
+        """Brings the copy of the game up to date and hands the changes to the readers. The change log of the memory
+        tells which facts and clues to copy, unless it was reset.
+
+        Called by the game thread, and by the deducer thread publishing what deductions in the background found
+        (Memory.run_deductions). Never by both at once: the game thread publishes only once it waited for them
+        in Memory.finish_deductions, so the copy needs no lock of its own."""
+        names = dict((p.id, p.name) for p in memory.get_players())
+        cards = dict((c.id, c) for c in memory.get_cards())
+        game = {'players': [p.name for p in sorted(memory.get_players(), key=lambda p: p.order)],
+                'user': memory.user.name,
+                'cards': [(c.name, c.type) for c in sorted(cards.values(), key=lambda c: (('suspect', 'weapon', 'room').index(c.type), c.name))]}
+        whose_turn = memory.whose_turn.name if memory.whose_turn else None
+
+        seen, changes = memory.changes_since(self.seen if memory is self.source else 0)
+        if memory is not self.source or changes is None:
+            memory.execute("SELECT perspective, player, card, has, certainty FROM facts")
+            facts = dict(((names[perspective], names[player], cards[card].name), (None if has is None else bool(has), certainty))
+                         for perspective, player, card, has, certainty in memory.fetchall())
+            memory.execute("SELECT perspective, number, player, questioner, lead FROM clues")
+            clues = set((names[perspective], number, names[player], names[questioner], cards[lead].name)
+                        for perspective, number, player, questioner, lead in memory.fetchall())
+            touched = set(facts) | set(self.facts)
+        else:
+            facts, clues, touched = dict(self.facts), set(self.clues), set()
+            for version, kind, perspective, player, card, number, questioner, old_has, has, old_certainty, certainty in changes:
+                if kind == 'fact':
+                    key = (names[perspective], names[player], cards[card].name)
+                    facts[key] = (None if has is None else bool(has), certainty)
+                    touched.add(key)
+                else:
+                    clue = (names[perspective], number, names[player], names[questioner], cards[card].name)
+                    if kind == 'clue_added':
+                        clues.add(clue)
+                    else:
+                        clues.discard(clue)
+        self.source, self.seen = memory, seen
+
+        if game != self.game:
+            event, data = 'reset', {}
+        else:
+            clue_keys = ('perspective', 'number', 'player', 'questioner', 'lead')
+            data = {'facts': [{'perspective': perspective, 'player': player, 'card': card, 'has': has, 'certainty': certainty}
+                              for (perspective, player, card), (has, certainty) in sorted((key, facts[key]) for key in touched)
+                              if self.facts.get((perspective, player, card)) != (has, certainty)],
+                    'clues_added': [dict(zip(clue_keys, clue)) for clue in sorted(clues - self.clues)],
+                    'clues_dropped': [dict(zip(clue_keys, clue)) for clue in sorted(self.clues - clues)]}
+            if not any(data.values()) and whose_turn == self.whose_turn and memory.turns == self.turns:
+                return
+            event = 'changes'
+        data.update(turn=memory.turns, whose_turn=whose_turn)
+        with self.changed:
+            self.version += 1
+            data['version'] = self.version
+            self.changes.append((self.version, event, json.dumps(data)))
+            self.game, self.facts, self.clues = game, facts, clues
+            self.whose_turn, self.turns = whose_turn, memory.turns
+            self.changed.notify_all()
+
+    def sheet(self, perspective=None):
+        """One perspective's facts and open clues (the user's by default) as of the version given with them, None
+        for an unknown perspective or before the cards are dealt"""
+        with self.changed:
+            game, facts, clues, version = self.game, self.facts, self.clues, self.version
+            whose_turn, turns = self.whose_turn, self.turns
+        if not game:
+            return None
+        perspective = perspective or game['user']
+        if perspective not in game['players']:
+            return None
+        grouped = {}
+        for clue_perspective, number, player, questioner, lead in sorted(clues):
+            if clue_perspective == perspective:
+                grouped.setdefault(number, {'number': number, 'player': player, 'questioner': questioner, 'leads': []})
+                grouped[number]['leads'].append(lead)
+        return {'version': version, 'turn': turns, 'whose_turn': whose_turn, 'perspective': perspective,
+                'players': game['players'],
+                'cards': [{'card': card, 'type': cardtype,
+                           'facts': dict((player, dict(zip(('has', 'certainty'), facts[(perspective, player, card)])))
+                                         for player in game['players'])}
+                          for card, cardtype in game['cards']],
+                'clues': [grouped[number] for number in sorted(grouped)]}
+
+    def changes_since(self, since):
+        """The changes after version since, or a reset if some of them are no longer kept; call holding changed"""
+        if since == self.version:
+            return []
+        if since > self.version or self.changes[0][0] > since + 1:
+            return [(self.version, 'reset', json.dumps({'version': self.version}))]
+        return [change for change in self.changes if change[0] > since]
+
+
+class PushHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the readers of a PushServer, each one in a thread of its own"""
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        push = self.server.push
+        if url.path == '/sheet':
+            sheet = push.sheet(query.get('perspective'))
+            if sheet is None:
+                self.send_error(404, "No such perspective or no game yet")
+                return
+            body = json.dumps(sheet).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == '/events':
+            try:
+                since = int(query.get('since', self.headers.get('Last-Event-ID', -1)))
+            except ValueError:
+                self.send_error(400, "The version to stream from must be a number")
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            with push.changed:
+                if since < 0: #only what comes next
+                    since = push.version
+            try:
+                while True:
+                    with push.changed:
+                        changes = push.changes_since(since)
+                        if not changes:
+                            push.changed.wait(push.keepalive)
+                            changes = push.changes_since(since)
+                    if changes:
+                        for version, event, data in changes:
+                            self.wfile.write(("id: %i\nevent: %s\ndata: %s\n\n" % (version, event, data)).encode())
+                        since = changes[-1][0]
+                    else:
+                        self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+        else:
+            self.send_error(404, "Try /sheet?perspective=NAME or /events?since=VERSION")
+
+    def log_message(self, format, *args):
+        return #the terminal belongs to the game
+
+
+class SessionMemory(Memory):
+    """Memory of a hosted game: whatever the command line set up for the game on the terminal, a hosted game
+    records no events, publishes no snapshots and serves nothing, and keeps less history"""
+    events_file = None
+    snapshot_file = None
+    push = None
+    profiling = False
+    undo_depth = 5
+    change_retention = 500
+
+
+class Session(object):
+    """One of the games hosted by Sessions, on a database of its own. Its memory is bounded: a few turns to undo,
+    the last changes, the last log entries and, on a database file, the pages cached. Turns are told by names as
+    in event logs and recorded at once, the deductions run before the next call. Settings of Memory, such as the
+    engine, can be given per game."""
+    log_capacity = 200 #log entries kept
+    cache_kib = 512 #page cache of a database file
+
+    def __init__(self, name, dbname=None, **settings):
+        self.name = name
+        self.log = LogStore(lambda text: text.split('\n'), self.log_capacity)
+        self.memory = SessionMemory(dbname or DB.in_memory, logger=self.log.append, **settings)
+        if dbname:
+            self.memory.execute("PRAGMA cache_size = -%i" % self.cache_kib)
+        self.pending = collections.deque() #(future, method, args) submitted, the first one running
+        self.lock = threading.Lock()
+
+    def setup(self, cards, players, user_cards, first):
+        self.memory.setup(cards, players, user_cards, first)
+        self.memory.run_deductions()
+        return self.sheet()
+
+    def play_turn(self, player, leads, answers):
+        """The player suggests the leads and is answered: {'player': NAME, 'shows': BOOL, 'card': NAME or None}
+        in order of the players asked. Returns the (perspective, player, card) names of the facts set."""
+        memory = self.memory
+        questioner = memory.get_player(playername=player)
+        leads = [memory.get_card(cardname=name) for name in leads]
+        answers = [(memory.get_player(playername=answer['player']), answer['shows'],
+                    memory.get_card(cardname=answer['card']) if answer.get('card') else None) for answer in answers]
+        memory.begin_turn()
+        try:
+            touched = memory.record_answers(questioner, leads, answers)
+        except BaseException:
+            memory.abort_turn()
+            raise
+        memory.end_turn(questioner, leads)
+        memory.run_deductions()
+        return [(perspective.name, player.name, card.name) for perspective, player, card in touched]
+
+    def skip_turn(self):
+        self.memory.skip_turn()
+        return self.memory.whose_turn.name
+
+    def undo(self, turns=1):
+        self.memory.undo_turns(turns)
+        self.memory.run_deductions()
+        return self.memory.whose_turn.name
+
+    def sheet(self, perspective=None):
+        memory = self.memory
+        perspective = memory.get_player(playername=perspective) if perspective else memory.user
+        memory.execute("SELECT player, card, has, certainty FROM facts WHERE perspective = ?", (perspective.id,))
+        facts = [{'player': memory.get_player(playerid=player).name, 'card': memory.get_card(cardid=card).name,
+                  'has': None if has is None else bool(has), 'certainty': certainty}
+                 for player, card, has, certainty in memory.fetchall()]
+        solution = memory.solution(perspective)
+        return {'perspective': perspective.name, 'whose_turn': memory.whose_turn.name, 'turn': memory.turns,
+                'facts': facts, 'solution': [c.name for c in solution] if solution else None}
+
+    def messages(self, count=20):
+        return self.log.tail(count, None)[0]
+
+    def statistics(self):
+        return dict(self.memory.statistics(), session=self.name)
+
+    def close(self):
+        statistics = self.statistics()
+        memory = self.memory
+        for checkpoint in memory.checkpoints:
+            checkpoint['brain'].close()
+        memory.checkpoints = []
+        memory.engine = memory.real_brain = None #a database file goes with it
+        return statistics
+
+
+class Sessions(object):
+    """Hosts many independent games in one process, say for a whole game night. Every game is a Session on a
+    database of its own, in memory or as a file in the directory given. Calls to a game are queued and run on a
+    shared pool of threads one at a time and in order, while the calls to other games run alongside, each pool
+    task taking a single call so that a busy game cannot hold back the others."""
+
+    def __init__(self, directory=None, jobs=None):
+        self.directory = directory
+        self.pool = concurrent.futures.ThreadPoolExecutor(jobs)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def open(self, name, **settings):
+        with self.lock:
+            if name in self.sessions:
+                raise KeyError("Game %s is hosted already" % name)
+            dbname = os.path.join(self.directory, "%s.db.tmp" % name) if self.directory else None
+            self.sessions[name] = Session(name, dbname, **settings)
+        return self.sessions[name]
+
+    def submit(self, name, method, *args):
+        """Queues a call of the game's method, returns its Future"""
+        session = self.sessions[name]
+        future = concurrent.futures.Future()
+        with session.lock:
+            session.pending.append((future, method, args))
+            if len(session.pending) > 1: #runs after the calls before
+                return future
+        self.pool.submit(self.run, session)
+        return future
+
+    def run(self, session):
+        future, method, args = session.pending[0]
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(getattr(session, method)(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        with session.lock:
+            session.pending.popleft()
+            if not session.pending:
+                return
+        self.pool.submit(self.run, session)
+
+    def close(self, name):
+        """Ends the game once its calls ran, returns the Future of its statistics"""
+        closed = self.submit(name, 'close')
+        closed.add_done_callback(lambda future: self.sessions.pop(name, None))
+        return closed
+
+    def shutdown(self):
+        concurrent.futures.wait([self.close(name) for name in list(self.sessions)])
+        self.pool.shutdown(wait=True)
+
+
+class Completer(object):
+    """Completion index over the answers allowed at a prompt. An answer matches when the typed characters appear in
+    it in that order, ignoring case, just like the pattern ".*a.*b.*" would. Answers with a word starting with the
+    input are ranked first and found by bisecting a sorted array of all their word starts. The other matches are
+    found by advancing the leftmost match of every answer still matching the shorter input by one character, so a
+    keystroke never looks at answers ruled out before. The inputs the current one starts with are remembered, so
+    deleting costs nothing, while the others are forgotten and the memory stays within the length of the input."""
+    folding = str.maketrans({'\u0131': 'i', '\u017f': 's'}) #dotless i and long s match i and s when ignoring case
+
+    def __init__(self, words):
+        self.words = list(words)
+        self.folded = [w.lower().translate(self.folding) for w in self.words]
+        self.starts = sorted((f[k:], i) for i, f in enumerate(self.folded) for k in range(len(f)) if k == 0 or f[k-1] == ' ')
+        self.advanced = {'': [(i, 0) for i in range(len(self.words))]} #input -> (answer, end of its leftmost match)
+        self.ranked = {}
+
+    def advance(self, typed):
+        known = len(typed) #characters of the longest input remembered which the input starts with
+        while typed[:known] not in self.advanced:
+            known -= 1
+        found = self.advanced[typed[:known]]
+        for k in range(known, len(typed)):
+            found = [(i, end+1) for i, end in ((i, self.folded[i].find(typed[k], end)) for i, end in found) if end >= 0]
+            self.advanced[typed[:k+1]] = found
+        self.forget(self.advanced, typed)
+        return found
+
+    def forget(self, memo, typed):
+        for other in [other for other in memo if not typed.startswith(other)]:
+            del memo[other]
+
+    def complete(self, typed):
+        typed = typed.lower().translate(self.folding)
+        if typed not in self.ranked:
+            first = bisect.bisect_left(self.starts, (typed,))
+            last = bisect.bisect_left(self.starts, (typed + '\U0010ffff',))
+            leading = sorted(set(i for _, i in self.starts[first:last]))
+            ranked = set(leading)
+            self.ranked[typed] = [self.words[i] for i in leading + [i for i, _ in self.advance(typed) if i not in ranked]]
+            self.forget(self.ranked, typed)
+        return self.ranked[typed]
+
+
+class LogStore(object):
+    """Entries of a log pane as they were logged, the newest last. Only the last `capacity` entries are kept, older
+    ones are appended to the spill file if there is one. An entry is wrapped into lines only once a window reaches
+    it and keeps them for as long as the width stays the same, so showing or scrolling the newest lines costs the
+    lines shown, not the length of the game.
+
+    A cursor remembers how many lines the newest entries down to the oldest one a window reached have. It follows
+    new entries and windows moving up or down, so finding where a window starts costs the entries it moved over,
+    not the lines scrolled up."""
+    capacity = 1000
+
+    def __init__(self, wrap, capacity=None, spill=None):
+        self.wrap = wrap #text -> lines at the current width
+        self.capacity = capacity or self.capacity
+        self.spill = spill
+        self.entries = collections.deque() #[text, width wrapped for, lines]
+        self.cursor = None #[width, newest entries, their lines]
+
+    def append(self, text):
+        self.entries.append([text, None, None])
+        cursor = self.cursor
+        if cursor:
+            cursor[1] += 1
+            cursor[2] += len(self.lines(self.entries[-1], cursor[0]))
+        if len(self.entries) > self.capacity:
+            entry = self.entries.popleft()
+            if cursor and cursor[1] > len(self.entries):
+                cursor[1] -= 1
+                cursor[2] -= len(self.lines(entry, cursor[0]))
+            if self.spill:
+                with open(self.spill, "a") as spill:
+                    spill.write(entry[0] + "\n")
+
+    def clear(self):
+        self.entries.clear()
+        self.cursor = None
+
+    def lines(self, entry, width):
+        if entry[2] is None or entry[1] != width:
+            entry[1], entry[2] = width, self.wrap(entry[0])
+        return entry[2]
+
+    def newest(self, width):
+        return self.lines(self.entries[-1], width) if self.entries else []
+
+    def reach(self, count, width):
+        """Moves the cursor to the fewest newest entries with at least `count` lines (or all entries), returns how
+        many entries and lines that is"""
+        if not self.cursor or self.cursor[0] != width:
+            self.cursor = [width, 0, 0]
+        cursor, entries = self.cursor, self.entries
+        while cursor[1] and cursor[2] - len(self.lines(entries[-cursor[1]], width)) >= count:
+            cursor[2] -= len(self.lines(entries[-cursor[1]], width))
+            cursor[1] -= 1
+        while cursor[2] < count and cursor[1] < len(entries):
+            cursor[1] += 1
+            cursor[2] += len(self.lines(entries[-cursor[1]], width))
+        return cursor[1], cursor[2]
+
+    def count(self, limit, width):
+        """How many lines there are, counting up to limit only"""
+        return min(self.reach(limit, width)[1], limit)
+
+    def window(self, skip, count, width):
+        """The `count` lines ending `skip` lines above the newest one, fewer if there are not that many"""
+        reached, found = self.reach(skip + count, width)
+        if found <= skip:
+            return []
+        lines, top = [], found #lines below the top of the next entry
+        for i in range(reached, 0, -1):
+            chunk = self.lines(self.entries[-i], width)
+            lines += chunk
+            top -= len(chunk)
+            if top <= skip:
+                break
+        return lines[max(found - skip - count, 0):found - skip]
+
+    def tail(self, count, width):
+        """The last `count` lines and whether there are older ones"""
+        return self.window(0, count, width), self.count(count + 1, width) > count
+
+
+class ReplayFinished(Exception):
+    pass
+
 
 class Display:
     csi = "\033["
@@ -482,7 +2516,6 @@ class Display:
     max_userinput = 20
     possible = None
     matches = None
-    logs = {'engine':[], 'game':[]}
     log_row = 3
     log_col = 39
     log_height = 17
@@ -495,26 +2528,75 @@ class Display:
     sheet_col = 1
     sheet_width = 36
     simbuffer = ""
+    simpos = 0 #next key of simbuffer to replay
     recording = True
-    recordbuffer = ""
-    randseed = ""
+    record_chunk_size = 4096
+    autosave_file = "autosave_replay.sav"
+    autosave_flush = "action" #append to the autosave at every action, after every "key" or "off"
+    autosave_fsync = False
     cardsfile = ""
     typing_replay = False
+    differential = True
+    screen = None
+    keystrokes = 0
+    headless = False #replays without any terminal output
+    completer_cache = 32 #completion indexes kept for the answer lists asked for most recently
+    show_odds = False #probabilities from counting the deals instead of dots on the sheet
+    memory = None #the game currently played
+    background = True #live games deduce in a worker thread while waiting for keys, replays never do
+    board = None #the sheet last drawn and the version of the changes it reflects
+
+    def __init__(self):
+        self.logs = {'engine': LogStore(self.prepare_log_lines), 'game': LogStore(self.prepare_log_lines)}
+        self.pending_log = []
+        self.loop = None #event loop waiting for keys while deductions run in the background
+        self.completers = {} #answers -> Completer, least recently asked first
+        #Recorded keys are collected in chunks, appending to one ever growing string would copy it every time
+        self.recordbuffer = []
+        self.recordchunk = []
+        self.journal = None
 
     def print_at(self, row, col, text):
-        print(self.csi + str(row) + ";" + str(col) + "H" + text, end='')
+        if self.headless:
+            return
+        if self.differential:
+            if not self.screen:
+                self.screen = Screen()
+            self.screen.put(row, col, text)
+        else:
+            print(self.csi + str(row) + ";" + str(col) + "H" + text, end='')
+        return
+
+    def flush(self):
+        if self.headless:
+            return
+        if self.differential and self.screen:
+            self.screen.flush()
+        else:
+            sys.stdout.flush()
         return
 
     def clear_screen(self):
+        if self.headless:
+            return
         print(self.csi + "2J")
+        if self.screen:
+            self.screen.clear()
         return
 
-    def print_board(self, memory):
+    def sheet(self, memory, perspective, only=None):
+        """Aggregates the facts into the sheet as seen by perspective: the players in seating order and one entry
+        per card in sheet order with its type, whether it is known to be in the envelope and per player the
+        symbol shown as well as the raw fact. With the odds shown also the probabilities of each player holding
+        the card and of the card being in the envelope, and their margins of error if they are estimated. Each
+        entry only depends on the facts about its card, so the entries of only some card ids can be asked for."""
         memory.execute("""
             SELECT c.name, f.player, f.has, f.certainty, c.type, f.perspective
                 FROM cards c JOIN facts f ON c.id = f.card
+                %s
                 ORDER BY c.type = 'suspect' DESC, c.type = 'weapon' DESC, c.type = 'room' DESC, c.name ASC, f.perspective = ? DESC, f.player = ? DESC
-            """, (memory.perspective_board.id, memory.perspective_board.id))
+            """ % ("WHERE c.id IN (%s)" % ",".join("?"*len(only)) if only is not None else ""),
+            tuple(only or ()) + (perspective.id, perspective.id))
         rows = memory.fetchall()
         card_names = [] #keep names separately to recall order
         cards = {}
@@ -529,14 +2611,14 @@ class Display:
             has = row[2]
             certainty = row[3]
             type = row[4]
-            perspective = row[5]
+            fact_perspective = row[5]
 
             if name not in card_names:
                 card_names += [name]
                 cards[name] = {'players':{}, 'type':type}
 
-            #rows ordered by board perspective so if branch WILL trigger and therefore avoid index errors in later block
-            if perspective == memory.perspective_board.id:
+            #rows ordered by the sheet's perspective so if branch WILL trigger and therefore avoid index errors in later block
+            if fact_perspective == perspective.id:
                 cards[name]['players'][playerid] = {
                     'has': {'value': has, 'certainty':certainty},
                     'knows': {'value':None, 'certainty':None},
@@ -545,37 +2627,18 @@ class Display:
 
             #now processing perspectives - this only matters for displaying knowledge, not posession
             if has == True:
-                cards[name]['players'][perspective]['knows']['value'] = True
-                cards[name]['players'][perspective]['knows']['certainty'] = certainty
+                cards[name]['players'][fact_perspective]['knows']['value'] = True
+                cards[name]['players'][fact_perspective]['knows']['certainty'] = certainty
             elif has == False:
-                cards[name]['players'][perspective]['knows_hasnot']['counter'] += 1
-                cards[name]['players'][perspective]['knows_hasnot']['certainty'] = min(certainty, cards[name]['players'][perspective]['knows_hasnot']['certainty'])
-
-        #collection done, now print it
-        current_type = None
-        row = self.sheet_row
+                cards[name]['players'][fact_perspective]['knows_hasnot']['counter'] += 1
+                cards[name]['players'][fact_perspective]['knows_hasnot']['certainty'] = min(certainty, cards[name]['players'][fact_perspective]['knows_hasnot']['certainty'])
 
-        markers_width = max(6,len(players))*2 +2
-        labels_width = self.sheet_width - markers_width - 2
-
-        self.print_at(row, self.sheet_col, "/%s--%s\\"
-                % ('-'*labels_width, "-".join([p.name[:1] for p in players]).ljust(markers_width-2, '-')))
-        row += 1
+        #then decide what to show
+        entries = []
         for card_name in card_names:
-            if current_type and cards[card_name]['type'] != current_type:
-                self.print_at(row, self.sheet_col, "|%s+%s|" % ('-'*labels_width, '-'*(markers_width-1),))
-                row += 1
-            current_type = cards[card_name]['type']
-            card_label = card_name[:labels_width].center(labels_width)
-            if cards[card_name]['players'][memory.perspective_board.id]['knows_hasnot']['counter'] == len(players):
-                card_label = display.csi + "31;1m" + card_label.upper() + display.csi + "0m"
-            self.print_at(row, self.sheet_col, "|%s|%s|" % (card_label, ' '*(markers_width-1)))
-            col_offset = 2
-
+            entry = {'card': card_name, 'type': cards[card_name]['type'], 'symbols': [], 'facts': [],
+                     'envelope': cards[card_name]['players'][perspective.id]['knows_hasnot']['counter'] == len(players)}
             for player in players:
-                if player.suspectcard.name == card_name:
-                    self.print_at(row, self.sheet_col, player.name[:1])
-
                 relation = cards[card_name]['players'][player.id]
                 if relation['has']['value']:
                     symbol = 'O'
@@ -593,10 +2656,119 @@ class Display:
                     symbol = 'X'
                 else:
                     symbol = '.'
-                self.print_at(row, self.sheet_col + 1 + labels_width + col_offset, symbol)
-                col_offset += 2
+                entry['symbols'].append(symbol)
+                entry['facts'].append(relation['has'])
+            entries.append(entry)
+
+        odds = memory.odds(perspective) if self.show_odds else None
+        if odds and odds['deals'] != 0:
+            for entry in entries:
+                card = memory.get_card(cardname=entry['card'])
+                entry['odds'] = [odds['cells'][(player.id, card.id)] for player in players]
+                entry['envelope_odds'] = odds['envelope'][card.id]
+                if odds['deals'] is None: #estimated from deals drawn, half widths of the confidence intervals
+                    entry['margins'] = [odds['margins']['cells'][(player.id, card.id)] for player in players]
+                    entry['envelope_margin'] = odds['margins']['envelope'][card.id]
+        return players, entries
+
+    def sheet_lines(self, memory, perspective, highlight=False, sheet=None):
+        players, entries = sheet or self.sheet(memory, perspective)
+        current_type = None
+        lines = []
+
+        markers_width = max(6,len(players))*2 +2
+        labels_width = self.sheet_width - markers_width - 2
+
+        lines.append("/%s--%s\\"
+                % ('-'*labels_width, "-".join([p.name[:1] for p in players]).ljust(markers_width-2, '-')))
+        for entry in entries:
+            if current_type and entry['type'] != current_type:
+                lines.append("|%s+%s|" % ('-'*labels_width, '-'*(markers_width-1),))
+            current_type = entry['type']
+            card_label = entry['card'][:labels_width].center(labels_width)
+            symbols = entry['symbols']
+            if 'odds' in entry:
+                #chance of the envelope holding the card next to its name, tenths for the unknown cells, but no
+                #certainty from estimates
+                envelope_odds, certain = entry['envelope_odds'], entry.get('envelope_margin') is None
+                percent = "    " if not envelope_odds and certain else " <1%" if envelope_odds < 0.005 else "%3i%%" % round(envelope_odds*100)
+                card_label = entry['card'][:labels_width-4].center(labels_width-4) + percent
+                symbols = [symbol if symbol != '.' else 'x' if p == 0 and margin is None else 'o' if p == 1 and margin is None
+                           else str(min(9, max(1, int(round(p*10)))))
+                           for symbol, p, margin in zip(symbols, entry['odds'], entry.get('margins', [None] * len(symbols)))]
+            if entry['envelope']:
+                card_label = card_label.upper()
+                if highlight:
+                    card_label = self.csi + "31;1m" + card_label + self.csi + "0m"
+            border = '|'
+            for player in players:
+                if player.suspectcard.name == entry['card']:
+                    border = player.name[:1]
+            markers = (' ' + ' '.join(symbols)).ljust(markers_width-1)
+            lines.append("%s%s|%s|" % (border, card_label, markers))
+        lines.append("\\%s/" % ('-'*(labels_width+markers_width),))
+        return lines
+
+    def export_sheets(self, memory, output_format="text"):
+        #The sheets of all perspectives, e.g. after a headless replay - nothing to show before the cards are dealt
+        players = memory.get_players() if memory and memory.user else []
+        if output_format == "json":
+            sheets = [(player, self.sheet(memory, player)[1]) for player in players]
+            export = {
+                'players': [p.name for p in players],
+                'whose_turn': memory.whose_turn.name if players and memory.whose_turn else None,
+                'sheets': [{
+                    'perspective': perspective.name,
+                    'cards': [{
+                        'card': entry['card'],
+                        'type': entry['type'],
+                        'envelope': entry['envelope'],
+                        'symbols': dict((p.name, symbol) for p, symbol in zip(players, entry['symbols'])),
+                        'facts': dict((p.name, {'has': None if fact['value'] is None else bool(fact['value']),
+                                                'certainty': fact['certainty']})
+                                      for p, fact in zip(players, entry['facts']))
+                    } for entry in entries]
+                } for perspective, entries in sheets]
+            }
+            for sheet, (perspective, entries) in zip(export['sheets'], sheets):
+                for card, entry in zip(sheet['cards'], entries):
+                    if 'odds' in entry:
+                        card['envelope_probability'] = entry['envelope_odds']
+                        for p, probability in zip(players, entry['odds']):
+                            card['facts'][p.name]['probability'] = probability
+                    if 'margins' in entry:
+                        card['envelope_probability_margin'] = entry['envelope_margin']
+                        for p, margin in zip(players, entry['margins']):
+                            card['facts'][p.name]['probability_margin'] = margin
+            return json.dumps(export, indent=2)
+        else:
+            return "\n\n".join(["Sheet of %s:\n" % perspective.name + "\n".join(self.sheet_lines(memory, perspective))
+                                for perspective in players])
+
+    def board_sheet(self, memory, perspective):
+        #Only the cards whose facts changed since the board was last drawn are read again, unless the odds are shown
+        cached = self.board
+        version, changes = memory.changes_since(cached['version'] if cached else 0)
+        if self.show_odds or not cached or cached['memory'] is not memory or cached['perspective'] != perspective:
+            changes = None
+        if changes is None:
+            players, entries = self.sheet(memory, perspective)
+        else:
+            players, entries = cached['sheet']
+            cards = set(change[4] for change in changes if change[1] == 'fact')
+            if cards:
+                fresh = dict((entry['card'], entry) for entry in self.sheet(memory, perspective, only=cards)[1])
+                entries = [fresh.get(entry['card'], entry) for entry in entries]
+        self.board = None if self.show_odds else {'memory': memory, 'perspective': perspective, 'version': version,
+                                                  'sheet': (players, entries)}
+        return players, entries
+
+    def print_board(self, memory):
+        row = self.sheet_row
+        sheet = self.board_sheet(memory, memory.perspective_board)
+        for line in self.sheet_lines(memory, memory.perspective_board, highlight=True, sheet=sheet):
+            self.print_at(row, self.sheet_col, line)
             row += 1
-        self.print_at(row, self.sheet_col, "\\%s/" % ('-'*(labels_width+markers_width),))
         return
 
     def update_prompt(self):
@@ -621,21 +2793,44 @@ class Display:
         self.print_at(self.prompt_row+2, self.prompt_col, reactionline.ljust(self.prompt_width))
 
         self.print_at(self.prompt_row+1, self.prompt_col + len(inputline), "")
-        sys.stdout.flush()
+        self.flush()
         return
 
     def load_recording(self, filename, inform_user=True):
-        with open(filename, "r", newline='') as save:
-            self.cardsfile, self.simbuffer = tuple(save.read().split('\0', maxsplit=1))
+        with open(filename, "rb") as save:
+            header, keys = tuple(save.read().split(b'\0', maxsplit=1))
+        #An autosave cut short by a crash may end in padding or half a character, the keys before are intact
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+        self.cardsfile = header.decode(locale.getpreferredencoding(False))
+        self.simbuffer = decoder.decode(keys.rstrip(b'\0'))
+        self.simpos = 0
         if inform_user:
-            display.log("Loading game from "+filename)
+            self.log("Loading game from "+filename)
+            if decoder.getstate()[0] or len(keys.rstrip(b'\0')) < len(keys):
+                self.log("Recovered replay, skipped its damaged end.")
 
     def save_recording(self, filename, inform_user=True):
         with open(filename, "w", newline='') as save:
             save.write(self.cardsfile + '\0')
-            save.write(self.recordbuffer)
+            save.write(self.recorded())
         if inform_user:
-            display.log("Saved game as "+filename)
+            self.log("Saved game as "+filename)
+
+    def recorded(self, start=0):
+        #keys recorded from position start on, full chunks all have the same size
+        done = len(self.recordbuffer) * self.record_chunk_size
+        if start >= done:
+            return ''.join(self.recordchunk[start-done:])
+        first, offset = divmod(start, self.record_chunk_size)
+        return self.recordbuffer[first][offset:] + ''.join(self.recordbuffer[first+1:]) + ''.join(self.recordchunk)
+
+    def autosave(self):
+        if self.autosave_flush == "off" or self.headless or not self.recording: #nothing to recover from a replay
+            return
+        if not self.journal:
+            self.journal = Journal(self.autosave_file, self.cardsfile, self.recorded(), self.autosave_fsync)
+        else:
+            self.journal.append(self.recorded(self.journal.written))
 
     def getch(self):
         ch = '\0'
@@ -643,40 +2838,92 @@ class Display:
         old_settings = termios.tcgetattr(fd)
         try:
             tty.setraw(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
+            if self.memory and self.memory.deduction:
+                self.loop = self.loop or asyncio.new_event_loop()
+                self.loop.run_until_complete(self.await_key(fd))
+            #read unbuffered, a key already read ahead would keep the event loop waiting for it
+            decoder = codecs.getincrementaldecoder(sys.stdin.encoding or locale.getpreferredencoding(False))()
+            ch = ''
+            while not ch:
+                ch = decoder.decode(os.read(fd, 1))
         finally:
             termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
         if ord(ch) == 17: #Quit with Ctrl+Q
             raise SystemExit("fast quit")
         return ch
 
+    async def await_key(self, fd):
+        #Until a key is pressed the deductions running in the background may land and are shown right away
+        loop = asyncio.get_running_loop()
+        key = loop.create_future()
+        loop.add_reader(fd, lambda: key.done() or key.set_result(True))
+        try:
+            await asyncio.wait([key, asyncio.wrap_future(self.memory.deduction)], return_when=asyncio.FIRST_COMPLETED)
+            if not key.done():
+                self.land(self.memory)
+                await key
+        finally:
+            loop.remove_reader(fd)
+
+    def land(self, memory):
+        memory.finish_deductions()
+        self.update_log()
+        self.print_board(memory)
+        self.update_prompt()
+        self.flush()
+
+    def replaying(self):
+        return self.headless or self.simpos < len(self.simbuffer)
+
     def getchar(self):
-        if self.simbuffer:
-            ch, self.simbuffer = self.simbuffer[0], self.simbuffer[1:]
+        self.keystrokes += 1
+        if self.simpos < len(self.simbuffer):
+            ch = self.simbuffer[self.simpos]
+            self.simpos += 1
             if self.typing_replay:
                 self.getch()
-            if not self.simbuffer:
-                display.log("#FILL(~)\nReplay completed!\n#FILL(~)")
-                termios.tcflush(sys.stdin, termios.TCIOFLUSH)
+            if self.simpos == len(self.simbuffer):
+                self.log("#FILL(~)\nReplay completed!\n#FILL(~)")
+                if sys.stdin.isatty():
+                    termios.tcflush(sys.stdin, termios.TCIOFLUSH)
+        elif self.headless:
+            raise ReplayFinished("end of replay")
         else:
             ch = self.getch()
 
         #self.log("getchar received: "+str(ord(ch)))
 
         if ord(ch) == 19: #Manual save with Ctrl+S
-            filename = "CSBot_"+datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")+".sav"
-            self.save_recording(filename, inform_user=True)
+            if self.recording:
+                filename = "CSBot_"+datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")+".sav"
+                self.save_recording(filename, inform_user=True)
+            else:
+                self.log("Keys are not recorded in games restored from events, use --events instead.")
         elif self.recording: #in else to not record manual saves
-            self.recordbuffer += ch
+            self.recordchunk.append(ch)
+            if len(self.recordchunk) >= self.record_chunk_size:
+                self.recordbuffer.append(''.join(self.recordchunk))
+                self.recordchunk = []
+            if self.journal and self.autosave_flush == "key":
+                self.autosave()
 
         if ord(ch) == 3: #Quit command with Ctrl+C
             raise KeyboardInterrupt("panic abort")
         return ch
 
+    def completer(self, possible):
+        key = tuple(possible)
+        completer = self.completers.pop(key, None) or Completer(possible)
+        self.completers[key] = completer
+        while len(self.completers) > self.completer_cache:
+            del self.completers[next(iter(self.completers))]
+        return completer
+
     def ask(self, question, possible=None): #if possible given: allowed answers
         self.userinput = ""
         self.question = question
         self.possible = possible
+        completer = self.completer(possible) if possible else None
         tabcount = -1
 
         while True:
@@ -687,10 +2934,11 @@ class Display:
                     (self.userinput,) = self.matches
 
             #Show prompt/alerts/...
-            self.update_kpis()
-            self.update_log()
-            self.update_prompt()
-            sys.stdout.flush()
+            if not self.headless:
+                self.update_kpis()
+                self.update_log()
+                self.update_prompt()
+                self.flush()
 
             #Get input
             keycode = self.getchar()
@@ -723,6 +2971,10 @@ class Display:
             #React to input
             if char in [0, 19]:
                 pass #special treatment done already
+            elif char == 16: #Ctrl+P profiles the deduction rules
+                self.profile()
+            elif char == 15: #Ctrl+O shows the odds on the sheet
+                self.toggle_odds()
             elif char == 21 or char == 23: #Ctrl+U and Ctrl+W clears line almost like in bash
                 self.userinput = ""
             elif char == 127: #Delete... deletes one character
@@ -762,30 +3014,33 @@ class Display:
 
             #Process input
             if self.possible:
-                self.matches = []
-                for word in self.possible:
-                    if re.match(".*" + ".*".join(self.userinput) + ".*", word, re.IGNORECASE):
-                        self.matches += [word]
+                self.matches = completer.complete(self.userinput)
                 if not self.matches:
                     self.alert = "No matches!"
         return
 
     def update_log(self):
-        #what do we have?
-        all_content = self.logs['engine'] + [""]
+        while self.pending_log:
+            self.log(self.pending_log.pop(0))
+        #what do we have? Only as much as the window reaches, older lines are never wrapped
         free_height = self.log_height - 2
-
-        #if it's too short, stretch it to fill at least one display
-        if len(all_content) < free_height:
-            all_content += [""]*(free_height-len(all_content))
+        store = self.logs['engine']
+        reach = free_height + self.log_scrollup - 1
+        found = store.count(reach + 1, self.log_width)
+        #the lines, an empty one below them and, if it's too short, more to fill at least one display
+        height = max(min(found, reach) + 1, free_height)
 
         #how far can we scroll up?
-        max_scrollup = -min(-len(all_content) + free_height, 0)
+        max_scrollup = height - free_height + (1 if found > reach else 0)
         effective_scrollup = min(self.log_scrollup, max_scrollup)
         self.log_max_scrollup = max_scrollup
 
         #calculate window to display
-        display_content = all_content[(-free_height - effective_scrollup):(-effective_scrollup if effective_scrollup else None)]
+        if effective_scrollup:
+            display_content = store.window(effective_scrollup - 1, free_height, self.log_width)
+        else:
+            display_content = store.window(0, free_height - 1, self.log_width) + [""]
+            display_content += [""]*(free_height-len(display_content))
 
         base = self.log_row
         #print tabs...
@@ -808,35 +3063,74 @@ class Display:
 
     def prepare_log_lines(self, text, breakindent=2):
         lines = []
-        if '\n' in text:
-            for line in text.split('\n'):
-                lines += self.prepare_log_lines(line, breakindent)
-            return lines
-        elif text == "":
-            return [""]
-        elif re.match("^#FILL\(.\)$", text): #e.g. "#FILL(~)" produces a line full of "~"
-            return [(self.log_width-2)*text[6]]
-        else:
-            part = ""
-            while text:
-                upto = self.log_width -2 -len(part)
-                lastspace = text[:upto].rfind(' ') + 1
-                upto = lastspace if lastspace > 0 and len(text) > upto else upto
-                part += text[:upto]
-                text = text[upto:].strip()
-                lines += [part]
-                part = breakindent*' '
-            return lines
+        for text in text.split('\n'):
+            if text == "":
+                lines.append("")
+            elif len(text) == 8 and text.startswith("#FILL(") and text[7] == ")": #e.g. "#FILL(~)" produces a line full of "~"
+                lines.append((self.log_width-2)*text[6])
+            else:
+                part = ""
+                while text:
+                    upto = self.log_width -2 -len(part)
+                    lastspace = text[:upto].rfind(' ') + 1
+                    upto = lastspace if lastspace > 0 and len(text) > upto else upto
+                    part += text[:upto]
+                    text = text[upto:].strip()
+                    lines.append(part)
+                    part = breakindent*' '
+        return lines
 
     def log(self, text):
-        lines = self.prepare_log_lines(text)
-        self.logs['engine'] += lines
-        if self.log_scrollup:
-            self.log_scrollup += len(lines)
+        if threading.current_thread() is not threading.main_thread():
+            self.pending_log.append(text) #from the deductions in the background, shown once they land
+            return
+        self.logs['engine'].append(text)
+        if self.log_scrollup: #keep showing the same lines
+            self.log_scrollup += len(self.logs['engine'].newest(self.log_width))
+        return
+
+    def profile(self):
+        if not self.memory:
+            self.alert = "No game to profile!"
+            return
+        self.memory.finish_deductions() #no profiler switched on or off halfway through
+        if not self.memory.profiler:
+            self.memory.profiler = Profiler(self.memory.profile_file)
+            self.log("Profiling deduction rules, CTRL+P again shows the results.")
+        else:
+            profiler = self.memory.profiler
+            self.log(profiler.report())
+            if profiler.last_turn is not None:
+                self.log(profiler.report(profiler.last_turn))
+        return
+
+    def toggle_odds(self):
+        memory = self.memory
+        if not (memory and memory.user):
+            self.alert = "No cards dealt yet!"
+            return
+        self.show_odds = not self.show_odds
+        self.print_board(memory)
+        if self.show_odds:
+            perspective = memory.perspective_board
+            odds = memory.odds(perspective, solutions=True)
+            if odds and odds['deals'] is None:
+                self.log("%i deals drawn for %s's sheet give the odds within %.1f%%, most likely in the envelope:"
+                         % (odds['drawn'], perspective.name, odds['precision']*100))
+                self.log("\n".join("%3i%% %s" % (round(p*100), ", ".join(c.name for c in cards))
+                                   for p, cards in odds['solutions'][:3]))
+            elif odds and odds['deals']:
+                self.log("%i deals fit %s's sheet, most likely in the envelope:" % (odds['deals'], perspective.name))
+                self.log("\n".join("%3i%% %s" % (round(p*100), ", ".join(c.name for c in cards))
+                                   for p, cards in odds['solutions'][:3]))
+            elif odds:
+                self.log("No deal fits %s's sheet, check the facts!" % perspective.name)
+        else:
+            self.log("Showing facts only.")
         return
 
     def clearlog(self, text):
-        self.logs['engine'] = []
+        self.logs['engine'].clear()
         return
 
     def update_kpis(self):
@@ -844,23 +3138,31 @@ class Display:
         return
 
     def pick_player(self, memory, question):
-        return Player(memory, playername=display.ask(question, [p.name for p in memory.get_players()]))
+        return memory.get_player(playername=self.ask(question, [p.name for p in memory.get_players()]))
 
     def pick_card(self, memory, question, cardtype=None):
         cards = memory.get_cards()
         if cardtype: #narrow down if type given
             cards = [c for c in cards if c.type == cardtype.rstrip('s')]
-        return Card(memory, cardname=display.ask(question, [c.name for c in cards]))
+        return memory.get_card(cardname=self.ask(question, [c.name for c in cards]))
 
-    def refresh(self, memory, deduce=False, clear_screen=False):
-        if deduce:
-            memory.run_deductions()
+    def refresh(self, memory, deduce=False, clear_screen=False, publish=False):
+        if (deduce or publish) and self.background and not self.replaying():
+            memory.start_deductions(publish) #the board is drawn once they land
+        else:
+            if deduce:
+                memory.run_deductions()
+            if publish:
+                memory.publish()
+        if self.headless:
+            return
         if clear_screen:
             self.clear_screen()
         self.update_kpis()
         self.update_log()
         self.update_prompt()
-        self.print_board(memory)
+        if not memory.deduction:
+            self.print_board(memory)
 
     def get_card_config(self, config=None):
         if config:
@@ -872,7 +3174,7 @@ class Display:
                     "rooms": []
                 }
             }
-            with open(self.cardsfile, 'rU') as cardsfile:
+            with open(self.cardsfile, 'r') as cardsfile:
                 for line in cardsfile.readlines():
                     for category in ["suspects", "weapons", "rooms"]:
                         match = re.match("^%s:(.+)" % category, line, flags=re.IGNORECASE)
@@ -895,22 +3197,127 @@ class Display:
         return cards
 
 
-class Recommender: #TODO do proper recommendations
-    def __init__(self, memory):
+class Recommender:
+    """Ranks the user's possible suggestions by how much their answer is expected to tell about the solution.
+
+    Deals fitting the user's sheet are drawn at random and every suggestion is answered in each of them: the
+    interviewees are asked in seating order and the first one holding a lead shows one of them, each equally
+    likely. Who holds a card is kept as one bit per drawn deal, so an interviewee's answer over all deals takes a
+    few integer operations. A suggestion's gain is how much the entropy of the envelope's cards drops on average,
+    summed over the three types, in bits."""
+    samples = 1000 #deals drawn per turn
+    max_nodes = 50000 #giving up on counting the deals, after the same work on every machine to keep replays exact
+
+    def __init__(self, memory, display):
         self.memory = memory
+        self.display = display #asks the user
+
+    def rank_leads(self):
+        """(gain, room, suspect, weapon) of every suggestion, best first, or None without deals to draw; kept for
+        the rest of the turn as long as the user's sheet does not change"""
+        memory = self.memory
+        counter = DealCounter(memory, memory.user, max_nodes=self.max_nodes)
+        seed = "%s%i" % (memory.randseed, memory.turns) #reproducible like the game's other randomness
+        if memory.leads_cache and memory.leads_cache[0] == (counter.key, seed):
+            return memory.leads_cache[1]
+        try:
+            deals = counter.sample(random.Random(seed), self.samples)
+        except CountingBudgetExceeded as e:
+            deals = []
+        ranking = self.rank(counter, deals) if deals else None
+        memory.leads_cache = ((counter.key, seed), ranking)
+        return ranking
+
+    def rank(self, counter, deals):
+        memory, envelope = self.memory, len(counter.players)
+        held = [{} for h in range(envelope+1)] #holder -> card id -> bit of every deal it is dealt there
+        for k, deal in enumerate(deals):
+            for i, h in enumerate(deal):
+                card = counter.order[i].id
+                held[h][card] = held[h].get(card, 0) | 1 << k
+        solution = list(held[envelope].values())
+        holder = dict((p.id, h) for h, p in enumerate(counter.players))
+        interviewees = []
+        interviewee = memory.next_player(memory.user)
+        while interviewee != memory.user:
+            interviewees.append(held[holder[interviewee.id]])
+            interviewee = memory.next_player(interviewee)
+
+        def xlogx(x):
+            return x * math.log2(x) if x > 0 else 0.0
+
+        def counted(deals):
+            #how many of the deals there are and how many of them have each envelope card
+            return [popcount(deals)] + [popcount(deals & envelope_card) for envelope_card in solution]
+
+        def uncertainty(counts):
+            #the number of deals times the entropy of the envelope among them
+            return 3 * xlogx(counts[0]) - sum(map(xlogx, counts[1:]))
+
+        everything = (1 << len(deals)) - 1
+        before = uncertainty(counted(everything))
+        ranking = []
+        by_type = dict((t, [c for c in memory.get_cards() if c.type == t]) for t in ("room", "suspect", "weapon"))
+        for room in by_type["room"]:
+            for suspect in by_type["suspect"]:
+                for weapon in by_type["weapon"]:
+                    leads = (room.id, suspect.id, weapon.id)
+                    left, after = everything, 0.0
+                    for hand in interviewees:
+                        a, b, c = [hand.get(lead, 0) & left for lead in leads]
+                        if not a | b | c:
+                            continue
+                        left &= ~(a | b | c)
+                        #Deals by the leads held, those holding several split evenly between the cards shown
+                        regions = [(a & ~b & ~c, 1, (0,)), (b & ~a & ~c, 1, (1,)), (c & ~a & ~b, 1, (2,)),
+                                   (a & b & ~c, 0.5, (0, 1)), (a & c & ~b, 0.5, (0, 2)), (b & c & ~a, 0.5, (1, 2)),
+                                   (a & b & c, 1.0/3, (0, 1, 2))]
+                        answers = [None, None, None]
+                        for deals_held, weight, shown in regions:
+                            if not deals_held:
+                                continue
+                            counts = counted(deals_held)
+                            for card in shown:
+                                if answers[card] is None and weight == 1:
+                                    answers[card] = counts
+                                elif answers[card] is None:
+                                    answers[card] = [n * weight for n in counts]
+                                else:
+                                    answers[card] = [m + n * weight for m, n in zip(answers[card], counts)]
+                        after += sum(uncertainty(counts) for counts in answers if counts)
+                    after += uncertainty(counted(left)) #nobody shows a card
+                    ranking.append(((before - after) / len(deals), room, suspect, weapon))
+        ranking.sort(key=lambda suggestion: -suggestion[0])
+        return ranking
 
     def pick_leads(self):
-        room = display.pick_card(self.memory, "Pick a room:", "room")
-        suspect = display.pick_card(self.memory, "Pick a suspect:", "suspect")
-        weapon = display.pick_card(self.memory, "Pick a weapon:", "weapon")
+        ranking = self.rank_leads() or []
+        if ranking and ranking[0][0] >= 0.005: #not when nothing is left to learn
+            self.display.log("Most telling suggestions (bits expected):")
+            self.display.log("\n".join("  %.2f %s, %s, %s" % (gain, suspect.name, room.name, weapon.name)
+                                  for gain, room, suspect, weapon in ranking[:3]))
+        room = self.pick_card("Pick a room:", "room", [r for g, r, s, w in ranking])
+        suspect = self.pick_card("Pick a suspect:", "suspect", [s for g, r, s, w in ranking if r == room])
+        weapon = self.pick_card("Pick a weapon:", "weapon", [w for g, r, s, w in ranking if r == room and s == suspect])
         return (room, suspect, weapon)
 
+    def pick_card(self, question, cardtype, best):
+        #the best card is named in the question, the choices keep their usual order for TAB and prefixes
+        if best:
+            question = "%s (best: %s):" % (question.rstrip(":"), best[0].name)
+        return self.display.pick_card(self.memory, question, cardtype)
+
     def pick_answer(self, holds):
-        return Card(self.memory, cardname=display.ask("Which card do you show?", [c.name for c in holds]))
+        return self.memory.get_card(cardname=self.display.ask("Which card do you show?", [c.name for c in holds]))
 
 ### GAME FLOW ###
 
-def programloop():
+def programloop(display, cards, restored=None, **settings):
+    """Runs the main menu on the display with the cards configured, and the game started from it on a Memory with
+    the given settings or the one restored"""
+    if restored: #game rebuilt from an event log
+        return play(restored, display)
+
     action = display.ask("", ["new game", "exit"])
 
     if action == "exit":
@@ -919,13 +3326,10 @@ def programloop():
     elif action == "new game":
 
         #Prepare database
-        memory = Memory()
+        memory = Memory(logger=display.log, **settings)
         memory.db_setup()
-        display.randseed = ""
-
-        for cardtype in sorted(list(cards["names"])):
-            for cardname in sorted(list(cards["names"][cardtype])):
-                memory.new_card(cardname, cardtype.rstrip('s'))
+        display.memory = memory
+        memory.new_cards(cards["names"])
 
         display.log("#FILL(#)\nLet's prepare the game!\nAdd all players starting with you and proceeding clockwise. Commence the game when ready.")
 
@@ -958,11 +3362,11 @@ def programloop():
                     display.alert = "Already at player maximum!"
                     continue
                 suspect_pick = display.ask(name_pick+"'s pawn:", suspectnames)
-                suspectcard = Card(memory, cardname=suspect_pick)
+                suspectcard = memory.get_card(cardname=suspect_pick)
 
                 memory.new_player(name_pick, suspectcard)
                 display.log("Player "+str(len(players)+1)+": "+name_pick+" as "+suspect_pick)
-                display.randseed += name_pick+suspect_pick
+                memory.randseed += name_pick+suspect_pick
 
 
         #Register number of cards
@@ -984,6 +3388,7 @@ def programloop():
                 memory.set_number_of_cards(player, num_cards)
                 display.log(player.name+" holds "+str(num_cards)+" cards.")
 
+            players = memory.get_players()
             num_cards_players = sum([p.number_of_cards for p in players])
             num_cards_expected = len(memory.get_cards()) -3
             if num_cards_players == num_cards_expected:
@@ -993,22 +3398,16 @@ def programloop():
                 if display.ask("Resolve conflict:", ["override", "repeat input"]) == "override":
                     break
 
-        #Create blank facts
-        memory.init_facts()
-        memory.user = players[0]
-
-        #Default perspective is the user
-        memory.perspective_default = memory.user
-        memory.perspective_board = memory.user
-
-        #User's cards
+        #User's cards, the user is the first player
         display.log("Recording your cards...")
         user_cardnames = []
-        for i in range(memory.user.number_of_cards):
-            card = Card(memory, cardname=display.ask("Which cards do you have? ("+str(i+1)+" of "+str(memory.user.number_of_cards)+")", [c.name for c in memory.get_cards() if c.name not in user_cardnames]))
+        for i in range(players[0].number_of_cards):
+            card = memory.get_card(cardname=display.ask("Which cards do you have? ("+str(i+1)+" of "+str(players[0].number_of_cards)+")", [c.name for c in memory.get_cards() if c.name not in user_cardnames]))
             user_cardnames += [card.name]
-            memory.add_fact(memory.user, card, has=True, certainty=1, perspective=memory.user)
-            display.randseed += card.name
+            memory.randseed += card.name
+
+        #Create blank facts, default perspective is the user
+        memory.deal([memory.get_card(cardname=name) for name in user_cardnames])
 
         #Determine where to start
         display.log("Almost there...")
@@ -1016,22 +3415,34 @@ def programloop():
         display.log(memory.whose_turn.name+" will start.")
 
         #Reproducable randomness if same players with same pawns and same cards recorded by user in same order
-        random.seed(display.randseed, version=2)
+        random.seed(memory.randseed, version=2)
 
+        memory.log_event('setup', cardsfile=display.cardsfile, cards=cards["names"],
+                         players=[(p.name, p.suspectcard.name, p.number_of_cards) for p in players],
+                         user_cards=user_cardnames, first=memory.whose_turn.name)
         display.log("The game is on!")
-        memory.undo_available, memory.undo_savepoint_exists = False, False
-
-        while True:
-            try:
-                if gameloop(memory):
-                    return True
-            except KeyboardInterrupt as e:
-                display.log("Panic abort from current command.")
+        return play(memory, display)
+
+def play(memory, display):
+    display.memory = memory
+    if memory.in_memory and memory.snapshot_file:
+        display.log("Read-only snapshots are published to "+memory.snapshot_file)
+    if memory.events:
+        display.log("Events are recorded to "+memory.events.filename)
+    if memory.push:
+        display.log("Sheets and their changes are served at "+memory.push.address)
+
+    while True:
+        try:
+            if gameloop(memory, display):
+                return True
+        except KeyboardInterrupt as e:
+            display.log("Panic abort from current command.")
 
-def gameloop(memory):
-    display.refresh(memory, deduce=True)
-    display.save_recording("autosave_replay.sav", inform_user=False)
-    action = display.ask("", ["turn", "skip"]+(["undo"] if memory.undo_available else [])+["database", "refresh", "exit"])
+def gameloop(memory, display):
+    display.refresh(memory, deduce=True, publish=True)
+    display.autosave()
+    action = display.ask("", ["turn", "skip"]+(["undo"] if memory.undoable_turns() else [])+["database", "refresh", "exit"])
 
     def ask_perspectives():
         playernames = [p.name for p in memory.get_players()]
@@ -1040,7 +3451,7 @@ def gameloop(memory):
             chosen = playernames
         else:
             chosen = [perspective_input]
-        return [Player(memory, playername=x) for x in chosen]
+        return [memory.get_player(playername=x) for x in chosen]
 
 
     if action == "exit":
@@ -1049,12 +3460,16 @@ def gameloop(memory):
             return True
 
     elif action == "undo":
-        display.log("#FILL(#)\nYou can time travel back to the point right before you started your last turn.")
-        if display.ask("Undo one and only one turn?", ["yes", "cancel"]) == "yes":
-            memory.execute("ROLLBACK TO SAVEPOINT undoturn")
-            memory.execute("RELEASE SAVEPOINT undoturn")
-            memory.whose_turn = memory.whose_turn_undo
-            memory.undo_available, memory.undo_savepoint_exists = False, False
+        undoable = memory.undoable_turns()
+        display.log("#FILL(#)\nYou can time travel back to the point right before any of the last %i turn(s) started:" % undoable)
+        display.log("\n".join("   %i: %s's turn" % (undoable - i, checkpoint['whose_turn'].name)
+                               for i, checkpoint in enumerate(memory.checkpoints)))
+        #"more" goes last so that the choices of a single undo and their order stay those of older key recordings
+        answer = display.ask("Undo the last turn?", ["yes", "cancel"]+(["more"] if undoable > 1 else []))
+        if answer == "more":
+            answer = display.ask("Undo how many turns?", [str(n) for n in range(2, undoable+1)]+["cancel"])
+        if answer != "cancel":
+            memory.undo_turns(1 if answer == "yes" else int(answer))
             display.log("Summoning TARDIS, reverting changes...\n#FILL(#)")
             return
         else:
@@ -1069,14 +3484,13 @@ def gameloop(memory):
 
         if override == "fact":
             player = display.pick_player(memory, "Fact about which player?")
-            card = Card(memory, cardname=display.ask(player.name+"'s relation to which card?", [c.name for c in memory.get_cards()]))
+            card = memory.get_card(cardname=display.ask(player.name+"'s relation to which card?", [c.name for c in memory.get_cards()]))
             has_options = {"holding":True, "missing":False, "unknown":None}
             has = has_options[display.ask("What about the card?", list(has_options))]
             certainty_options = {"maybe":0.3, "probably":0.7, "absolutely":1.0}
             certainty = certainty_options[display.ask("How certain is this?", list(certainty_options))]
 
-            for current_perspective in ask_perspectives():
-                memory.add_fact(player, card, has, certainty=certainty, perspective=current_perspective)
+            memory.override_fact(player, card, has, certainty, ask_perspectives())
 
             display.log("Fact table updated.")
 
@@ -1085,31 +3499,24 @@ def gameloop(memory):
             #raise NotImplementedError("manually add clue") #TODO
 
         elif override == "commit":
-            if display.ask("Commit and delete undo savepoint?", ["yes", "cancel"]) == "yes":
-                if memory.undo_savepoint_exists:
-                    memory.execute("RELEASE SAVEPOINT undoturn")
-                    memory.undo_savepoint_exists, memory.undo_available = False, False
+            if display.ask("Commit and delete the undo history?", ["yes", "cancel"]) == "yes":
+                if memory.commit_undo():
                     display.log("Committed all data.")
                 else:
-                    display.log("There is no undo savepoint which could be committed.")
+                    display.log("There is no undo history which could be committed.")
 
     elif action == "skip":
         if display.ask("Really skip %s's turn?" % memory.whose_turn.name, ["yes", "no"]) == "yes":
-            memory.whose_turn = memory.next_player(memory.whose_turn)
+            memory.skip_turn()
             display.log("Skipping player, %s will be next." % memory.whose_turn.name)
 
     elif action == "turn":
-        if memory.undo_savepoint_exists:
-            memory.execute("RELEASE SAVEPOINT undoturn")
-        memory.execute("SAVEPOINT undoturn")
-        memory.whose_turn_undo = memory.whose_turn
-        memory.undo_savepoint_exists = True
+        memory.begin_turn()
 
         display.log("#FILL(-)")
         player = memory.whose_turn
-        butler = Recommender(memory)
+        butler = Recommender(memory, display)
 
-        memory.execute("SAVEPOINT turn")
         try:
             if player == memory.user:
                 display.log("Now it's your turn.")
@@ -1139,93 +3546,229 @@ def gameloop(memory):
                     can_show = (display.ask("Can %s show a card?" % interviewee.name, ["show", "pass"]) == "show")
 
                 if can_show:
-                    #if we are the inspector we gain plain facts...
+                    shown = None
                     if player == memory.user:
                         shown_possible = [lead.name for lead in leads if (memory.has_card(interviewee, lead, player)[0] != False)]
                         if not shown_possible:
                             display.log("%s should not be able to show a card..." % interviewee.name)
                             display.ask("This seems impossible...", ["retry"])
                             continue
-                        shown = Card(memory, cardname=display.ask("Which card is shown to you?", shown_possible))
-                        memory.add_fact(interviewee, shown, has=True, certainty=1, perspective=player)
-                        memory.add_fact(interviewee, shown, has=True, certainty=1, perspective=interviewee)
+                        shown = memory.get_card(cardname=display.ask("Which card is shown to you?", shown_possible))
                         display.log("%s shows you %s." % (interviewee.name, shown.name.upper()))
-                    #if we are interviewed we know who knows more...
                     elif interviewee == memory.user:
                         shown = butler.pick_answer(holding)
-                        memory.add_fact(interviewee, shown, has=True, certainty=1, perspective=player)
                         display.log("You show %s %s." % (player.name, shown.name.upper()))
                     else:
                         display.log("%s shows %s a card." % (interviewee.name, player.name))
-
-                    #...but in any case everyone gets a clue
-                    memory.add_clue(player, interviewee, leads)
-
+                    memory.record_show(player, interviewee, leads, shown)
 
                     break #turn ends when someone can show
 
-                else: #cannot show so everyone gains facts
-                    for inspector in memory.get_players():
-                        for lead in leads:
-                            memory.add_fact(interviewee, lead, has=False, certainty=1, perspective=inspector)
-
+                else:
+                    memory.record_pass(interviewee, leads)
                     display.log("%s cannot show a card." % interviewee.name)
 
                 interviewee = memory.next_player(interviewee)
                 display.refresh(memory, deduce=True)
 
-            memory.whose_turn = memory.next_player(memory.whose_turn)
+            memory.end_turn(player, leads)
             display.log("%s will be next." % memory.whose_turn.name)
-
-            memory.execute("RELEASE SAVEPOINT turn")
         except KeyboardInterrupt as e:
-            memory.execute("ROLLBACK TO SAVEPOINT turn")
-            memory.execute("RELEASE SAVEPOINT turn")
+            memory.abort_turn()
             display.log("Turn aborted, no changes persisted.")
             raise
 
-        memory.undo_available = True
-
 
     pass #always reached unless KeyboardInterrupt or turn undo - but no break or continue bullshit otherwise
 
-### REAL EXECUTION
-display = Display()
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--replay', action='store', required=False,
-                    help="Opens the given replay file", metavar='SAVEFILE')
-parser.add_argument('--typing', action='store_true', required=False,
-                    help="Activates manual replay mode in which one character is replayed with each key pressed")
-parser.add_argument('--cards', action='store', required=False, default="",
-                    help="Uses the given cards file for custom Cluedo variants", metavar='CARDSFILE')
-args = parser.parse_args()
+### BATCH ANALYSIS
 
-display.clear_screen()
+def analyze_replay(filename, engine_name='sql'):
+    """Plays a replay file or event log headless with its own display and in-memory database, returns the
+    statistics of its (last) game"""
+    display = Display()
+    display.headless = True
+    settings = dict(engine_name=engine_name, in_memory=True, snapshot_file=None, events_file=None, push=None)
 
-display.cardsfile = args.cards
-
-if args.replay:
-    display.load_recording(args.replay)
-    if args.typing:
-        display.typing_replay = True
-
-cards = display.get_card_config(display.cardsfile)
+    stats = {'file': filename}
+    start = time.perf_counter()
+    try:
+        if EventLog.is_event_log(filename):
+            display.memory, turns = EventLog.replay(filename, logger=display.log, **settings)
+        else:
+            display.load_recording(filename, inform_user=False)
+            cards = display.get_card_config(display.cardsfile)
+            try:
+                while not programloop(display, cards, **settings):
+                    pass
+            except ReplayFinished as e:
+                pass
+    except (Exception, SystemExit) as e:
+        stats['error'] = "%s: %s" % (type(e).__name__, e)
+    stats['wall_time'] = round(time.perf_counter() - start, 4)
+    if display.memory:
+        stats.update(display.memory.statistics())
+    return stats
+
+def replay_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(('.sav', '.jsonl'))]
+    return sorted(glob.glob(path))
+
+def analyze_replays(files, jobs=None, engine_name='sql'):
+    analyze = functools.partial(analyze_replay, engine_name=engine_name)
+    if jobs == 1:
+        return [analyze(filename) for filename in files]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(analyze, files, chunksize=1)
+
+def write_statistics(stats, output_format="text"):
+    columns = ['file', 'players', 'turns', 'solved_turn', 'cycles', 'facts_deduced'] + \
+              ['deduced_' + rule for rule in Memory.rules] + ['wall_time', 'error']
+    if output_format == "json":
+        print(json.dumps(stats, indent=2))
+    elif output_format == "csv":
+        writer = csv.DictWriter(sys.stdout, columns, restval='')
+        writer.writeheader()
+        writer.writerows(stats)
+    else:
+        headers = ['file', 'players', 'turns', 'solved', 'cycles', 'deduced'] + \
+                  [''.join(word[0] for word in rule.split('_')).upper() for rule in Memory.rules] + ['seconds']
+        print(("%-30s" + " %8s"*(len(headers)-1)) % tuple(headers))
+        for game in stats:
+            if 'error' in game:
+                print("%-30s %s" % (game['file'][-30:], game['error']))
+                continue
+            print(("%-30s" + " %8s"*(len(headers)-1)) % tuple([game['file'][-30:]] +
+                  ['-' if game[column] is None else game[column] for column in columns[1:-2]] + ["%.2f" % game['wall_time']]))
 
-display.log("Welcome to Clue/Cluedo!\n\nType available commands in [brackets] to interact. Hit TAB to cycle through options, type ? to get a full list and use ENTER to accept. Clear the input line with CTRL+U. Use arrow keys to scroll in tabs and switch between tabs. Once the game has started CTRL+C aborts the current command. CTRL+Q exits *immediately*.")
+### REAL EXECUTION
+display = Display()
 
-while True:
-    try:
-        if programloop():
-            display.clear_screen()
-            print("\nBye!")
-            break
-    except (SystemExit, KeyboardInterrupt) as e:
-        display.clear_screen()
-        print("Fast quit... bye!")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', action='store', required=False,
+                        help="Opens the given replay file or event log", metavar='SAVEFILE')
+    parser.add_argument('--turn', action='store', required=False, default=0, type=int,
+                        help="Stops replaying an event log at the start of turn N", metavar='N')
+    parser.add_argument('--events', action='store', required=False, default="",
+                        help="Records the game as an event log, replays are converted", metavar='EVENTFILE')
+    parser.add_argument('--typing', action='store_true', required=False,
+                        help="Activates manual replay mode in which one character is replayed with each key pressed")
+    parser.add_argument('--cards', action='store', required=False, default="",
+                        help="Uses the given cards file for custom Cluedo variants", metavar='CARDSFILE')
+    parser.add_argument('--engine', action='store', required=False, default="sql", choices=sorted(engines),
+                        help="Selects the deduction engine, sql being the reference implementation")
+    parser.add_argument('--memory-db', action='store_true', required=False,
+                        help="Keeps the database in memory and publishes read-only snapshots instead")
+    parser.add_argument('--snapshot', action='store', required=False, default="",
+                        help="Snapshot file of the in-memory database (default: unique per process)", metavar='DBFILE')
+    parser.add_argument('--snapshot-interval', action='store', required=False, default=0, type=int,
+                        help="Also publish snapshots after deductions at most every MS milliseconds", metavar='MS')
+    parser.add_argument('--undo-depth', action='store', required=False, default=20, type=int,
+                        help="Number of turns that can be undone, each keeping a copy of the database in memory (default: 20, 0 keeps all)",
+                        metavar='N')
+    parser.add_argument('--serve', action='store', required=False, default=0, type=int,
+                        help="Serves the sheets and streams their changes to external apps on localhost:PORT (HTTP)", metavar='PORT')
+    parser.add_argument('--full-redraw', action='store_true', required=False,
+                        help="Redraws the whole screen on every key instead of only what changed")
+    parser.add_argument('--blocking-deductions', action='store_true', required=False,
+                        help="Waits for the deductions before taking the next key, as replays do, instead of running them in the background")
+    parser.add_argument('--autosave-flush', action='store', required=False, default="action", choices=["action", "key", "off"],
+                        help="Appends new keys to autosave_replay.sav at every action (default), after every key or never")
+    parser.add_argument('--autosave-fsync', action='store_true', required=False,
+                        help="Forces every autosave append to disk before going on")
+    parser.add_argument('--log-spill', action='store', required=False, default="",
+                        help="Appends the log entries which no longer fit the last %i kept to LOGFILE" % LogStore.capacity, metavar='LOGFILE')
+    parser.add_argument('--profile', action='store', required=False, default="",
+                        help="Profiles the deduction rules from the start and appends one JSON line per deduction run", metavar='PROFILEFILE')
+    parser.add_argument('--odds', action='store_true', required=False,
+                        help="Shows the probabilities from counting all deals that fit the facts on the sheet")
+    parser.add_argument('--odds-budget', action='store', required=False, default=500, type=int,
+                        help="Draws deals at random instead of counting them after MS milliseconds, for at most as long (default: 500, 0 never gives up counting)", metavar='MS')
+    parser.add_argument('--odds-precision', action='store', required=False, default=0.02, type=float,
+                        help="Stops drawing deals once all odds are within P with 95%% confidence (default: 0.02)", metavar='P')
+    parser.add_argument('--headless', action='store_true', required=False,
+                        help="Fast-forwards the replay without any screen output and prints the final sheets")
+    parser.add_argument('--output', action='store', required=False, default="text", choices=["text", "json", "csv"],
+                        help="Format of the sheets printed after a headless replay or of the batch statistics (csv)")
+    parser.add_argument('--batch', action='store', required=False, default="",
+                        help="Analyzes all replays in the directory or matching the glob and prints statistics", metavar='PATH')
+    parser.add_argument('--jobs', action='store', required=False, default=None, type=int,
+                        help="Number of processes analyzing a batch or drawing deals (default: one per core)",
+                        metavar='N')
+    args = parser.parse_args()
+    if args.batch:
+        files = replay_files(args.batch)
+        start = time.perf_counter()
+        stats = analyze_replays(files, args.jobs, args.engine)
+        write_statistics(stats, args.output)
+        if args.output == "text":
+            print("%i replay(s) in %.2f seconds" % (len(files), time.perf_counter() - start))
         sys.exit()
-    except Exception as e:
-        display.clear_screen()
-        traceback.print_exc()
-        sys.exit()
-
+    if args.output == "csv":
+        parser.error("csv output is only available for --batch")
+    if args.headless and not args.replay:
+        parser.error("--headless needs a replay file")
+    events_replay = args.replay and EventLog.is_event_log(args.replay)
+    if args.turn and not events_replay:
+        parser.error("--turn needs an event log to replay")
+
+    display.headless = args.headless
+    display.clear_screen()
+
+    display.cardsfile = args.cards
+    display.differential = not args.full_redraw
+    display.background = not args.blocking_deductions
+    display.autosave_flush = args.autosave_flush
+    display.autosave_fsync = args.autosave_fsync
+    display.show_odds = args.odds
+    display.logs['engine'].spill = args.log_spill
+    Memory.engine_name = args.engine
+    Memory.in_memory = args.memory_db
+    Memory.snapshot_file = args.snapshot or "cluesheetbot.%i.db" % os.getpid()
+    Memory.snapshot_interval = args.snapshot_interval
+    Memory.undo_depth = args.undo_depth
+    Memory.push = PushServer(args.serve) if args.serve else None
+    Memory.events_file = args.events or None
+    Memory.profiling = bool(args.profile)
+    Memory.profile_file = args.profile or None
+    Memory.odds_budget = args.odds_budget
+    Memory.odds_precision = args.odds_precision
+    Memory.sample_jobs = args.jobs
+
+    if args.replay and not events_replay:
+        display.load_recording(args.replay)
+        if args.typing:
+            display.typing_replay = True
+
+    cards = display.get_card_config(display.cardsfile)
+
+    display.log("Welcome to Clue/Cluedo!\n\nType available commands in [brackets] to interact. Hit TAB to cycle through options, type ? to get a full list and use ENTER to accept. Clear the input line with CTRL+U. Use arrow keys to scroll in tabs and switch between tabs. Once the game has started CTRL+C aborts the current command. CTRL+Q exits *immediately*.")
+
+    while True:
+        try:
+            restored = None
+            if events_replay: #only once, afterwards it is a regular game
+                events_replay = False
+                display.recording = False
+                restored, turns = EventLog.replay(args.replay, args.turn, logger=display.log)
+                display.log("Restored %i turn(s) from %s." % (turns, args.replay))
+            if programloop(display, cards, restored):
+                if display.headless:
+                    print(display.export_sheets(display.memory, args.output))
+                    break
+                display.clear_screen()
+                print("\nBye!")
+                break
+        except ReplayFinished as e:
+            print(display.export_sheets(display.memory, args.output))
+            break
+        except (SystemExit, KeyboardInterrupt) as e:
+            display.clear_screen()
+            print("Fast quit... bye!")
+            sys.exit()
+        except Exception as e:
+            display.clear_screen()
+            traceback.print_exc()
+            sys.exit()
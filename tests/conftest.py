@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import cluesheetbot as csb
+
+
+@pytest.fixture(autouse=True)
+def memory_config(monkeypatch):
+    #games live in memory only, so tests neither leave files behind nor see each other's databases
+    monkeypatch.setattr(csb.Memory, "in_memory", True)
+    monkeypatch.setattr(csb.Memory, "snapshot_file", None)
+    monkeypatch.setattr(csb.Memory, "events_file", None)
+    monkeypatch.setattr(csb.Memory, "push", None)
+
+
+@pytest.fixture
+def play():
+    """Plays a random but consistent game of that many turns straight on Memory, returns the SyntheticGame"""
+    def play(turns, players=4, seed=0, cards_per_category=6):
+        game = benchmark.SyntheticGame(benchmark.variant(cards_per_category), players, seed)
+        for _ in range(turns):
+            game.play_turn()
+        game.deduce()
+        return game
+    return play
@@ -0,0 +1,49 @@
+import random
+import re
+
+import cluesheetbot as csb
+
+ROOMS = ["Ballroom", "Billiard Room", "Conservatory", "Dining Room", "Hall", "Kitchen", "Library", "Lounge", "Study"]
+
+
+def test_word_starts_rank_first():
+    completer = csb.Completer(ROOMS)
+    assert completer.complete("l") == ["Library", "Lounge", "Ballroom", "Billiard Room", "Hall"]
+    assert completer.complete("ro") == ["Billiard Room", "Dining Room", "Ballroom", "Conservatory"]
+    assert completer.complete("RO") == completer.complete("ro")
+    assert completer.complete("bm") == ["Ballroom", "Billiard Room"]
+    assert completer.complete("") == ROOMS
+    assert completer.complete("xyz") == []
+
+
+def test_folded_letters():
+    completer = csb.Completer(["Dıvan", "Kaſtle", "Émile", "Ivy"])
+    assert completer.complete("i") == ["Ivy", "Dıvan", "Émile"]
+    assert completer.complete("DIV") == ["Dıvan"]
+    assert completer.complete("st") == ["Kaſtle"]
+    assert completer.complete("ém") == completer.complete("ÉM") == ["Émile"]
+    assert completer.complete("em") == []
+
+
+def test_matches_are_the_regex_ones():
+    rnd = random.Random(1)
+    words = ["".join(rnd.choice("abcdeAB ıſ") for _ in range(rnd.randrange(1, 12))) for _ in range(200)]
+    completer = csb.Completer(words)
+    typed = ""
+    for _ in range(2000):
+        if typed and rnd.random() < 0.4:
+            typed = typed[:-1]
+        else:
+            typed += rnd.choice("abcdeABis ")
+        pattern = re.compile(".*".join(re.escape(ch) for ch in typed), re.IGNORECASE)
+        assert sorted(completer.complete(typed)) == sorted(w for w in words if pattern.search(w))
+        for memo in (completer.advanced, completer.ranked): #only the inputs on the way to the current one
+            longest = max(memo, key=len)
+            assert typed.lower().translate(completer.folding) in memo
+            assert all(longest.startswith(known) for known in memo)
+
+
+def test_long_input_at_once():
+    completer = csb.Completer(ROOMS + ["a" * 5000])
+    assert completer.complete("a" * 5000) == ["a" * 5000] #no recursion through every shorter input
+    assert completer.complete("a" * 4999 + "b") == []
@@ -0,0 +1,211 @@
+import random
+
+import pytest
+
+import benchmark
+import cluesheetbot as csb
+
+#The deduction statements as they were before facts and clues got their keys and indexes: the reference every
+#engine has to agree with. A rule named counts the facts it changed, the others only drop clues.
+REFERENCE = [
+    ("romeo_and_julia", """
+    WITH
+        plan_raw (perspective, player, has_known, has_target, certainty) AS
+            (WITH
+                allcards (num) AS
+                    (SELECT COUNT(*) FROM cards),
+                cardlimits (player, has, maxcards) AS
+                    (SELECT id, 1, number_of_cards FROM players
+                     UNION SELECT id, 0, ((SELECT num FROM allcards) - number_of_cards) FROM players),
+                playercardstats (perspective, player, has, numcards, certainsum) AS
+                    (SELECT perspective, player, has, COUNT(card), TOTAL(certainty)
+                        FROM facts
+                        GROUP BY perspective, player, has)
+            SELECT s.perspective, s.player, s.has, NOT s.has, (1.0 * s.certainsum / s.numcards)
+                FROM playercardstats s
+                    INNER JOIN cardlimits c
+                    ON s.player = c.player AND s.has = c.has
+                WHERE s.numcards = c.maxcards),
+        plan (perspective, player, has_known, has_target, certainty) AS
+            (SELECT * FROM plan_raw a
+                WHERE NOT EXISTS
+                    (SELECT 1 FROM plan_raw b
+                        WHERE a.perspective = b.perspective AND a.player = b.player
+                        AND a.has_known = NOT b.has_known))
+    UPDATE facts
+        SET has =
+            (SELECT plan.has_target FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.player = plan.player
+                    AND (facts.has IS NULL OR facts.has = plan.has_target)),
+            certainty =
+            (SELECT MAX(plan.certainty, IFNULL(facts.certainty, 0.0)) FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.player = plan.player
+                    AND (facts.has IS NULL OR facts.has = plan.has_target))
+        WHERE EXISTS
+            (SELECT 42 FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.player = plan.player
+                    AND facts.has IS NULL)
+    """),
+    ("highlander", """
+    WITH plan (perspective, card, poorplayer, certainty) AS
+        (SELECT fhas.perspective, fhas.card, fhasnot.player, MAX(IFNULL(fhas.certainty, 0.0), IFNULL(fhasnot.certainty, 0.0))
+            FROM facts fhas
+                JOIN facts fhasnot
+                ON fhas.card = fhasnot.card
+                    AND fhas.perspective = fhasnot.perspective
+            WHERE fhas.has = 1 AND fhasnot.has IS NULL)
+    UPDATE facts
+        SET has = 0,
+            certainty =
+            (SELECT certainty FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.player = plan.poorplayer
+                    AND facts.card = plan.card)
+        WHERE EXISTS
+            (SELECT 42 FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.player = plan.poorplayer
+                    AND facts.card = plan.card);
+    """),
+    ("whats_in_the_box", """
+    WITH
+        onemissing (perspective, type, certainty) AS
+            (SELECT f.perspective, c.type, AVG(f.certainty)
+                FROM facts f
+                    JOIN cards c
+                        ON f.card = c.id
+                    JOIN (SELECT count(type) num, type FROM cards GROUP BY type) cstats
+                        ON c.type = cstats.type
+                WHERE f.has = 1
+                GROUP BY f.perspective, f.has, c.type
+                HAVING COUNT(f.card) = cstats.num - 1),
+        nobodyknows (perspective, card, type) AS
+            (SELECT f.perspective, f.card, c.type
+                FROM facts f
+                    JOIN cards c
+                        ON f.card = c.id
+                GROUP BY f.perspective, f.card
+                HAVING MAX(IFNULL(f.has, 0)) = 0),
+        plan (perspective, card, certainty) AS
+            (SELECT om.perspective, nk.card, om.certainty
+                FROM onemissing om
+                    INNER JOIN nobodyknows nk
+                        ON om.perspective = nk.perspective
+                            AND om.type = nk.type)
+    UPDATE facts
+        SET has = 0,
+            certainty =
+            (SELECT certainty FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.card = plan.card)
+        WHERE EXISTS
+            (SELECT 42 FROM plan
+                WHERE facts.perspective = plan.perspective
+                    AND facts.card = plan.card
+                    AND facts.has IS NULL)
+    """),
+    (None, """
+    WITH analysis (perspective, number, player, lead, has) AS
+        (SELECT cl.perspective, cl.number, cl.player, cl.lead, f.has
+            FROM clues cl
+                JOIN facts f
+                    ON cl.perspective = f.perspective
+                        AND cl.player = f.player
+                        AND cl.lead = f.card
+            WHERE f.has = 0)
+    DELETE FROM clues
+        WHERE EXISTS
+            (SELECT 42 FROM analysis a
+                WHERE a.perspective = clues.perspective
+                    AND a.number = clues.number
+                    AND a.player = clues.player
+                    AND a.lead = clues.lead)
+    """),
+    ("resolve_questioner", """
+    WITH remainders (perspective, questioner, player, lead) AS
+        (SELECT perspective, questioner, player, SUM(lead)
+            FROM clues
+            GROUP BY perspective, number, questioner, player
+            HAVING COUNT(lead) = 1)
+    UPDATE facts
+        SET has = 1, certainty = 1.0
+        WHERE EXISTS
+            (SELECT 42 FROM remainders r
+                WHERE r.questioner = facts.perspective
+                    AND r.player = facts.player
+                    AND r.lead = facts.card)
+    """),
+    ("resolve_solver", """
+    WITH remainders (perspective, number, player, lead) AS
+        (SELECT perspective, number, player, SUM(lead)
+            FROM clues
+            GROUP BY perspective, number, player
+            HAVING COUNT(lead) = 1)
+    UPDATE facts
+        SET has = 1, certainty = 0.5
+        WHERE EXISTS
+            (SELECT 42 FROM remainders r
+                WHERE r.perspective = facts.perspective
+                    AND r.player = facts.player
+                    AND r.lead = facts.card
+                    AND facts.has IS NULL)
+    """),
+    (None, """
+    WITH usedup (perspective, number) AS
+        (SELECT perspective, number
+            FROM clues
+            GROUP BY perspective, number, player
+            HAVING COUNT(lead) = 1)
+    DELETE FROM clues
+        WHERE EXISTS
+            (SELECT 42 FROM usedup u
+                WHERE u.perspective = clues.perspective
+                    AND u.number = clues.number)
+    """),
+]
+
+
+class ReferenceEngine(csb.SQLEngine):
+    def deduce(self):
+        changes = 0
+        for rule, statement in REFERENCE:
+            self.memory.execute(statement)
+            if rule:
+                self.memory.execute("SELECT CHANGES()")
+                changes += self.memory.fetchall()[0][0]
+        return changes
+
+
+def replay(seed, players, turns):
+    """The same synthetic game whatever the engine, with manual facts of every certainty mixed in"""
+    game = benchmark.SyntheticGame(benchmark.variant(6), players, seed)
+    memory, overrides = game.memory, random.Random(seed)
+    for turn in range(turns):
+        game.play_turn()
+        if turn % 4 == 3:
+            player, card = overrides.choice(memory.get_players()), overrides.choice(memory.get_cards())
+            memory.override_fact(player, card, overrides.choice([True, False]), overrides.choice([0.3, 0.7, 1.0]),
+                                 [overrides.choice(memory.get_players())])
+    game.deduce()
+    memory.execute("SELECT perspective, player, card, has, certainty FROM facts ORDER BY perspective, player, card")
+    facts = memory.fetchall()
+    memory.execute("SELECT perspective, number, player, questioner, lead FROM clues ORDER BY perspective, number, player, lead")
+    return facts, memory.fetchall()
+
+
+@pytest.mark.parametrize("engine", sorted(csb.engines))
+@pytest.mark.parametrize("seed", range(6))
+def test_engine_matches_reference(engine, seed, monkeypatch):
+    monkeypatch.setitem(csb.engines, "reference", ReferenceEngine)
+    players, turns = 3 + seed % 4, 12 + 2*seed
+    monkeypatch.setattr(csb.Memory, "engine_name", "reference")
+    expected_facts, expected_clues = replay(seed, players, turns)
+    monkeypatch.setattr(csb.Memory, "engine_name", engine)
+    facts, clues = replay(seed, players, turns)
+    assert [f[:4] for f in facts] == [f[:4] for f in expected_facts]
+    #averaged certainties may be summed up in another order
+    assert [f[4] for f in facts] == pytest.approx([f[4] for f in expected_facts], abs=1e-9)
+    assert clues == expected_clues
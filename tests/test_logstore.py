@@ -0,0 +1,81 @@
+import random
+
+import cluesheetbot as csb
+
+
+def wrap(text):
+    return [text[i:i+8] for i in range(0, len(text), 8)] or [""]
+
+
+def all_lines(store, width):
+    return [line for entry in store.entries for line in store.lines(entry, width)]
+
+
+def test_windows_match_all_lines():
+    rnd = random.Random(0)
+    store = csb.LogStore(wrap, capacity=50)
+    for step in range(600):
+        store.append("x" * rnd.randrange(0, 30) + str(step))
+        skip, count = rnd.randrange(0, 120), rnd.randrange(0, 25)
+        lines = all_lines(store, None)
+        assert store.window(skip, count, None) == lines[max(len(lines) - skip - count, 0):max(len(lines) - skip, 0)]
+        assert store.tail(count, None) == (lines[max(len(lines) - count, 0):] if count else [], len(lines) > count)
+
+
+def test_scrolling_wraps_the_entries_reached_only():
+    wrapped = []
+    def counting(text):
+        wrapped.append(text)
+        return text.split("\n")
+    store = csb.LogStore(counting)
+    for entry in range(1000):
+        store.append("entry %i\nsecond line" % entry)
+    assert store.window(0, 20, 30) == [line for entry in range(990, 1000) for line in ("entry %i" % entry, "second line")]
+    assert len(wrapped) == 10
+    for skip in range(1, 2000):
+        store.window(skip, 20, 30)
+    assert len(wrapped) == 1000 #every entry once, as the window reached it
+    del wrapped[:]
+    store.window(1100, 20, 30)
+    calls = []
+    store.lines = lambda entry, width, lines=store.lines: calls.append(entry) or lines(entry, width)
+    store.window(1101, 20, 30)
+    store.window(1100, 20, 30)
+    assert len(calls) < 40 #the entries around the window, not the 1100 lines below it
+    assert wrapped == []
+
+
+def test_log_window_and_older_lines(monkeypatch):
+    display = csb.Display()
+    shown = {}
+    monkeypatch.setattr(display, "print_at", lambda row, col, text: shown.__setitem__(row, text))
+    store = display.logs['engine']
+    height = display.log_height - 2
+    for entry in range(3):
+        store.append("line %i" % entry)
+    display.update_log()
+    assert display.log_max_scrollup == 0 #all of it fits
+    for entry in range(3, 100):
+        store.append("line %i" % entry)
+
+    def window():
+        rows = [shown[display.log_row + 1 + row] for row in range(1, height + 1)]
+        return [row[1:-1].strip() for row in rows]
+    def arrows():
+        return shown[display.log_row + 2][-1], shown[display.log_row + 1 + height][-1]
+    display.update_log()
+    assert window() == ["line %i" % entry for entry in range(100 - height + 1, 100)] + [""]
+    assert display.log_max_scrollup == 1 #older lines, each step up finds out about the next
+    assert arrows() == ("^", "|")
+
+    display.log_scrollup = 5
+    display.update_log()
+    assert window() == ["line %i" % entry for entry in range(100 - height - 4, 100 - 4)]
+    assert display.log_max_scrollup == 6
+    assert arrows() == ("^", "v")
+
+    display.log_scrollup = 1000
+    display.update_log()
+    assert window() == ["line %i" % entry for entry in range(height)]
+    assert display.log_max_scrollup == 100 - height + 1 #the oldest line is on top, no older ones
+    assert arrows() == ("|", "v")
@@ -0,0 +1,71 @@
+import itertools
+
+import pytest
+
+import cluesheetbot as csb
+
+
+def test_sampler_pool_is_reused(play):
+    memory = play(turns=6).memory
+    perspective = memory.get_players()[0]
+    estimates = []
+    for jobs in (1, 2, 2):
+        sampler = csb.DealSampler(csb.DealCounter(memory, perspective), "seed", precision=0.05, jobs=jobs)
+        estimates.append(sampler.estimate())
+    try:
+        assert estimates[0]['drawn'] and list(csb.DealSampler.pools) == [2]
+        #the tasks are seeded by their number, so the estimates do not depend on the processes drawing them
+        assert estimates[0]['cells'] == estimates[1]['cells'] == estimates[2]['cells']
+    finally:
+        csb.DealSampler.close()
+    assert csb.DealSampler.pools == {}
+
+
+def brute_force(memory, perspective):
+    """Every deal consistent with the perspective's facts and clues, one at a time"""
+    players = memory.get_players()
+    memory.execute("SELECT player, card, has FROM facts WHERE perspective = ? AND has IS NOT NULL", (perspective.id,))
+    facts = dict(((player, card), has) for player, card, has in memory.fetchall())
+    memory.execute("SELECT number, player, lead FROM clues WHERE perspective = ?", (perspective.id,))
+    clues = {}
+    for number, player, lead in memory.fetchall():
+        clues.setdefault((number, player), set()).add(lead)
+    by_type = {}
+    for card in memory.get_cards():
+        by_type.setdefault(card.type, []).append(card)
+    for envelope in itertools.product(*by_type.values()):
+        rest = [c for c in memory.get_cards() if c not in envelope]
+        def deal(cards, hands):
+            if not cards:
+                yield dict(hands)
+                return
+            for player in players:
+                if len(hands[player.id]) < player.number_of_cards:
+                    hands[player.id].append(cards[0])
+                    for dealt in deal(cards[1:], hands):
+                        yield dealt
+                    hands[player.id].pop()
+        for hands in deal(rest, dict((p.id, []) for p in players)):
+            holder = dict((card.id, player) for player, cards in hands.items() for card in cards)
+            if all((holder.get(card) == player) == bool(has) for (player, card), has in facts.items()) and \
+               all(any(holder.get(lead) == player for lead in leads) for (number, player), leads in clues.items()):
+                yield envelope, holder
+
+
+def test_exact_odds_match_brute_force(play):
+    memory = play(turns=5, players=3, seed=2, cards_per_category=4).memory
+    for perspective in memory.get_players():
+        deals = list(brute_force(memory, perspective))
+        odds = csb.DealCounter(memory, perspective).count(solutions=True)
+        assert odds['deals'] == len(deals) > 1
+        for player in memory.get_players():
+            for card in memory.get_cards():
+                held = sum(1 for envelope, holder in deals if holder.get(card.id) == player.id)
+                assert odds['cells'][(player.id, card.id)] == pytest.approx(held / len(deals))
+        for card in memory.get_cards():
+            assert odds['envelope'][card.id] == pytest.approx(sum(card in envelope for envelope, _ in deals) / len(deals))
+        solutions = {}
+        for envelope, _ in deals:
+            solutions[frozenset(envelope)] = solutions.get(frozenset(envelope), 0) + 1
+        assert dict((frozenset(cards), p) for p, cards in odds['solutions']) == \
+            dict((cards, pytest.approx(ways / len(deals))) for cards, ways in solutions.items())
@@ -0,0 +1,57 @@
+import cluesheetbot as csb
+
+
+def test_profile_of_one_turn(play):
+    game = play(turns=4)
+    memory = game.memory
+    memory.profiler = csb.Profiler()
+    stored = []
+    memory.engine.store = lambda store=memory.engine.store: stored.append(store())
+    try:
+        game.play_turn()
+        game.deduce()
+    finally:
+        del memory.engine.store
+    profiler = memory.profiler
+    assert profiler.last_turn == memory.turns == 5
+    assert list(profiler.turns) == [5]
+    runs, cycles, rules = profiler.turns[5]
+    assert runs == len(stored) == profiler.runs > 0
+    assert cycles == profiler.cycles >= runs
+    assert rules["load"][0] == rules["store"][0] == runs
+    for rule in memory.rules:
+        assert rules[rule][0] == cycles #the sql engine runs every rule once a cycle
+    assert rules == profiler.totals
+
+    lines = profiler.report(5).split("\n")
+    assert lines[0] == "Profile of turn 5, %i deduction(s), %i cycles:" % (runs, cycles)
+    assert [line.split()[0] for line in lines[2:]] == [csb.Profiler.abbreviations.get(rule, rule[:5]) for rule in rules]
+    assert profiler.report(4).split("\n")[2:] == []
+
+
+def test_profile_sums_up_turns(play, monkeypatch):
+    monkeypatch.setattr(csb.Memory, "profiling", True)
+    profiler = play(turns=6).memory.profiler
+    assert sorted(profiler.turns) == list(range(7)) #turn 0 deduces the cards dealt
+    assert sum(runs for runs, cycles, rules in profiler.turns.values()) == profiler.runs
+    assert sum(cycles for runs, cycles, rules in profiler.turns.values()) == profiler.cycles
+    for rule, (runs, evaluated, seconds, rows) in profiler.totals.items():
+        assert sum(rules[rule][0] for _, _, rules in profiler.turns.values() if rule in rules) == runs
+        assert sum(rules[rule][3] for _, _, rules in profiler.turns.values() if rule in rules) == rows
+
+
+def test_no_profiler_unless_profiling(play):
+    game = play(turns=3)
+    assert game.memory.profiler is None
+
+
+def test_engine_tab_shows_the_last_turn(play):
+    game = play(turns=2)
+    display = csb.Display()
+    display.memory = game.memory
+    display.profile()
+    game.play_turn()
+    game.deduce()
+    display.profile()
+    assert [entry[0].split("\n")[0].split(",")[0] for entry in display.logs['engine'].entries][-2:] == \
+        ["Profile of %i deduction(s)" % game.memory.profiler.runs, "Profile of turn 3"]
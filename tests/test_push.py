@@ -0,0 +1,72 @@
+import json
+import urllib.request
+
+import pytest
+
+import cluesheetbot as csb
+
+
+@pytest.fixture
+def push():
+    server = csb.PushServer(0) #any free port
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+def get(push, path):
+    return urllib.request.urlopen(push.address + path, timeout=10)
+
+
+def next_event(stream):
+    """(event, data) of the next server-sent event, skipping keepalives"""
+    fields = {}
+    for line in stream:
+        line = line.decode().rstrip("\n")
+        if not line:
+            if "event" in fields:
+                return fields["event"], json.loads(fields["data"])
+            fields = {}
+        elif not line.startswith(":"):
+            name, value = line.split(": ", 1)
+            fields[name] = value
+    raise EOFError("stream ended")
+
+
+def test_sheet_and_changes_of_a_turn(play, push):
+    game = play(turns=3)
+    memory = game.memory
+    memory.push = push
+    memory.publish()
+    with get(push, "/sheet") as response:
+        sheet = json.load(response)
+    assert sheet["perspective"] == memory.user.name
+    assert sheet["turn"] == 3
+    assert len(sheet["cards"]) == len(memory.get_cards())
+
+    game.play_turn()
+    game.deduce()
+    assert push.version > sheet["version"]
+    with get(push, "/events?since=%i" % sheet["version"]) as stream:
+        events = [next_event(stream) for _ in range(push.version - sheet["version"])]
+    assert [event for event, data in events] == ["changes"] * len(events)
+    assert [data["version"] for event, data in events] == list(range(sheet["version"] + 1, push.version + 1))
+    assert events[-1][1]["turn"] == 4
+    assert events[-1][1]["whose_turn"] == memory.whose_turn.name
+
+
+def test_background_deductions_publish(play, push):
+    game = play(turns=3)
+    memory = game.memory
+    memory.push = push
+    memory.publish()
+    version = push.version
+    memory.begin_turn()
+    memory.record_pass(memory.next_player(memory.whose_turn), [game.by_type[t][0] for t in ("room", "suspect", "weapon")])
+    memory.start_deductions(publish=True)
+    memory.publish() #waits for the deducer thread publishing first
+    with get(push, "/events?since=%i" % version) as stream:
+        event, data = next_event(stream)
+    assert event == "changes"
+    assert data["facts"]
+    assert push.sheet()["version"] == push.version
@@ -0,0 +1,61 @@
+import re
+
+import pytest
+
+#The statements of the SQL engine (Memory.deduce) by a name they define, and the indexes they reach facts and clues
+#through. None of them may scan a table per candidate row: every correlated subquery searches an index. The only
+#scans are those reading the whole sheet once per statement in index order, which a rule counting or listing it as
+#a whole needs anyway: Romeo-and-Julia counts every player's known cards, refining the clues walks every clue.
+#The wording of the plans differs between SQLite versions, so only the indexes are compared.
+PLANS = {
+    "cardlimits": ("romeo_and_julia", {"facts_by_player"}),
+    "fhasnot": ("highlander", {"facts_by_has", "PRIMARY KEY"}),
+    "onemissing": ("whats_in_the_box", {"facts_by_has"}),
+    "analysis": ("refine_clues", {"clues_by_questioner", "PRIMARY KEY"}),
+    "remainders (perspective, questioner": ("resolve_questioner", {"clues_by_questioner", "PRIMARY KEY"}),
+    "remainders (perspective, number": ("resolve_solver", {"PRIMARY KEY", "facts_by_has"}),
+    "usedup": ("drop_clues", {"PRIMARY KEY", "clues_by_questioner"}),
+}
+
+#Both tables are WITHOUT ROWID, so a plain scan walks their primary key
+ACCESS = re.compile(r"(SCAN|SEARCH) (?:TABLE )?(facts|clues|f|fhas|fhasnot|cl)\b(?: USING (?:(AUTOMATIC )?(?:COVERING )?INDEX(?: (\w+))?|PRIMARY KEY))?")
+
+
+def index(detail):
+    """The index an access of facts or clues goes through, None for an index built on the fly"""
+    automatic, name = ACCESS.match(detail).group(3, 4)
+    return None if automatic else name or "PRIMARY KEY"
+
+
+@pytest.fixture
+def statements(play):
+    memory = play(turns=8, players=6).memory
+    statements = []
+    memory.real_brain.dbconn.set_trace_callback(statements.append)
+    memory.deduce()
+    memory.real_brain.dbconn.set_trace_callback(None)
+    return memory, [s for s in statements if "facts" in s or "clues" in s]
+
+
+def test_every_rule_is_planned(statements):
+    memory, statements = statements
+    assert sorted(marker for marker in PLANS for s in statements if marker in s) == sorted(PLANS)
+
+
+def test_rules_search_indexes(statements):
+    memory, statements = statements
+    for statement in statements:
+        marker = next(marker for marker in PLANS if marker in statement)
+        rule, expected = PLANS[marker]
+        memory.execute("EXPLAIN QUERY PLAN " + statement)
+        plan = memory.fetchall()
+        used = set(index(detail) for node, parent, _, detail in plan if ACCESS.match(detail))
+        assert None not in used, rule #no index built for want of one
+        assert used == expected, rule
+        #no scan of its own per row of an outer query
+        parents = dict((node, parent) for node, parent, _, detail in plan)
+        correlated = set(node for node, parent, _, detail in plan if "CORRELATED" in detail) #"EXECUTE CORRELATED ..." in older versions
+        for node, parent, _, detail in plan:
+            while parent and detail.startswith("SCAN") and ACCESS.match(detail):
+                assert parent not in correlated, (rule, detail)
+                parent = parents.get(parent)
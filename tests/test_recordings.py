@@ -0,0 +1,159 @@
+import json
+import os
+
+import pytest
+
+import benchmark
+import cluesheetbot as csb
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def sheet(memory):
+    memory.execute("SELECT p.name, q.name, c.name, f.has, f.certainty FROM facts f JOIN players p ON p.id = f.perspective"
+                   " JOIN players q ON q.id = f.player JOIN cards c ON c.id = f.card ORDER BY 1, 2, 3")
+    return [[perspective, player, card, bool(has), certainty] for perspective, player, card, has, certainty
+            in memory.fetchall()]
+
+
+@pytest.fixture
+def replayed():
+    """Replays a keystroke recording headless, returns its Memory"""
+    def replayed(name):
+        display, replaying, saving = benchmark.replay_headless(os.path.join(DATA, name))
+        return display.memory
+    return replayed
+
+
+def test_recording_gives_the_baseline_sheet(replayed):
+    #long_game.sav was played with passes before cards shown to the user, its sheet is the one the first release left
+    with open(os.path.join(DATA, "long_game_sheet.json")) as reference:
+        expected = json.load(reference)
+    assert sheet(replayed("long_game.sav")) == [row[:4] + [pytest.approx(row[4], abs=1e-6)] for row in expected]
+
+
+def test_event_log_gives_the_sheet_of_its_game(replayed, monkeypatch, tmp_path):
+    events = str(tmp_path / "game.jsonl")
+    monkeypatch.setattr(csb.Memory, "events_file", events)
+    played = sheet(replayed("long_game.sav"))
+    monkeypatch.setattr(csb.Memory, "events_file", None)
+    memory, turns = csb.EventLog.replay(events)
+    assert sheet(memory) == played
+
+
+def test_headless_replay_is_the_drawn_one(replayed, capsys, tmp_path):
+    path = os.path.join(DATA, "long_game.sav")
+    display = csb.Display()
+    display.autosave_file = str(tmp_path / "autosave_replay.sav")
+    display.load_recording(path, inform_user=False)
+    def getch():
+        raise csb.ReplayFinished("end of replay")
+    display.getch = getch
+    cards = display.get_card_config(display.cardsfile)
+    try:
+        while not csb.programloop(display, cards):
+            pass
+    except csb.ReplayFinished:
+        pass
+    assert len(capsys.readouterr().out) > 10000 #the game was drawn all along
+
+    memory = replayed("long_game.sav")
+    assert sheet(memory) == sheet(display.memory)
+    assert csb.Display().export_sheets(memory, "json") == display.export_sheets(display.memory, "json")
+    assert memory.turns == display.memory.turns and memory.clue_number == display.memory.clue_number
+
+
+def test_keys_are_replayed_and_recorded_in_chunks(tmp_path):
+    display = csb.Display()
+    display.record_chunk_size = 7
+    keys = "".join(chr(ord("a") + n % 26) + ("\r" if n % 5 == 0 else "") for n in range(100)) + "é€"
+    savefile = str(tmp_path / "keys.sav")
+    with open(savefile, "w", newline='') as save:
+        save.write("cards.txt\0" + keys)
+    display.load_recording(savefile, inform_user=False)
+    replayed = [display.getchar() for _ in keys]
+    assert "".join(replayed) == keys and display.simpos == len(keys)
+    assert [len(chunk) for chunk in display.recordbuffer] == [7] * (len(keys) // 7)
+    assert len(display.recordchunk) == len(keys) % 7
+    for start in range(len(keys) + 2): #what a journal appends from any position on
+        assert display.recorded(start) == keys[start:]
+    display.save_recording(str(tmp_path / "again.sav"), inform_user=False)
+    with open(str(tmp_path / "again.sav"), "rb") as again, open(savefile, "rb") as save:
+        assert again.read() == save.read()
+
+
+def test_autosave_journal_and_recovery(tmp_path):
+    display = csb.Display()
+    display.autosave_file = str(tmp_path / "autosave_replay.sav")
+    display.cardsfile = "cards.txt"
+    display.record_chunk_size = 4
+    typed = ""
+    for part in ("new game\r", "Me\r", "Colonel Mustard\r", "", "Ställe\r"):
+        display.recordchunk.extend(part) #as getchar records them
+        typed += part
+        display.autosave()
+        with open(display.autosave_file, "rb") as save:
+            assert save.read() == ("cards.txt\0" + typed).encode()
+    assert display.journal.written == len(typed)
+
+    #a crash in the middle of a write leaves half a character or padding behind
+    with open(display.autosave_file, "ab") as save:
+        save.write("é".encode()[:1] + b"\0\0")
+    restored = csb.Display()
+    logged = []
+    restored.log = logged.append
+    restored.load_recording(display.autosave_file)
+    assert (restored.cardsfile, restored.simbuffer) == ("cards.txt", typed)
+    assert "Recovered replay, skipped its damaged end." in logged
+
+
+def test_event_log_seeks_from_checkpoints(replayed, monkeypatch, tmp_path):
+    events = str(tmp_path / "game.jsonl")
+    monkeypatch.setattr(csb.EventLog, "checkpoint_interval", 3)
+    monkeypatch.setattr(csb.Memory, "events_file", events)
+    replayed("long_game.sav")
+    monkeypatch.setattr(csb.Memory, "events_file", None)
+    with open(events) as log:
+        lines = log.readlines()
+    assert sum(line.startswith('{"event": "checkpoint"') for line in lines) > 3
+    full = str(tmp_path / "without_checkpoints.jsonl")
+    with open(full, "w") as log:
+        log.writelines(line for line in lines if not line.startswith('{"event": "checkpoint"'))
+
+    begun = []
+    begin_turn = csb.Memory.begin_turn
+    monkeypatch.setattr(csb.Memory, "begin_turn", lambda memory: begun.append(memory) or begin_turn(memory))
+    for until_turn in range(1, 50):
+        sought, turns = csb.EventLog.replay(events, until_turn)
+        assert len(begun) <= 3 #the turns since the last checkpoint only
+        del begun[:]
+        played, played_turns = csb.EventLog.replay(full, until_turn)
+        del begun[:]
+        assert turns == played_turns
+        assert sought.state() == played.state(), until_turn
+        assert sheet(sought) == sheet(played)
+    assert turns < 48 #up to the end of the game
+
+
+def test_batch_analysis_in_parallel(replayed, monkeypatch, tmp_path):
+    archive = tmp_path / "archive"
+    archive.mkdir()
+    monkeypatch.setattr(csb.Memory, "events_file", str(archive / "b_game.jsonl"))
+    replayed("long_game.sav")
+    monkeypatch.setattr(csb.Memory, "events_file", None)
+    with open(os.path.join(DATA, "long_game.sav"), "rb") as save, open(str(archive / "a_game.sav"), "wb") as copy:
+        copy.write(save.read())
+    with open(str(archive / "c_broken.sav"), "w") as broken:
+        broken.write("no_such_cards.txt\0new game\r")
+    (archive / "notes.txt").write_text("not a replay")
+
+    files = csb.replay_files(str(archive))
+    assert [os.path.basename(name) for name in files] == ["a_game.sav", "b_game.jsonl", "c_broken.sav"]
+    parallel = csb.analyze_replays(files, jobs=2)
+    serial = csb.analyze_replays(files, jobs=1)
+    for stats in parallel + serial:
+        stats.pop('wall_time')
+    assert parallel == serial
+    assert [stats['file'] for stats in parallel] == files
+    assert "error" not in parallel[0] and "error" not in parallel[1] and "error" in parallel[2]
+    assert parallel[0]['turns'] == parallel[1]['turns'] > 0
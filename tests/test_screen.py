@@ -0,0 +1,67 @@
+import random
+import re
+
+import cluesheetbot as csb
+
+
+class Terminal(object):
+    """Just enough of a terminal to follow what Screen sends: cursor moves, graphics renditions and text"""
+
+    def __init__(self):
+        self.cells = {}
+        self.row, self.col = None, None
+        self.attr = ''
+
+    def feed(self, data):
+        for part in re.split("(\033\\[[0-9;]*[Hm])", data):
+            if part.startswith("\033["):
+                params = part[2:-1]
+                if part.endswith("H"):
+                    self.row, self.col = [int(n) for n in params.split(";")]
+                else:
+                    self.attr = '' if params in ('', '0') else params[2:] if params.startswith("0;") else params
+                continue
+            for ch in part:
+                self.cells[(self.row, self.col)] = (ch, self.attr)
+                self.col += 1
+
+
+def visible(screen):
+    return dict((pos, cell) for pos, cell in screen.back.items() if cell != screen.blank)
+
+
+def test_flushes_paint_the_back_buffer():
+    rnd = random.Random(0)
+    screen, terminal = csb.Screen(), Terminal()
+    for frame in range(200):
+        for _ in range(rnd.randrange(0, 6)):
+            color = rnd.choice(["", "\033[31m", "\033[1;32m", "\033[0m"])
+            text = "".join(rnd.choice("ab .") for _ in range(rnd.randrange(1, 12)))
+            screen.put(rnd.randrange(1, 8), rnd.randrange(1, 30), color + text + "\033[0m")
+        terminal.feed(screen.render())
+        assert dict((pos, cell) for pos, cell in terminal.cells.items() if cell != screen.blank) == visible(screen)
+        assert (terminal.row, terminal.col) == screen.cursor
+        assert terminal.attr == "" #nothing bleeds into text printed after a frame
+
+
+def test_only_changes_are_sent():
+    screen = csb.Screen()
+    screen.put(3, 1, "Kitchen \033[32mX\033[0m")
+    first = screen.render()
+    assert "Kitchen" in first
+    screen.put(3, 1, "Kitchen \033[32mX\033[0m") #the same again
+    assert screen.render() == ""
+    screen.put(3, 1, "Kitchen \033[32m?\033[0m")
+    assert screen.render() == "\033[3;9H\033[0;32m?\033[0m"
+    screen.put(5, 1, "ab")
+    screen.put(5, 6, "cd")
+    assert screen.render() == "\033[5;1Hab   cd" #a short gap is repeated rather than jumped over
+
+
+def test_clear_repaints_everything():
+    screen = csb.Screen()
+    screen.put(1, 1, "Hall")
+    screen.render()
+    screen.clear()
+    screen.put(1, 1, "Hall")
+    assert "Hall" in screen.render()
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import benchmark
+import cluesheetbot as csb
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def test_sessions_with_different_engines_side_by_side():
+    names = benchmark.variant(6)
+    sessions = csb.Sessions(jobs=2)
+    games = {}
+    for engine in ("sql", "bitset"):
+        sessions.open(engine, engine_name=engine)
+        games[engine] = benchmark.HostedGame(names, 4, seed=3)
+        sessions.submit(engine, 'setup', *games[engine].setup).result()
+    futures = []
+    for turn in range(12):
+        for engine, game in games.items(): #queued alternately, so both games run at the same time
+            futures.append(sessions.submit(engine, 'play_turn', *game.turn()))
+    for future in futures:
+        future.result()
+
+    assert isinstance(sessions.sessions["sql"].memory.engine, csb.SQLEngine)
+    assert isinstance(sessions.sessions["bitset"].memory.engine, csb.BitsetEngine)
+    assert csb.Memory.engine_name == csb.SessionMemory.engine_name == "sql"
+    sheets = dict((engine, sessions.submit(engine, 'sheet').result()) for engine in games)
+    key = lambda fact: (fact['player'], fact['card'])
+    for sheet in sheets.values():
+        sheet['facts'].sort(key=key)
+    assert sheets["sql"] == sheets["bitset"]
+    sessions.shutdown()
+
+
+def test_settings_of_one_memory_only():
+    memory = csb.Memory(in_memory=True, engine_name="incremental", undo_depth=3)
+    assert isinstance(memory.engine, csb.IncrementalEngine)
+    assert memory.undo_depth == 3
+    assert (csb.Memory.engine_name, csb.Memory.undo_depth) == ("sql", 20)
+    with pytest.raises(TypeError):
+        csb.Memory(engine="bitset")
+
+
+def test_analyze_replay_leaves_the_defaults():
+    display = csb.display
+    stats = csb.analyze_replay(os.path.join(DATA, "long_game.sav"), engine_name="bitset")
+    assert "error" not in stats and stats['turns'] > 0
+    assert csb.display is display
+    assert csb.Memory.engine_name == "sql"
+    assert csb.Memory.in_memory is True #as the tests set it, not the batch analysis
+    assert stats == dict(csb.analyze_replay(os.path.join(DATA, "long_game.sav")), wall_time=stats['wall_time'])
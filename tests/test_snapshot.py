@@ -0,0 +1,39 @@
+import os
+import sqlite3
+
+import pytest
+
+import cluesheetbot as csb
+
+
+def dump(connection):
+    return dict((table, sorted(connection.execute("SELECT * FROM " + table).fetchall()))
+                for table in ("cards", "players", "facts", "clues", "changes", "sqlite_sequence"))
+
+
+def test_snapshot_during_turn(play, monkeypatch, tmp_path):
+    snapshot = str(tmp_path / "sheet.db")
+    monkeypatch.setattr(csb.Memory, "snapshot_file", snapshot)
+    memory = play(turns=5).memory
+    memory.begin_turn() #the turn savepoint keeps a transaction open, the backup API can not be used
+    assert memory.real_brain.dbconn.in_transaction
+    memory.publish()
+    assert not os.path.exists(snapshot + ".part")
+    copy = sqlite3.connect(snapshot)
+    assert dump(copy) == dump(memory.real_brain.dbconn)
+    copy.close()
+
+
+def test_failed_snapshot_leaves_no_partial_file(play, monkeypatch, tmp_path):
+    snapshot = str(tmp_path / "sheet.db")
+    monkeypatch.setattr(csb.Memory, "snapshot_file", snapshot)
+    memory = play(turns=2).memory
+    memory.begin_turn()
+
+    def broken(self, target, table):
+        raise sqlite3.OperationalError("disk full")
+    monkeypatch.setattr(csb.DB, "copy_rows", broken)
+    with pytest.raises(sqlite3.OperationalError):
+        memory.publish()
+    assert not os.path.exists(snapshot + ".part")
+    assert not os.path.exists(snapshot)
@@ -0,0 +1,80 @@
+import pickle
+
+import pytest
+
+import cluesheetbot as csb
+
+
+class Statements(object):
+    """The statements the game hands to its database while in the block, a statement run for many rows counted once"""
+    def __init__(self, memory):
+        self.brain = memory.real_brain
+        self.run = []
+
+    def __enter__(self):
+        execute, executemany = self.brain.execute, self.brain.executemany
+        self.brain.execute = lambda query, vals=(): self.traced(execute, query, vals)
+        self.brain.executemany = lambda query, vals: self.traced(executemany, query, vals)
+        return self.run
+
+    def __exit__(self, *exc):
+        del self.brain.execute, self.brain.executemany
+
+    def traced(self, method, query, vals):
+        self.run.append(" ".join(query.split()))
+        return method(query, vals)
+
+
+@pytest.mark.parametrize("players", [3, 6])
+def test_registry_lookups_run_no_statements(play, players):
+    memory = play(turns=3, players=players).memory
+    with Statements(memory) as run:
+        player = memory.whose_turn
+        for _ in range(2*players):
+            player = memory.next_player(player)
+            assert memory.get_player(playername=player.name) is player
+            assert memory.get_player(playerid=player.id) is player
+            for card in memory.get_cards():
+                assert memory.get_card(cardname=card.name) is card
+                assert memory.get_card(cardid=card.id) is card
+    assert run == []
+
+
+def test_registry_entries_are_immutable(play):
+    memory = play(turns=2).memory
+    player, card = memory.get_players()[1], memory.get_cards()[0]
+    with pytest.raises(AttributeError):
+        player.number_of_cards = 9
+    with pytest.raises(AttributeError):
+        card.name = "Hall"
+    memory.get_players().reverse()
+    memory.get_cards().pop()
+    assert memory.get_players()[1] is player and memory.get_cards()[0] is card #copies handed out only
+
+    changed = memory.set_number_of_cards(player, player.number_of_cards + 1)
+    assert changed == player and changed.number_of_cards == player.number_of_cards + 1 #a new entry replaces it
+    assert memory.get_player(playerid=player.id) is changed is memory.get_player(playername=player.name)
+    assert memory.get_players()[1] is changed
+    memory.execute("SELECT number_of_cards FROM players WHERE id = ?", (player.id,))
+    assert memory.fetchall() == [(changed.number_of_cards,)]
+    assert pickle.loads(pickle.dumps(changed)).number_of_cards == changed.number_of_cards
+
+@pytest.mark.parametrize("players,cards_per_category", [(3, 6), (6, 6), (6, 9)])
+def test_statements_per_deduction_round(play, monkeypatch, players, cards_per_category):
+    #one statement per rule and per count of its changes, however many players and cards there are
+    memory = play(turns=4, players=players, cards_per_category=cards_per_category).memory
+    with Statements(memory) as run:
+        memory.engine.deduce()
+    assert len(run) == 12
+
+    #the bitset engines read the sheet once and write back what changed in one savepoint
+    monkeypatch.setattr(csb.Memory, "engine_name", "bitset")
+    memory = play(turns=4, players=players, cards_per_category=cards_per_category).memory
+    memory.execute("SELECT perspective, player, card FROM facts WHERE has IS NULL ORDER BY perspective, player, card LIMIT 1")
+    perspective, player, card = memory.fetchall()[0]
+    memory.add_facts([(memory.get_player(playerid=perspective), memory.get_player(playerid=player),
+                       memory.get_card(cardid=card), True, 1.0)]) #nobody else holds it then
+    with Statements(memory) as run:
+        memory.run_deductions()
+    assert [statement.split()[0] for statement in run] == ["SELECT", "SELECT", "SAVEPOINT", "UPDATE", "DELETE", "RELEASE",
+                                                           "SELECT"] #whether the user solved the game
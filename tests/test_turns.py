@@ -0,0 +1,124 @@
+import time
+
+import cluesheetbot as csb
+
+
+def clue_numbers(memory):
+    memory.execute("SELECT DISTINCT number FROM clues ORDER BY number")
+    return [row[0] for row in memory.fetchall()]
+
+
+def test_clue_numbers_after_undo(play):
+    game = play(turns=6)
+    memory = game.memory
+    before = memory.clue_number
+    for _ in range(3):
+        game.play_turn()
+    assert memory.clue_number > before
+    memory.undo_turns(3)
+    assert memory.clue_number == before
+    assert max(clue_numbers(memory) or [0]) <= before
+    while memory.clue_number == before:
+        game.play_turn()
+    assert memory.clue_number == before + 1 #never more than one clue a turn
+
+
+def test_clue_numbers_after_aborted_turn(play):
+    game = play(turns=4)
+    memory = game.memory
+    before = memory.clue_number
+    memory.begin_turn()
+    memory.record_answers(memory.whose_turn, [game.by_type[t][0] for t in ("room", "suspect", "weapon")],
+                          [(memory.next_player(memory.whose_turn), True, None)])
+    assert memory.clue_number == before + 1
+    memory.abort_turn()
+    assert memory.clue_number == before
+    assert max(clue_numbers(memory) or [0]) <= before
+
+
+def test_clue_numbers_from_saved_state(play):
+    memory = play(turns=8).memory
+    state = memory.state()
+    restored = play(turns=0).memory
+    restored.restore_state(state)
+    assert restored.clue_number == memory.clue_number
+    del state['clue_number'] #event logs written before it was saved
+    restored.restore_state(state)
+    assert restored.clue_number == max(clue_numbers(memory) or [0])
+
+
+def test_undo_supersedes_running_deductions(play):
+    game = play(turns=4)
+    memory = game.memory
+    game.play_turn()
+    generation, cycles = memory.generation, []
+    deadline = time.monotonic() + 5
+
+    def deduce(): #a cycle finding something new every time, until the undo supersedes it
+        cycles.append(memory.generation)
+        while memory.generation == generation and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return 1
+    memory.engine.deduce = deduce
+    memory.settled = False
+    memory.start_deductions()
+    memory.undo_turns(1)
+    assert cycles == [generation]
+    assert memory.deduction is None and not memory.settled
+
+    del memory.engine.deduce
+    memory.start_deductions()
+    memory.finish_deductions()
+    assert memory.settled
+
+
+def test_answer_supersedes_running_deductions(play):
+    game = play(turns=4)
+    memory = game.memory
+    generation, cycles, published = memory.generation, [], []
+    deadline = time.monotonic() + 5
+
+    def deduce(): #as above, until the answer supersedes it
+        cycles.append(memory.generation)
+        while memory.generation == generation and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return 1
+    memory.engine.deduce = deduce
+    memory.publish = lambda turn_boundary=True: published.append(memory.generation)
+    memory.settled = False
+    memory.begin_turn()
+    memory.start_deductions(publish=True)
+    memory.record_pass(memory.next_player(memory.whose_turn), [game.by_type[t][0] for t in ("room", "suspect", "weapon")])
+    assert time.monotonic() < deadline #not waiting for the run to time out
+    assert cycles == [generation]
+    assert published == [] #the stale run shows nothing
+    assert memory.deduction is None and not memory.settled
+
+    del memory.engine.deduce
+    memory.start_deductions(publish=True)
+    memory.finish_deductions()
+    assert memory.settled
+    assert published and set(published) == {generation + 1}
+
+
+def test_undo_stays_offered_while_turns_remain(play):
+    game = play(turns=5)
+    memory = game.memory
+    offered = []
+    class Menu(object):
+        def refresh(self, *args, **kwargs):
+            pass
+        def autosave(self):
+            pass
+        def ask(self, question, choices=None):
+            offered.append(choices)
+            return "refresh"
+        def log(self, *args, **kwargs):
+            pass
+    memory.undo_turns(1)
+    assert memory.undoable_turns() == 4
+    csb.gameloop(memory, Menu())
+    assert "undo" in offered[-1]
+    memory.undo_turns(4)
+    csb.gameloop(memory, Menu())
+    assert "undo" not in offered[-1]